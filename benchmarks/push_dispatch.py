@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Micro-benchmark of delivering pushes to a device's receivers.
+
+Compares Django's Signal.send_robust, used for device pushes before, with
+DeviceSignal.send for a range of subscriber counts. Receivers are bound
+methods, like the socket namespace callbacks.
+
+Run from the repository root:
+    python benchmarks/push_dispatch.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xbgw_dashboard.settings")
+
+from django.dispatch import Signal
+from xbgw_dashboard.apps.dashboard.signals import SignalDict
+
+DEVICE_ID = '00000000-00000000-00409DFF-FF000001'
+SENDS = 1000
+SUBSCRIBERS = (1, 5, 20, 100)
+REPEAT = 10
+
+
+class Namespace(object):
+
+    def device_data_receiver(self, **kwargs):
+        return True
+
+
+def main():
+    data = {'topic': '1/DataPoint/dia/channel/%s/DIO/0' % DEVICE_ID}
+    print '%-12s %12s %12s' % ('subscribers', 'Signal ms', 'Device ms')
+    for count in SUBSCRIBERS:
+        namespaces = [Namespace() for i in range(count)]
+
+        signal = Signal(providing_args=['device_id', 'data'])
+        signals = SignalDict(['device_id', 'data'])
+        for namespace in namespaces:
+            signal.connect(namespace.device_data_receiver)
+            signals.connect(DEVICE_ID, namespace.device_data_receiver)
+        device_signal = signals[DEVICE_ID]
+
+        def django_send():
+            for i in xrange(SENDS):
+                signal.send_robust(sender=None, device_id=DEVICE_ID,
+                                   data=data)
+
+        def device_send():
+            for i in xrange(SENDS):
+                device_signal.send(device_id=DEVICE_ID, data=data)
+
+        results = [min(timeit.repeat(func, number=1, repeat=REPEAT)) * 1000
+                   for func in (django_send, device_send)]
+        print '%-12d %12.2f %12.2f' % tuple([count] + results)
+    print '(times per %d sends)' % SENDS
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Micro-benchmark of push monitor routing.
+
+Routes a 1000 message Document through the original per-message parsing
+loop of monitor_receiver and through PushRouter, delivering to a no-op
+receiver for a handful of subscribed devices.
+
+Run from the repository root:
+    python benchmarks/push_routing.py
+"""
+import os
+import sys
+import re
+import timeit
+from urllib import unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "xbgw_dashboard.settings")
+
+from xbgw_dashboard.apps.dashboard.signals import SignalDict
+from xbgw_dashboard.apps.dashboard.routing import PushRouter
+from xbgw_dashboard.apps.dashboard.push import send_signals
+
+MESSAGES = 1000
+DEVICES = 50
+SUBSCRIBED = 10
+REPEAT = 20
+
+
+def make_document():
+    msgs = []
+    for i in range(MESSAGES):
+        device_id = '00000000-00000000-00409DFF-FF%06X' % (i % DEVICES)
+        if i % 10:
+            msgs.append({
+                'topic': '1/DataPoint/dia/channel/%s/DIO/%d' % (device_id,
+                                                                i % 4),
+                'DataPoint': {'data': i},
+            })
+        else:
+            msgs.append({
+                'topic': '1/DeviceCore/%d/0' % i,
+                'DeviceCore': {'devConnectwareId': device_id},
+            })
+    return {'Document': {'Msg': msgs}}
+
+
+def legacy_route(signal_maps, messages):
+    # monitor_receiver's message loop before PushRouter, delivering through
+    # DeviceSignal like the router path
+    for msg in messages:
+        topic_full = msg['topic']
+        (topic, subtopic) = topic_full.split('/', 2)[1:]
+        subtopic = unquote(subtopic)
+        signal_map = signal_maps[topic]
+        signal = None
+        args = {}
+        if topic == 'DataPoint':
+            reg_pattern = "\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))"
+            match = re.match(reg_pattern, subtopic)
+            if match:
+                device_id = match.groupdict()['dev_id']
+                signal = signal_map[device_id]
+                args['device_id'] = device_id
+                args['data'] = msg
+        elif topic == 'DeviceCore':
+            device_id = msg['DeviceCore']['devConnectwareId']
+            signal = signal_map[device_id]
+            args['device_id'] = device_id
+            args['data'] = msg
+        if signal is not None and len(signal.receivers):
+            signal.send(**args)
+
+
+def new_route(router, messages):
+    send_signals(router.route(messages))
+
+
+def receiver(**kwargs):
+    pass
+
+
+def main():
+    signal_maps = {
+        'DataPoint': SignalDict(['device_id', 'data']),
+        'DeviceCore': SignalDict(['device_id', 'data']),
+    }
+    for i in range(SUBSCRIBED):
+        device_id = '00000000-00000000-00409DFF-FF%06X' % i
+        signal_maps['DataPoint'][device_id].connect(receiver)
+        signal_maps['DeviceCore'][device_id].connect(receiver)
+    router = PushRouter(signal_maps)
+    messages = make_document()['Document']['Msg']
+
+    for name, func in (('legacy', lambda: legacy_route(signal_maps, messages)),
+                       ('router', lambda: new_route(router, messages))):
+        best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print '%-8s %8.2f ms per %d message Document' % (name, best * 1000,
+                                                         MESSAGES)
+
+
+if __name__ == '__main__':
+    main()
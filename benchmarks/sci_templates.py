@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Micro-benchmark of building SCI request bodies.
+
+Compares the original dict tree passed to xmltodict.unparse with the
+precompiled templates in libs/digi/sci, for:
+
+- set_output, sent on every IO toggle from the dashboard
+- set_device_settings for a remote XBee, with a handful of settings
+- get_device_settings for a remote XBee
+
+Run from the repository root:
+    python benchmarks/sci_templates.py
+"""
+import os
+import sys
+import timeit
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xmltodict
+from xbgw_dashboard.libs.digi import sci
+
+REPEAT = 5
+NUMBER = 2000
+
+DEVICE_ID = '00000000-00000000-00409DFF-FF000001'
+RADIO = '00:13:A2:00:40:A1:2B:01!'
+SETTINGS = {'InputOutput': {'D0': '4', 'D1': '5', 'D2': '0', 'D3': '3'},
+            'radio': {'NI': 'Node & co'}}
+
+
+def rci_dict(rci_request, cache=None):
+    send_message = {
+        'targets': {'device': {'@id': DEVICE_ID}},
+        'rci_request': rci_request,
+    }
+    if cache is not None:
+        send_message['@cache'] = str(cache)
+    return {'sci_request': {'@version': '1.0', 'send_message': send_message}}
+
+
+def set_output_unparse():
+    return xmltodict.unparse(rci_dict({
+        '@version': '1.1',
+        'set_state': {
+            'Executable': OrderedDict([('OM', '0x3'), ('IO', '0x1')]),
+        },
+    }))
+
+
+def set_output_template():
+    return sci.rci_request(DEVICE_ID, sci.SET_STATE.render(
+        state=sci.element('OM', '0x3') + sci.element('IO', '0x1')))
+
+
+def set_settings_unparse():
+    settings = SETTINGS.copy()
+    settings['@addr'] = RADIO
+    return xmltodict.unparse(rci_dict({
+        '@version': '1.1',
+        'do_command': {'@target': 'xbee', 'set_setting': settings},
+    }, cache=False))
+
+
+def set_settings_template():
+    settings = SETTINGS.copy()
+    settings['@addr'] = RADIO
+    return sci.rci_request(DEVICE_ID, sci.XBEE_COMMAND.render(
+        command=sci.element('set_setting', settings)), cache=False)
+
+
+def get_settings_unparse():
+    return xmltodict.unparse(rci_dict({
+        '@version': '1.1',
+        'do_command': {'@target': 'xbee', 'query_setting': {'@addr': RADIO}},
+    }, cache=False))
+
+
+def get_settings_template():
+    return sci.rci_request(
+        DEVICE_ID, sci.XBEE_QUERY_SETTING.render(addr=sci.attr(RADIO)),
+        cache=False)
+
+
+def main():
+    requests = (
+        ('set_output (IO toggle)', set_output_unparse, set_output_template),
+        ('set_device_settings', set_settings_unparse, set_settings_template),
+        ('get_device_settings', get_settings_unparse, get_settings_template),
+    )
+    for label, original, template in requests:
+        assert original() == template(), label
+        print '%s (%d bytes)' % (label, len(template()))
+        for name, func in (('unparse', original), ('template', template)):
+            best = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+            print '  %-10s %8.2f us' % (name, best / NUMBER * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Micro-benchmark of parsing Device Cloud XML replies.
+
+Parses replies shaped like those recorded from Device Cloud, as served in
+a Requests response, with the original xmltodict.parse(response.text) and
+with xmlparse on the response's byte stream:
+
+- an SCI query_setting reply for an XBee, with the full set of radio
+  settings
+- an SCI reply for a query sent to several gateways at once
+- an XML DataPoint page (as some XBee Gateway streams return) of 1000 points
+
+Run from the repository root:
+    python benchmarks/xml_parsing.py
+"""
+import os
+import sys
+import timeit
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xmltodict
+from requests import Response
+from requests.packages.urllib3.response import HTTPResponse
+from xbgw_dashboard.libs.digi import xmlparse
+from xbgw_dashboard.libs.digi.devicecloud import XBEE_SETTINGS_PATH
+
+REPEAT = 20
+
+GROUPS = {
+    'radio': ['ID', 'SC', 'SD', 'ZS', 'NJ', 'JV', 'NW', 'JN', 'CE', 'DO',
+              'NI', 'NH', 'BH', 'AR', 'DD', 'NT', 'NO', 'CR', 'PL', 'PM',
+              'EE', 'EO', 'KY', 'NK'],
+    'serial': ['BD', 'NB', 'SB', 'D7', 'D6', 'AP', 'AO', 'RO'],
+    'InputOutput': ['D0', 'D1', 'D2', 'D3', 'D4', 'D5', 'D8', 'P0', 'P1',
+                    'P2', 'PR', 'LT', 'RP', 'IR', 'IC', 'PP'],
+    'sleep': ['SM', 'SN', 'SP', 'ST', 'SO', 'WH', 'PO'],
+    'diagnostics': ['VR', 'HV', 'AI', 'DB', 'TP', 'CK', 'MY', 'MP', 'SH',
+                    'SL', 'OP', 'OI', 'CH'],
+}
+
+
+def query_setting(i):
+    groups = ''.join(
+        '<%s>%s</%s>' % (group, ''.join('<%s>0x%X</%s>' % (name, i + n, name)
+                                        for n, name in enumerate(names)),
+                         group)
+        for group, names in sorted(GROUPS.iteritems()))
+    return '<query_setting>%s</query_setting>' % groups
+
+
+def settings_reply(devices=1):
+    replies = ''.join(
+        '<device id="00000000-00000000-00409DFF-FF%06X"><rci_reply '
+        'version="1.1"><do_command target="xbee">%s</do_command>'
+        '</rci_reply></device>' % (i, query_setting(i))
+        for i in range(devices))
+    return ('<?xml version="1.0" encoding="UTF-8"?><sci_reply version="1.0">'
+            '<send_message>%s</send_message></sci_reply>' % replies)
+
+
+def datapoint_reply(points=1000):
+    items = ''.join(
+        '<DataPoint><id>%08x-0000-11e4-a111-0000000000%02x</id>'
+        '<cstId>2376</cstId><streamId>00000000-00000000-00409DFF-FF000001/'
+        'xbee.serialIn/[00:13:A2:00:40:A1:2B:%02X]!</streamId>'
+        '<timestamp>%d</timestamp><serverTimestamp>%d</serverTimestamp>'
+        '<data>%d</data><description></description><quality>0</quality>'
+        '</DataPoint>' % (i, i % 256, i % 256, 1420070400000 + i * 1000,
+                          1420070400500 + i * 1000, i)
+        for i in range(points))
+    return ('<?xml version="1.0" encoding="UTF-8"?><result>'
+            '<resultSize>%d</resultSize><requestedSize>1000</requestedSize>'
+            '<pageCursor>00000000-0000-11e4-a111-000000000000</pageCursor>'
+            '<requestedStartTime>-1</requestedStartTime>'
+            '<requestedEndTime>-1</requestedEndTime>%s</result>'
+            % (points, items))
+
+
+def make_response(body):
+    response = Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/xml;charset=UTF-8'
+    # As Requests sets it from the header
+    response.encoding = 'UTF-8'
+    response.raw = HTTPResponse(body=StringIO(body), preload_content=False)
+    return response
+
+
+def main():
+    replies = (
+        ('query_setting, 1 XBee', settings_reply(), XBEE_SETTINGS_PATH),
+        ('query_setting, 20 gateways', settings_reply(20), XBEE_SETTINGS_PATH),
+        ('DataPoint page', datapoint_reply(), None),
+    )
+    for label, body, select in replies:
+        def original():
+            xmltodict.parse(make_response(body).text)
+
+        def streamed():
+            xmlparse.parse(
+                make_response(body).iter_content(xmlparse.CHUNK_SIZE),
+                select=select)
+
+        print '%s (%d bytes)' % (label, len(body))
+        for name, func in (('xmltodict', original), ('xmlparse', streamed)):
+            best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+            print '  %-10s %8.2f ms' % (name, best * 1000)
+
+
+if __name__ == '__main__':
+    main()
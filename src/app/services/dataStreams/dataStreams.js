@@ -18,12 +18,18 @@ angular.module('XBeeGatewayApp')
             $log.debug("Got new data: ", event);
             new_data_handler(event);
         });
+        socket.addListener('device_data_batch', function (events) {
+            $log.debug("Got new data batch: ", events);
+            _.each(events, new_data_handler);
+        });
 
         var disconnected = false;
         var disconnectedToast;
         socket.on('connect', function () {
             notificationService.success("Data will appear within the app soon!",
                                         "WebSocket connected", {timeout: 7000});
+            // Receive DataPoint events in batches (device_data_batch)
+            socket.emit("enabledatabatching");
             // Init the DeviceCore monitor
             socket.emit("startmonitoringstatus");
 
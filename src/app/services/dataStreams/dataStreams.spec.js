@@ -63,6 +63,7 @@ describe("Service: dataStreams", function() {
 
     it("should call socket.addListener and socket.on appropriately, right away", function () {
         expect(socket.addListener).toHaveBeenCalledWith('device_data', jasmine.any(Function));
+        expect(socket.addListener).toHaveBeenCalledWith('device_data_batch', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('connect', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('disconnect', jasmine.any(Function));
         expect(socket.on).toHaveBeenCalledWith('started_monitoring', jasmine.any(Function));
@@ -74,6 +75,7 @@ describe("Service: dataStreams", function() {
         socket_listeners.connect();
 
         expect(notifications.success).toHaveBeenCalled();
+        expect(socket.emit).toHaveBeenCalledWith("enabledatabatching");
         expect(socket.emit).toHaveBeenCalledWith("startmonitoringstatus");
     });
 
@@ -273,6 +275,16 @@ describe("Service: dataStreams", function() {
         expect(spy2).toHaveBeenCalledWith({timestamp: 1, value: 10}, null, deviceId, "TEST2");
     });
 
+    it("should handle each point of a device_data_batch event", function () {
+        spyOn(tree, 'trigger');
+        socket_listeners.device_data_batch([
+            {DataPoint: {streamId: deviceId + "/DIO/0", data: 0, timestamp: 100}},
+            {DataPoint: {streamId: deviceId + "/DIO/1", data: 1, timestamp: 101}}
+        ]);
+        expect(tree.trigger).toHaveBeenCalledWith(deviceId, "DIO/0", {timestamp: 100, value: 0});
+        expect(tree.trigger).toHaveBeenCalledWith(deviceId, "DIO/1", {timestamp: 101, value: 1});
+    });
+
     it("should parse timestamp strings in .new_data", function () {
         spyOn(tree, 'trigger');
 
@@ -0,0 +1,365 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Brokers delivering Device Cloud pushes to the worker processes whose sockets
+are subscribed to them.
+
+Device Cloud pushes to whichever worker accepts the connection, while the
+sockets listening for a device may live in any worker. The monitor receiver
+publishes each push through the broker configured in
+settings.MONITOR_PUSH_BROKER:
+
+LocalBroker
+    Delivers to this process only. Suitable for a single worker.
+UnixSocketBroker
+    Each worker binds a Unix datagram socket in a shared directory next to a
+    file listing the devices it has subscribers for. Pushes are forwarded to
+    the workers subscribed to them, for workers on the same host.
+'''
+import _socket
+import atexit
+import errno
+import json
+import logging
+import os
+import stat
+import time
+import gevent
+from gevent import socket
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+import metrics
+from datapoints import datapoint_buffer, datapoint_store
+from push import push_queue
+from routing import push_router
+from signals import MONITOR_TOPIC_SIGNAL_MAP
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBroker(object):
+    """
+    Delivers pushes to subscribers in this process
+    """
+
+    def __init__(self, router=push_router, queue=push_queue,
+                 buffer=datapoint_buffer, store=datapoint_store):
+        self.router = router
+        self.queue = queue
+        self.buffer = buffer
+        self.store = store
+
+    def deliver(self, messages):
+        """
+        Queue messages for this process' subscribers, keeping copies of their
+        DataPoints
+
+        Returns the number of messages queued
+        """
+        batch = self.router.route(messages)
+        if not batch:
+            return 0
+        messages = [args['data'] for signal, args in batch]
+        self.buffer.add_messages(messages)
+        if settings.DATAPOINT_STORE['ENABLED']:
+            self.store.add_messages(messages)
+        if self.queue.put(batch):
+            return len(batch)
+        return 0
+
+    def publish(self, messages):
+        """
+        Deliver messages to all of their subscribers
+
+        Raises KeyError if a message has no topic.
+
+        Returns the number of messages accepted for delivery, 0 if nothing is
+        subscribed to them (or they can't be accepted right now)
+        """
+        return self.deliver(messages)
+
+    def subscriptions(self):
+        """
+        Returns the set of (topic, device_id) subscribed to in any process
+        """
+        return self.router.subscriptions()
+
+    def has_subscribers(self, customer_id):
+        """
+        Whether some process may have subscribers for a device of the account
+        with customer_id
+        """
+        return self.router.has_subscribers(customer_id, self.subscriptions())
+
+    def subscriptions_changed(self):
+        """
+        Called when this process starts or stops having subscribers for a
+        device
+        """
+        pass
+
+
+class UnixSocketBroker(LocalBroker):
+    """
+    Forwards pushes between the worker processes on this host over Unix
+    datagram sockets.
+
+    Each worker binds <path>/<name>.sock and publishes the (topic, device id)
+    pairs it has subscribers for in <path>/<name>.subs. A push received by
+    any worker is queued locally for its own subscribers, and forwarded to
+    each other worker subscribed to some of its messages.
+    """
+
+    # Largest datagram we'll send, pushes are split to fit
+    MAX_DATAGRAM = 65000
+    # Seconds between rescans of the directory for peers
+    PEER_REFRESH = 1.0
+
+    def __init__(self, path, name=None, **kwargs):
+        super(UnixSocketBroker, self).__init__(**kwargs)
+        self.path = path
+        self.name = name
+        self._pid = None
+        self._sock = None
+        self._listener = None
+        self._writer = None
+        # name -> (file version, set of subscriptions)
+        self._peer_subs = {}
+        self._peers = []
+        self._peers_scanned = 0
+
+    def _file(self, name, ext):
+        return os.path.join(self.path, '%s.%s' % (name, ext))
+
+    def _own_name(self):
+        return self.name or str(os.getpid())
+
+    def start(self):
+        """
+        Bind this worker's socket and start receiving pushes. Called lazily,
+        and again if we find ourselves in a forked child.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._check_path()
+
+        sock_path = self._file(self._own_name(), 'sock')
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(sock_path)
+        self._listener = gevent.spawn(self._receive)
+        atexit.register(self._remove_files)
+        self._write_subscriptions()
+        logger.info('Push broker listening on %s', sock_path)
+
+    def _check_path(self):
+        # Anyone able to write to the directory could read or inject pushes
+        try:
+            os.makedirs(self.path, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        info = os.lstat(self.path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            self._pid = None
+            raise ImproperlyConfigured(
+                'Push broker path %s is not a directory owned by this user'
+                % self.path)
+        if stat.S_IMODE(info.st_mode) != 0700:
+            os.chmod(self.path, 0700)
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.kill()
+        if self._sock is not None:
+            self._sock.close()
+        self._remove_files()
+        self._pid = None
+
+    def _remove_files(self):
+        if self._pid != os.getpid():
+            return
+        for ext in ('sock', 'subs'):
+            try:
+                os.unlink(self._file(self._own_name(), ext))
+            except OSError:
+                pass
+
+    def _receive(self):
+        while True:
+            data = self._sock.recv(self.MAX_DATAGRAM)
+            try:
+                messages = json.loads(data)
+                self.deliver(messages)
+            except Exception:
+                logger.exception('Error delivering forwarded push')
+
+    def subscriptions_changed(self):
+        # May be called from a weak reference callback, write from a greenlet
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write_subscriptions)
+
+    def _write_subscriptions(self):
+        self._writer = None
+        self.start()
+        subs = sorted(self.router.subscriptions())
+        subs_path = self._file(self._own_name(), 'subs')
+        tmp_path = subs_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(subs, f)
+        os.rename(tmp_path, subs_path)
+
+    def _scan_peers(self):
+        now = time.time()
+        if now - self._peers_scanned < self.PEER_REFRESH:
+            return self._peers
+        self._peers_scanned = now
+        own_name = self._own_name()
+        peers = []
+        for filename in os.listdir(self.path):
+            name, ext = os.path.splitext(filename)
+            if ext == '.subs' and name != own_name:
+                peers.append(name)
+        self._peers = peers
+        return peers
+
+    def _subscriptions_of(self, name):
+        subs_path = self._file(name, 'subs')
+        try:
+            stat = os.stat(subs_path)
+            # Files are replaced by rename, so the inode changes on each write
+            version = (stat.st_ino, stat.st_mtime)
+            cached = self._peer_subs.get(name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            with open(subs_path) as f:
+                subs = set(tuple(sub) for sub in json.load(f))
+        except (OSError, IOError, ValueError):
+            self._peer_subs.pop(name, None)
+            return set()
+        self._peer_subs[name] = (version, subs)
+        return subs
+
+    def _chunks(self, messages):
+        """
+        Encode messages into datagrams no larger than MAX_DATAGRAM
+        """
+        chunk = []
+        size = 2
+        for msg in messages:
+            encoded = json.dumps(msg)
+            if len(encoded) + 2 > self.MAX_DATAGRAM:
+                logger.warning('Push message too large to forward, dropped')
+                metrics.incr('broker.dropped')
+                continue
+            if chunk and size + len(encoded) + 1 > self.MAX_DATAGRAM:
+                yield '[%s]' % ','.join(chunk)
+                chunk = []
+                size = 2
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            yield '[%s]' % ','.join(chunk)
+
+    def _forget_peer(self, name):
+        """
+        Remove the files of a peer that went away without cleaning up
+        """
+        try:
+            os.kill(int(name), 0)
+            return
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                return
+        except ValueError:
+            # Not a pid, can't tell if it's alive
+            return
+        for ext in ('sock', 'subs'):
+            try:
+                os.unlink(self._file(name, ext))
+            except OSError:
+                pass
+        self._peer_subs.pop(name, None)
+
+    def _send(self, name, messages):
+        # Never wait on a peer, the push is being answered meanwhile. A plain
+        # socket, as gevent's waits for a full buffer even when non-blocking.
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        try:
+            for datagram in self._chunks(messages):
+                sock.sendto(datagram, self._file(name, 'sock'))
+                metrics.incr('broker.forwarded')
+            return True
+        except _socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logger.warning('Push broker peer %s is not keeping up, '
+                               'dropping push', name)
+            elif e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                self._forget_peer(name)
+            else:
+                logger.warning('Error forwarding push to %s: %s', name, e)
+        finally:
+            sock.close()
+        metrics.incr('broker.dropped')
+        return False
+
+    def subscriptions(self):
+        self.start()
+        subs = self.router.subscriptions()
+        for name in self._scan_peers():
+            subs |= self._subscriptions_of(name)
+        return subs
+
+    def publish(self, messages):
+        self.start()
+        accepted = self.deliver(messages)
+
+        keys = None
+        for name in self._scan_peers():
+            subs = self._subscriptions_of(name)
+            if not subs:
+                continue
+            if keys is None:
+                keys = [self.router.device_key(msg) for msg in messages]
+            selected = [msg for msg, key in zip(messages, keys)
+                        if key in subs]
+            if selected and self._send(name, selected):
+                accepted += len(selected)
+        return accepted
+
+
+def load_broker(conf):
+    """
+    Instantiate the broker described by conf, a dict with the dotted path
+    of the broker class as BACKEND and its keyword arguments as OPTIONS
+    """
+    module_name, _, class_name = conf['BACKEND'].rpartition('.')
+    try:
+        broker_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured(
+            'Unable to load push broker %s: %s' % (conf['BACKEND'], e))
+    options = dict((key.lower(), value)
+                   for key, value in conf.get('OPTIONS', {}).iteritems())
+    return broker_class(**options)
+
+
+push_broker = load_broker(settings.MONITOR_PUSH_BROKER)
+
+
+def _subscriptions_changed():
+    push_broker.subscriptions_changed()
+
+
+for _signals in MONITOR_TOPIC_SIGNAL_MAP.values():
+    _signals.on_change = _subscriptions_changed
@@ -0,0 +1,386 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Per-process caches of Device Cloud data, shared by the requests and sockets
+of an account.
+
+Entries are keyed by account, (username, cloud_fqdn), and handed out as
+copies, so views are free to modify what they get.
+'''
+import copy
+import logging
+import threading
+import time
+from collections import defaultdict
+import gevent
+from django.conf import settings
+from xbgw_dashboard.libs.digi.cache import TTLCache
+import metrics
+from xbgw_dashboard.libs.digi.devicecloud import reply_errors, \
+    XBEE_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceListCache(object):
+    """
+    DeviceCore device lists, as returned by
+    DeviceCloudConnector.get_device_list, kept for a short time to live.
+
+    DeviceCore pushes update the cached devices in place, so connection
+    status changes don't force a refetch.
+    """
+
+    def __init__(self, ttl=30, max_accounts=1000):
+        self._lists = TTLCache(ttl=ttl, max_size=max_accounts,
+                               on_evict=self._forget)
+        # Device id -> accounts with a cached list including it
+        self._accounts = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def _forget(self, key, devices):
+        with self._lock:
+            for item in devices.get('items', []):
+                accounts = self._accounts.get(item.get('devConnectwareId'))
+                if accounts is not None:
+                    accounts.discard(key)
+                    if not accounts:
+                        del self._accounts[item.get('devConnectwareId')]
+
+    def get(self, key):
+        """
+        Returns a copy of the cached device list of account key, or None
+        """
+        with self._lock:
+            devices = self._lists.get(key)
+            if devices is None:
+                metrics.incr('caches.device_list.miss')
+                return None
+            metrics.incr('caches.device_list.hit')
+            return copy.deepcopy(devices)
+
+    def set(self, key, devices):
+        devices = copy.deepcopy(devices)
+        with self._lock:
+            self.invalidate(key)
+            self._lists.set(key, devices)
+            for item in devices.get('items', []):
+                self._accounts[item.get('devConnectwareId')].add(key)
+
+    def invalidate(self, key):
+        """
+        Drop the cached device list of account key
+        """
+        with self._lock:
+            devices = self._lists.pop(key)
+            if devices is not None:
+                self._forget(key, devices)
+
+    def update_device(self, device):
+        """
+        Patch the cached copies of a device with the fields of a pushed
+        DeviceCore record
+
+        Returns the number of cached lists updated
+        """
+        device_id = device.get('devConnectwareId')
+        updated = 0
+        with self._lock:
+            for key in list(self._accounts.get(device_id, ())):
+                devices = self._lists.get(key)
+                if devices is None:
+                    continue
+                for item in devices.get('items', []):
+                    if item.get('devConnectwareId') == device_id:
+                        # Only fields the query returned, pushes carry more
+                        item.update((field, value)
+                                    for field, value in device.iteritems()
+                                    if field in item)
+                        updated += 1
+        return updated
+
+    def update_messages(self, messages):
+        """
+        Apply the DeviceCore records of push monitor messages
+        """
+        for msg in messages:
+            device = msg.get('DeviceCore') if isinstance(msg, dict) else None
+            if isinstance(device, dict):
+                self.update_device(device)
+
+    def clear(self):
+        with self._lock:
+            self._lists.clear()
+            self._accounts.clear()
+
+
+class XBeeQueryError(Exception):
+    """
+    Device Cloud reported an error in the body of an XbeeCore response
+    """
+
+    def __init__(self, response):
+        super(XBeeQueryError, self).__init__('Error in XbeeCore response')
+        self.response = response
+
+
+def _xbee_items(xbees):
+    if reply_errors(xbees):
+        raise XBeeQueryError(xbees)
+    items = xbees.get('items', [])
+    if type(items) is not list:
+        items = [items]
+    return items
+
+
+def _ext_addr(addr):
+    return addr.upper()
+
+
+class _AccountXBees(object):
+    """
+    The XbeeCore records of an account, by extended address and by gateway
+    """
+
+    def __init__(self, items):
+        self.loaded = time.time()
+        self.by_addr = {}
+        self.by_gateway = defaultdict(set)
+        self.merge(items)
+
+    def merge(self, items, gateway=None):
+        """
+        Add or replace records. If gateway is given, items are its complete
+        node list and its other nodes are dropped.
+        """
+        if gateway is not None:
+            for addr in self.by_gateway.pop(gateway, ()):
+                self.by_addr.pop(addr, None)
+        for item in items:
+            try:
+                addr = _ext_addr(item['xpExtAddr'])
+            except (KeyError, TypeError, AttributeError):
+                continue
+            old = self.by_addr.get(addr)
+            if old is not None:
+                self.by_gateway[old.get('devConnectwareId')].discard(addr)
+            self.by_addr[addr] = item
+            self.by_gateway[item.get('devConnectwareId')].add(addr)
+
+
+class XBeeIndex(object):
+    """
+    Per-account index of the XBees in Device Cloud's XbeeCore, by extended
+    address and by gateway, so node lookups are answered locally.
+
+    An account's index is loaded with an XbeeCore query for all of its
+    XBees, a page at a time. After refresh seconds it is reloaded in the
+    background while still answering lookups, after max_age seconds it is
+    dropped. Addresses looked up that aren't in the index are queried for
+    and added to it.
+    """
+
+    def __init__(self, refresh=60, max_age=600, max_accounts=1000):
+        self.refresh = refresh
+        self._accounts = TTLCache(ttl=max_age, max_size=max_accounts)
+        self._refreshing = set()
+        self._lock = threading.RLock()
+
+    def _load(self, key, conn):
+        items = []
+        while True:
+            page = conn.get_xbees(start=len(items), size=XBEE_PAGE_SIZE)
+            page_items = _xbee_items(page)
+            items.extend(page_items)
+            try:
+                total = int(page['resultTotalRows'])
+            except (KeyError, TypeError, ValueError):
+                break
+            if not page_items or len(items) >= total:
+                break
+        entry = _AccountXBees(items)
+        self._accounts.set(key, entry)
+        return entry
+
+    def _refresh(self, key, conn):
+        try:
+            self._load(key, conn)
+        except Exception:
+            logger.warning('Unable to refresh XBees of %s@%s', *key,
+                           exc_info=True)
+        finally:
+            self._refreshing.discard(key)
+
+    def _entry(self, key, conn):
+        entry = self._accounts.get(key)
+        if entry is None:
+            metrics.incr('caches.xbees.miss')
+            return self._load(key, conn)
+        metrics.incr('caches.xbees.hit')
+        if time.time() - entry.loaded > self.refresh and \
+                key not in self._refreshing:
+            self._refreshing.add(key)
+            gevent.spawn(self._refresh, key, conn)
+        return entry
+
+    def lookup(self, key, conn, addrs=None, gateway=None):
+        """
+        XbeeCore records of account key with the extended addresses addrs,
+        or on gateway, or all of them. Addresses that aren't in the index are
+        queried for, and left out if Device Cloud doesn't know them either.
+        conn is used to load the index if needed.
+
+        Raises HTTPError/ConnectionError from Device Cloud, or
+        XBeeQueryError.
+
+        Returns a list of copies of the records, sorted by address
+        """
+        entry = self._entry(key, conn)
+        if addrs is not None:
+            with self._lock:
+                missing = [addr for addr in addrs
+                           if _ext_addr(addr) not in entry.by_addr]
+            if missing:
+                # Nodes that joined since the index was loaded
+                metrics.incr('caches.xbees.addr_miss')
+                items = _xbee_items(conn.get_xbees(addrs=missing))
+                with self._lock:
+                    entry.merge(items)
+        with self._lock:
+            if addrs is not None:
+                selected = set(_ext_addr(addr) for addr in addrs)
+            elif gateway is not None:
+                selected = entry.by_gateway.get(gateway, ())
+            else:
+                selected = entry.by_addr
+            items = [entry.by_addr[addr] for addr in sorted(selected)
+                     if addr in entry.by_addr]
+            return copy.deepcopy(items)
+
+    def merge(self, key, xbees, gateway=None):
+        """
+        Merge an XbeeCore query result into the index of account key. With
+        gateway, the result is that gateway's complete node list, as after a
+        discovery that cleared its cache.
+
+        Raises XBeeQueryError if the response reports an error
+        """
+        items = copy.deepcopy(_xbee_items(xbees))
+        with self._lock:
+            entry = self._accounts.get(key)
+            if entry is not None:
+                entry.merge(items, gateway)
+
+    def clear(self):
+        self._accounts.clear()
+
+
+def _query_setting(response, radio):
+    """
+    The query_setting element of an RCI settings response, or None
+    """
+    try:
+        reply = response['sci_reply']['send_message']['device']['rci_reply']
+        if radio is not None:
+            reply = reply['do_command']
+        return reply['query_setting']
+    except (KeyError, TypeError):
+        return None
+
+
+class SettingsCache(object):
+    """
+    RCI query_setting responses of gateways and XBee radios, as returned by
+    DeviceCloudConnector.get_device_settings, kept for ttl seconds.
+
+    Settings written with set_setting are written through to the cached
+    response, so a configuration change doesn't force a slow query over the
+    mesh.
+    """
+
+    def __init__(self, ttl=30, max_entries=1000):
+        self._responses = TTLCache(ttl=ttl, max_size=max_entries)
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(conn, device_id, radio=None):
+        """
+        Cache key of the settings of radio (or the gateway itself, if None)
+        on device_id, for the account of conn
+        """
+        if radio is not None:
+            radio = _ext_addr(radio).rstrip('!')
+        return (conn.auth[0], conn.cloud_fqdn, device_id, radio)
+
+    def get(self, key):
+        """
+        Returns (copy of the cached response, its age in seconds), or None
+        """
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                metrics.incr('caches.settings.miss')
+                return None
+            metrics.incr('caches.settings.hit')
+            response, stored = entry
+            return copy.deepcopy(response), time.time() - stored
+
+    def set(self, key, response):
+        """
+        Store a settings response. Responses reporting an error are not
+        cached.
+        """
+        if reply_errors(response) or \
+                not isinstance(_query_setting(response, key[3]), dict):
+            self.invalidate(key)
+            return
+        self._responses.set(key, (copy.deepcopy(response), time.time()))
+
+    def update(self, key, settings):
+        """
+        Write settings, of the form {group: {name: value}}, through to the
+        cached response of key. The cached response keeps its age.
+        """
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is None:
+                return
+            groups = _query_setting(entry[0], key[3])
+            if not isinstance(groups, dict):
+                self.invalidate(key)
+                return
+            for group, values in settings.iteritems():
+                if group.startswith('@'):
+                    continue
+                cached = groups.get(group)
+                if not isinstance(cached, dict):
+                    cached = groups[group] = {}
+                for name, value in values.iteritems():
+                    # As sent to the device by set_device_settings
+                    cached[name] = unicode(value)
+
+    def invalidate(self, key):
+        self._responses.pop(key)
+
+    def clear(self):
+        self._responses.clear()
+
+
+device_list_cache = DeviceListCache(
+    ttl=settings.DEVICE_LIST_CACHE['TTL'],
+    max_accounts=settings.DEVICE_LIST_CACHE['MAX_ACCOUNTS'])
+
+xbee_index = XBeeIndex(
+    refresh=settings.XBEE_INDEX['REFRESH'],
+    max_age=settings.XBEE_INDEX['MAX_AGE'],
+    max_accounts=settings.XBEE_INDEX['MAX_ACCOUNTS'])
+
+settings_cache = SettingsCache(
+    ttl=settings.SETTINGS_CACHE['TTL'],
+    max_entries=settings.SETTINGS_CACHE['MAX_ENTRIES'])
@@ -0,0 +1,365 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Local copies of DataPoints, so the DataPoint view can answer history queries
+without a Device Cloud round-trip.
+
+DataPointBuffer keeps recent points pushed for monitored devices in memory.
+DataPointStore keeps points in the database, with the time ranges known to
+be complete, when settings.DATAPOINT_STORE['ENABLED'] is set.
+'''
+import logging
+import threading
+from collections import deque
+import gevent
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from xbgw_dashboard.libs.digi.cache import TTLCache
+from models import StoredDataPoint, StoredRange
+from routing import DATAPOINT_DEVICE_ID_RE
+from signals import MONITOR_TOPIC_SIGNAL_MAP
+
+logger = logging.getLogger(__name__)
+
+
+def point_timestamp(point):
+    """
+    Timestamp of a DataPoint in milliseconds since the epoch. Device Cloud
+    sends it as a number in pushes, as a string in queries.
+    """
+    return int(point['timestamp'])
+
+
+def stream_device_id(stream_id):
+    """
+    Device id embedded in a stream id, or None
+    """
+    match = DATAPOINT_DEVICE_ID_RE.match(stream_id)
+    if match:
+        return match.group('dev_id')
+    return None
+
+
+class StreamBuffer(object):
+    """
+    The most recent DataPoints received for a stream, oldest first
+    """
+
+    def __init__(self, max_points):
+        self.points = deque(maxlen=max_points)
+        self.ids = set()
+        # Timestamp (ms) of the newest point evicted to make room, older
+        # points may be missing
+        self.evicted_until = None
+
+    def add(self, point):
+        point_id = point.get('id')
+        if point_id is not None and point_id in self.ids:
+            # Device Cloud retries pushes we couldn't accept
+            return
+        if len(self.points) == self.points.maxlen:
+            oldest = self.points[0]
+            self.ids.discard(oldest.get('id'))
+            self.evicted_until = max(self.evicted_until,
+                                     point_timestamp(oldest))
+        self.points.append(point)
+        if point_id is not None:
+            self.ids.add(point_id)
+
+    def since(self, start):
+        """
+        Points with a timestamp of start (ms) or later, in timestamp order
+        """
+        points = [p for p in self.points if point_timestamp(p) >= start]
+        points.sort(key=point_timestamp)
+        return points
+
+
+class DataPointBuffer(object):
+    """
+    Bounded per-stream buffers of pushed DataPoints.
+
+    Pushes only reach this process while one of its sockets is monitoring the
+    device, so a stream's buffer is only known to be complete from shortly
+    after the device's current subscription started (plus a grace period for
+    points still in flight), or from its oldest retained point if newer
+    points pushed older ones out.
+    """
+
+    def __init__(self, signal_map=None, max_points=1000, max_streams=10000,
+                 grace=5):
+        """
+        Kwargs:
+            signal_map (SignalDict): DataPoint signals, telling which devices
+                                     are being monitored and since when
+            max_points (int): Points kept per stream
+            max_streams (int): Streams kept, least recently updated are
+                               dropped first
+            grace (float): Seconds after a subscription starts before its
+                           pushes are trusted to be complete
+        """
+        if signal_map is None:
+            signal_map = MONITOR_TOPIC_SIGNAL_MAP['DataPoint']
+        self.signal_map = signal_map
+        self.max_points = max_points
+        self.grace = grace
+        self._streams = TTLCache(max_size=max_streams)
+        self._lock = threading.RLock()
+
+    def add(self, point):
+        """
+        Store a pushed DataPoint
+        """
+        try:
+            stream_id = point['streamId']
+            point_timestamp(point)
+        except (KeyError, TypeError, ValueError):
+            logger.debug('Not buffering malformed DataPoint %r', point)
+            return
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                stream = StreamBuffer(self.max_points)
+                self._streams.set(stream_id, stream)
+            stream.add(point)
+
+    def add_messages(self, messages):
+        """
+        Store the DataPoints of push monitor messages
+        """
+        for msg in messages:
+            point = msg.get('DataPoint')
+            if point is not None:
+                self.add(point)
+
+    def covered_from(self, stream_id):
+        """
+        Returns the timestamp (ms) from which the buffer holds every point of
+        stream_id up to now, or None if it isn't being filled
+        """
+        device_id = stream_device_id(stream_id)
+        if device_id is None:
+            return None
+        signal = self.signal_map.get(device_id)
+        if signal is None or not signal.receivers:
+            return None
+        start = int((signal.created + self.grace) * 1000)
+        stream = self._streams.get(stream_id)
+        if stream is not None and stream.evicted_until is not None:
+            start = max(start, stream.evicted_until + 1)
+        return start
+
+    def points(self, stream_id, start):
+        """
+        Buffered points of stream_id from timestamp start (ms), oldest first
+        """
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                return []
+            return stream.since(start)
+
+    def clear(self):
+        self._streams.clear()
+
+
+def point_id(point):
+    """
+    Identifier of a DataPoint. Falls back to its timestamp for points
+    without an id.
+    """
+    return point.get('id') or str(point_timestamp(point))
+
+
+def missing_ranges(start, end, ranges):
+    """
+    Parts of [start, end) not covered by ranges, a list of (start, end)
+    sorted by start
+    """
+    gaps = []
+    for range_start, range_end in ranges:
+        if range_end <= start:
+            continue
+        if range_start >= end:
+            break
+        if range_start > start:
+            gaps.append((start, range_start))
+        start = max(start, range_end)
+    if start < end:
+        gaps.append((start, end))
+    return gaps
+
+
+class DataPointStore(object):
+    """
+    Local database store of DataPoints, with the time ranges known to be
+    complete for each stream.
+
+    Pushed points are written in batches by a background greenlet, points
+    fetched from Device Cloud to fill gaps are written directly.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_size=500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = []
+        self._flush_timer = None
+        # Earliest timestamp of pushed points that failed to be written, by
+        # stream. Ranges from there on can't be taken from pushes.
+        self._unstored = {}
+
+    def add_messages(self, messages):
+        """
+        Queue the DataPoints of push monitor messages for writing
+        """
+        for msg in messages:
+            point = msg.get('DataPoint')
+            if point is not None:
+                self._pending.append(point)
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        elif self._pending and self._flush_timer is None:
+            self._flush_timer = gevent.spawn_later(self.flush_interval,
+                                                   self.flush)
+
+    def flush(self):
+        """
+        Write queued pushed points. Returns False if they couldn't be
+        written, see unstored_from.
+        """
+        timer, self._flush_timer = self._flush_timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        points, self._pending = self._pending, []
+        if points:
+            try:
+                self.save_points(points)
+            except Exception:
+                logger.exception('Error storing %d pushed DataPoints',
+                                 len(points))
+                self._lost(points)
+                return False
+        return True
+
+    def _lost(self, points):
+        for point in points:
+            try:
+                stream_id = point['streamId']
+                timestamp = point_timestamp(point)
+            except (KeyError, TypeError, ValueError):
+                continue
+            unstored = self._unstored.get(stream_id)
+            if unstored is None or timestamp < unstored:
+                self._unstored[stream_id] = timestamp
+
+    def unstored_from(self, stream_id, start):
+        """
+        Earliest timestamp (ms) of pushed points of stream_id that failed to
+        be written, or None. Points before start are no longer expected from
+        pushes, and are forgotten: their range is left to be backfilled.
+        """
+        unstored = self._unstored.get(stream_id)
+        if unstored is not None and unstored < start:
+            del self._unstored[stream_id]
+            return None
+        return unstored
+
+    def save_points(self, points):
+        """
+        Store points, skipping malformed ones and ones already stored
+        """
+        rows = {}
+        for point in points:
+            try:
+                key = (point['streamId'], point_id(point))
+                rows[key] = StoredDataPoint(
+                    stream_id=key[0], point_id=key[1],
+                    timestamp=point_timestamp(point), point=point)
+            except (KeyError, TypeError, ValueError):
+                logger.debug('Not storing malformed DataPoint %r', point)
+        if not rows:
+            return
+
+        for stream_id in set(stream_id for stream_id, _ in rows):
+            existing = StoredDataPoint.objects.filter(
+                stream_id=stream_id,
+                point_id__in=[pid for sid, pid in rows if sid == stream_id])
+            for pid in existing.values_list('point_id', flat=True):
+                rows.pop((stream_id, pid), None)
+        try:
+            with transaction.commit_on_success():
+                StoredDataPoint.objects.bulk_create(rows.values())
+        except IntegrityError:
+            # Raced with another writer, fall back to one at a time
+            for row in rows.values():
+                try:
+                    with transaction.commit_on_success():
+                        row.save()
+                except IntegrityError:
+                    pass
+
+    def ranges(self, stream_id, start, end):
+        """
+        Stored ranges of stream_id overlapping [start, end), as a list of
+        (start, end) sorted by start
+        """
+        return list(StoredRange.objects.filter(
+            stream_id=stream_id, end__gt=start, start__lt=end)
+            .order_by('start').values_list('start', 'end'))
+
+    def add_range(self, stream_id, start, end):
+        """
+        Record that every point of stream_id in [start, end) is stored,
+        merging with overlapping or adjacent ranges
+        """
+        if start >= end:
+            return
+        with transaction.commit_on_success():
+            overlapping = StoredRange.objects.filter(
+                stream_id=stream_id, end__gte=start, start__lte=end)
+            for stored in overlapping:
+                start = min(start, stored.start)
+                end = max(end, stored.end)
+            overlapping.delete()
+            StoredRange.objects.create(stream_id=stream_id, start=start,
+                                       end=end)
+
+    def points(self, stream_id, start, end):
+        """
+        Generator over the stored points of stream_id in [start, end), oldest
+        first. Rows are read as they are consumed.
+        """
+        rows = StoredDataPoint.objects.filter(
+            stream_id=stream_id, timestamp__gte=start, timestamp__lt=end)
+        for row in rows.order_by('timestamp').only('point').iterator():
+            yield row.point
+
+    def prune(self, before):
+        """
+        Delete points and ranges older than before (ms). Returns the number
+        of points deleted.
+        """
+        with transaction.commit_on_success():
+            old_points = StoredDataPoint.objects.filter(timestamp__lt=before)
+            count = old_points.count()
+            old_points.delete()
+            StoredRange.objects.filter(end__lte=before).delete()
+            StoredRange.objects.filter(start__lt=before).update(start=before)
+        return count
+
+
+def _buffer_from_settings():
+    conf = settings.DATAPOINT_BUFFER
+    return DataPointBuffer(max_points=conf['MAX_POINTS'],
+                           max_streams=conf['MAX_STREAMS'],
+                           grace=conf['GRACE'])
+
+
+datapoint_buffer = _buffer_from_settings()
+datapoint_store = DataPointStore()
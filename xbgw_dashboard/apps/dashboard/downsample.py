@@ -0,0 +1,225 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Downsampling of DataPoint series, so long histories can be sent to widgets
+as a few hundred points.
+
+Points are DataPoint dicts as returned by Device Cloud, in timestamp order.
+'''
+import itertools
+import re
+from datapoints import point_timestamp
+
+# Units accepted in rollup intervals, in milliseconds
+ROLLUP_UNITS = {
+    's': 1000,
+    'm': 60 * 1000,
+    'h': 60 * 60 * 1000,
+    'd': 24 * 60 * 60 * 1000,
+}
+ROLLUP_RE = re.compile(r'^(?P<count>[0-9]+)(?P<unit>[smhd])$')
+
+AGGREGATES = ('avg', 'min', 'max', 'last')
+# Not an aggregate: picks the points that best preserve the series' shape
+LTTB = 'lttb'
+
+
+def parse_rollup(value):
+    """
+    Parse a rollup interval such as '30s', '1m', '6h' or '1d'
+
+    Raises ValueError if the interval is invalid
+
+    Returns the interval in milliseconds
+    """
+    match = ROLLUP_RE.match(value)
+    if not match or int(match.group('count')) == 0:
+        raise ValueError('Invalid rollup interval %s' % value)
+    return int(match.group('count')) * ROLLUP_UNITS[match.group('unit')]
+
+
+def parse_params(query):
+    """
+    Read downsampling options from query parameters:
+
+    rollup - interval of the buckets points are aggregated in, e.g. 1m
+    agg - how a bucket is aggregated, one of avg (the default), min, max or
+          last. With maxPoints, can also be lttb.
+    maxPoints - maximum number of points to return
+
+    Raises ValueError on invalid parameters
+
+    Returns a dict of keyword arguments for downsample()
+    """
+    options = {}
+    if 'rollup' in query:
+        options['rollup'] = parse_rollup(query['rollup'])
+    if 'maxPoints' in query:
+        options['max_points'] = int(query['maxPoints'])
+        if options['max_points'] < 3:
+            raise ValueError('maxPoints must be at least 3')
+    if 'agg' in query:
+        agg = query['agg']
+        if agg == LTTB:
+            if 'max_points' not in options or 'rollup' in options:
+                raise ValueError('lttb requires maxPoints, without rollup')
+        elif agg not in AGGREGATES:
+            raise ValueError('Unknown aggregate %s' % agg)
+        options['agg'] = agg
+    return options
+
+
+def _number(point):
+    try:
+        return float(point['data'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _aggregate(bucket, start, agg):
+    """
+    A point standing for the (point, count) pairs in bucket, where count is
+    the number of samples each point stands for, timestamped with the
+    bucket's start. Averages are weighted by count. Non-numeric values are
+    ignored, unless there are no others.
+
+    Returns (point, count)
+    """
+    last = bucket[-1][0]
+    value = last.get('data')
+    if agg != 'last':
+        values = [(v, count) for v, count in
+                  ((_number(p), count) for p, count in bucket)
+                  if v is not None]
+        if values:
+            if agg == 'avg':
+                value = sum(v * count for v, count in values) / \
+                    sum(count for v, count in values)
+            elif agg == 'min':
+                value = min(v for v, count in values)
+            else:
+                value = max(v for v, count in values)
+    point = dict(last)
+    point['timestamp'] = start
+    point['data'] = value
+    return point, sum(count for p, count in bucket)
+
+
+def _rollup(counted, interval, agg, origin):
+    """
+    rollup_points() over (point, count) pairs, yielding (point, count) pairs
+    so the result can be rolled up again
+    """
+    bucket = []
+    bucket_start = None
+    for point, count in counted:
+        try:
+            timestamp = point_timestamp(point)
+        except (KeyError, TypeError, ValueError):
+            continue
+        start = origin + (timestamp - origin) // interval * interval
+        if bucket and start != bucket_start:
+            yield _aggregate(bucket, bucket_start, agg)
+            bucket = []
+        bucket_start = start
+        bucket.append((point, count))
+    if bucket:
+        yield _aggregate(bucket, bucket_start, agg)
+
+
+def rollup_points(points, interval, agg='avg', origin=0):
+    """
+    Aggregate points into buckets of interval milliseconds, aligned on
+    origin. Yields one point per non-empty bucket.
+    """
+    for point, count in _rollup(((point, 1) for point in points),
+                                interval, agg, origin):
+        yield point
+
+
+def lttb(points, threshold):
+    """
+    Select threshold points with the Largest-Triangle-Three-Buckets
+    algorithm, which keeps the visual shape of the series. Points without a
+    numeric value are dropped.
+
+    Returns a list of the selected points, unchanged
+    """
+    series = []
+    for point in points:
+        value = _number(point)
+        if value is None:
+            continue
+        try:
+            series.append((point_timestamp(point), value, point))
+        except (KeyError, TypeError, ValueError):
+            continue
+
+    if threshold >= len(series) or threshold < 3:
+        return [point for _, _, point in series]
+
+    selected = [series[0][2]]
+    # Buckets for all but the first and last points
+    every = float(len(series) - 2) / (threshold - 2)
+    a = 0
+    for i in xrange(threshold - 2):
+        # Average of the next bucket, the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(series))
+        next_bucket = series[next_start:next_end]
+        avg_x = sum(x for x, _, _ in next_bucket) / float(len(next_bucket))
+        avg_y = sum(y for _, y, _ in next_bucket) / len(next_bucket)
+
+        # Point of this bucket making the largest triangle with the
+        # previously selected point and the next bucket's average
+        ax, ay, _ = series[a]
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        max_area = -1
+        for j in xrange(start, end):
+            x, y, _ = series[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                a_next = j
+        selected.append(series[a_next][2])
+        a = a_next
+
+    selected.append(series[-1][2])
+    return selected
+
+
+def downsample(points, start, end, rollup=None, agg='avg', max_points=None):
+    """
+    Apply the options from parse_params() to points covering [start, end)
+
+    Returns an iterable of points. Points are consumed lazily, holding at
+    most max_points + 1 of them, except for lttb which needs the whole
+    series.
+    """
+    if agg == LTTB:
+        return lttb(points, max_points)
+
+    counted = ((point, 1) for point in points)
+    if rollup is not None:
+        counted = _rollup(counted, rollup, agg, 0)
+    if max_points is not None:
+        counted = iter(counted)
+        head = list(itertools.islice(counted, max_points + 1))
+        if len(head) > max_points:
+            # Equal time buckets over the queried window, whole rollup
+            # buckets so the samples in each are all counted
+            interval = max(1, -(-(end - start) // max_points))
+            if rollup is not None:
+                interval = -(-interval // rollup) * rollup
+            counted = _rollup(itertools.chain(head, counted), interval, agg,
+                              start)
+        else:
+            counted = head
+    return (point for point, count in counted)
@@ -0,0 +1,303 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Server-side batch jobs over many XBee radios.
+
+A job runs on a pool of greenlets in the worker that started it, and keeps
+every progress event it sends, so a socket reconnecting to the same worker
+can resume following it.
+'''
+import logging
+import time
+import uuid
+import gevent
+from gevent.pool import Pool
+from django.conf import settings
+from requests.exceptions import HTTPError, ConnectionError
+from rest_framework import status
+from xbgw_dashboard.libs.digi.cache import TTLCache
+import metrics
+from caches import settings_cache
+from util import with_errors
+from xbgw_dashboard.libs.digi.devicecloud import reply_errors
+from xbee import compare_config_with_stock
+
+logger = logging.getLogger(__name__)
+
+
+def apply_stock_config(conn, device_id, radio, throttle=None):
+    """
+    Query the configuration of a radio, and set whatever differs from the
+    Cloud Kit stock configuration
+
+    Kwargs:
+        throttle (callable): Called before each Device Cloud request
+
+    Returns (status code, response data). Data is None if nothing needed to
+    be applied.
+    """
+    key = settings_cache.key(conn, device_id, radio)
+    if throttle is not None:
+        throttle()
+    # Query present configuration, calculate diff.
+    try:
+        settings = conn.get_device_settings(
+            device_id=device_id, radio=radio)
+    except HTTPError, e:
+        return e.response.status_code, e.response.text
+    except ConnectionError, e:
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, None
+    settings_cache.set(key, settings)
+
+    # Check for any errors in query
+    errors = reply_errors(settings)
+    if errors:
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, with_errors(settings,
+                                                                  errors)
+
+    # Extract the settings from the response.
+    try:
+        device = settings['sci_reply']['send_message']['device']
+        settings_resp = device['rci_reply']['do_command']['query_setting']
+    except KeyError:
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, {
+            "error": "Could not parse settings",
+            "settings": settings}
+
+    # Compare the config with Cloud Kit stock settings, return diff
+    diff = compare_config_with_stock(settings_resp)
+    if not diff:
+        # No configuration needs to be applied.
+        return status.HTTP_200_OK, None
+
+    # If there is a difference, send the new config to the device
+    if throttle is not None:
+        throttle()
+    try:
+        response = conn.set_device_settings(
+            device_id=device_id, radio=radio, settings=diff)
+    except HTTPError, e:
+        settings_cache.invalidate(key)
+        return e.response.status_code, e.response.text
+    except ConnectionError, e:
+        settings_cache.invalidate(key)
+        return status.HTTP_503_SERVICE_UNAVAILABLE, None
+
+    # Make return value give both the SCI reply and the diff that was
+    # applied.
+    response = {
+        "diff_applied": diff,
+        "response": response
+    }
+
+    errors = reply_errors(response['response'])
+    if errors:
+        settings_cache.invalidate(key)
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, with_errors(response,
+                                                                  errors)
+    settings_cache.update(key, diff)
+    return status.HTTP_200_OK, response
+
+
+class RateLimiter(object):
+    """
+    Spaces out callers to at most rate calls per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+
+    def __call__(self):
+        now = time.time()
+        delay = self._next - now
+        # Reserve the next slot before sleeping
+        self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            gevent.sleep(delay)
+
+
+class StockConfigJob(object):
+    """
+    Applies the Cloud Kit stock configuration to a list of radios on a
+    gateway.
+
+    Sends these events to its listeners, each with the job id and a sequence
+    number (seq):
+
+    job_started - {'radios': [...]}
+    job_progress - {'radio', 'status', 'data', 'completed', 'total'}
+    job_done - {'results': {radio: status}, 'cancelled'}
+    """
+
+    def __init__(self, owner, conn, device_id, radios, concurrency=4,
+                 rate=5, throttle=None):
+        """
+        Args:
+            owner: Key of the account the job belongs to
+            conn (DeviceCloudConnector): Connection to run the job with
+            device_id (str): Gateway of the radios
+            radios (list): Extended addresses of the radios
+        Kwargs:
+            concurrency (int): Radios processed at the same time
+            rate (float): Maximum Device Cloud requests per second
+            throttle (RateLimiter): Shared limiter to use instead of one of
+                                    rate
+        """
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.conn = conn
+        self.device_id = device_id
+        self.radios = radios
+        self.results = {}
+        self.events = []
+        self.listeners = set()
+        self.done = False
+        self.cancelled = False
+        self._pool = Pool(concurrency)
+        self._throttle = throttle if throttle is not None \
+            else RateLimiter(rate)
+        self._runner = None
+
+    def _send(self, name, event):
+        event['id'] = self.id
+        event['seq'] = len(self.events) + 1
+        self.events.append((name, event))
+        for listener in list(self.listeners):
+            try:
+                listener(name, event)
+            except Exception:
+                logger.exception('Error sending %s of job %s', name, self.id)
+
+    def start(self):
+        self._send('job_started', {'device_id': self.device_id,
+                                   'radios': self.radios})
+        self._runner = gevent.spawn(self._run)
+
+    def _run(self):
+        try:
+            for radio in self.radios:
+                if self.cancelled:
+                    break
+                self._pool.spawn(self._apply, radio)
+            self._pool.join()
+        finally:
+            self.done = True
+            metrics.incr('jobs.stock_config.done')
+            self._send('job_done', {
+                'results': dict((radio, result['status']) for radio, result
+                                in self.results.iteritems()),
+                'cancelled': self.cancelled})
+            # Nothing more will be sent
+            self.listeners.clear()
+
+    def _apply(self, radio):
+        if self.cancelled:
+            return
+        try:
+            code, data = apply_stock_config(self.conn, self.device_id, radio,
+                                            throttle=self._throttle)
+        except Exception:
+            logger.exception('Error applying stock config to %s', radio)
+            code, data = status.HTTP_500_INTERNAL_SERVER_ERROR, None
+        self.results[radio] = {'status': code, 'data': data}
+        self._send('job_progress', {
+            'radio': radio, 'status': code, 'data': data,
+            'completed': len(self.results), 'total': len(self.radios)})
+
+    def cancel(self):
+        """
+        Stop starting radios. Radios already started are completed.
+        """
+        self.cancelled = True
+
+    def follow(self, listener, after=0):
+        """
+        Send listener the events after sequence number after, then the
+        job's new events
+        """
+        for name, event in self.events[after:]:
+            listener(name, event)
+        if not self.done:
+            self.listeners.add(listener)
+
+    def unfollow(self, listener):
+        self.listeners.discard(listener)
+
+    def join(self, timeout=None):
+        if self._runner is not None:
+            self._runner.join(timeout)
+
+
+class JobRegistry(object):
+    """
+    Jobs of this process by id, kept for a while after they finish so
+    clients can collect their results.
+
+    An owner can have max_running jobs running at once, and they share one
+    limit of rate Device Cloud requests per second.
+    """
+
+    def __init__(self, retention=3600, max_running=2, rate=5):
+        self._jobs = TTLCache(ttl=retention)
+        self.max_running = max_running
+        self.rate = rate
+        # Running jobs and their shared RateLimiter, by owner
+        self._running = {}
+        self._throttles = {}
+
+    def running(self, owner):
+        """
+        The jobs of owner still running
+        """
+        jobs = set(job for job in self._running.get(owner, ())
+                   if not job.done)
+        if jobs:
+            self._running[owner] = jobs
+        else:
+            self._running.pop(owner, None)
+            self._throttles.pop(owner, None)
+        return jobs
+
+    def can_start(self, owner):
+        return len(self.running(owner)) < self.max_running
+
+    def throttle(self, owner):
+        """
+        The RateLimiter shared by the jobs of owner
+        """
+        throttle = self._throttles.get(owner)
+        if throttle is None:
+            throttle = self._throttles[owner] = RateLimiter(self.rate)
+        return throttle
+
+    def add(self, job):
+        self._jobs.set(job.id, job)
+        self._running.setdefault(job.owner, set()).add(job)
+        # Expired jobs are swept out as new ones come in
+        self._jobs.purge()
+
+    def get(self, job_id, owner):
+        """
+        Returns the job with job_id belonging to owner, or None
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def clear(self):
+        self._jobs.clear()
+        self._running.clear()
+        self._throttles.clear()
+
+
+job_registry = JobRegistry(retention=settings.JOBS['RETENTION'],
+                           max_running=settings.JOBS['MAX_RUNNING'],
+                           rate=settings.JOBS['RATE'])
@@ -0,0 +1,39 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+from calendar import timegm
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from xbgw_dashboard.apps.dashboard.datapoints import datapoint_store
+
+
+class Command(BaseCommand):
+    help = ('Delete locally stored DataPoints older than the retention '
+            'period (DATAPOINT_STORE["RETENTION_DAYS"])')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    help='Keep this many days of DataPoints instead'),
+    )
+
+    def handle(self, *args, **options):
+        days = options.get('days')
+        if days is None:
+            days = settings.DATAPOINT_STORE['RETENTION_DAYS']
+        if days < 0:
+            raise CommandError('Retention must be a positive number of days')
+
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        before = timegm(cutoff.utctimetuple()) * 1000
+        count = datapoint_store.prune(before)
+        self.stdout.write('Deleted %d DataPoints older than %s UTC' %
+                          (count, cutoff.replace(microsecond=0)))
@@ -0,0 +1,92 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Minimal in-process metrics hook.
+
+Counters, gauges and timings are kept per worker process and can be read
+with snapshot(). If the New Relic agent is available, values are also
+reported to it as custom metrics.
+'''
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+try:
+    from newrelic.agent import record_custom_metric as _record_custom_metric
+except ImportError:
+    _record_custom_metric = None
+
+METRIC_PREFIX = 'Custom/XBeeCloudKit/'
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+# name -> [count, total, max]
+_timings = {}
+
+
+def _report(name, value):
+    if _record_custom_metric is not None:
+        try:
+            _record_custom_metric(METRIC_PREFIX + name, value)
+        except Exception:
+            logger.debug('Unable to report metric %s', name, exc_info=True)
+
+
+def incr(name, value=1):
+    """
+    Increment the counter name by value
+    """
+    with _lock:
+        _counters[name] += value
+    _report(name, value)
+
+
+def gauge(name, value):
+    """
+    Record the current value of something, such as a queue depth
+    """
+    _gauges[name] = value
+    _report(name, value)
+
+
+def timing(name, millis):
+    """
+    Record a duration, in milliseconds
+    """
+    with _lock:
+        stats = _timings.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += millis
+        stats[2] = max(stats[2], millis)
+    _report(name, millis)
+
+
+def snapshot():
+    """
+    Return a dict of all metrics recorded by this process
+    """
+    with _lock:
+        timings = dict(
+            (name, {'count': count, 'avg': total / count, 'max': maximum})
+            for name, (count, total, maximum) in _timings.iteritems())
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timings': timings,
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
@@ -19,3 +19,30 @@ class Dashboard(models.Model):
     """
     owner = models.ForeignKey(get_user_model(), related_name='dashboards')
     widgets = JSONField(blank=True)
+
+
+class StoredDataPoint(models.Model):
+    """
+    A DataPoint pushed by, or fetched from, Device Cloud, kept locally to
+    answer history queries
+    """
+    stream_id = models.CharField(max_length=255)
+    point_id = models.CharField(max_length=64)
+    # Milliseconds since the epoch
+    timestamp = models.BigIntegerField()
+    # The DataPoint as received from Device Cloud
+    point = JSONField()
+
+    class Meta:
+        unique_together = ('stream_id', 'point_id')
+        index_together = [['stream_id', 'timestamp']]
+
+
+class StoredRange(models.Model):
+    """
+    A time range, [start, end) in milliseconds since the epoch, for which
+    every DataPoint of a stream is stored locally
+    """
+    stream_id = models.CharField(max_length=255, db_index=True)
+    start = models.BigIntegerField()
+    end = models.BigIntegerField()
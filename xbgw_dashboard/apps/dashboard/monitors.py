@@ -0,0 +1,205 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Helpers for creating and maintaining Device Cloud push monitors
+'''
+import logging
+import time
+from django.conf import settings
+from gevent.lock import RLock
+from requests.exceptions import HTTPError
+from xbgw_dashboard.libs.digi.cache import TTLCache
+from xbgw_dashboard.libs.digi.devicecloud import DATAPOINT_RESOURCE
+
+logger = logging.getLogger(__name__)
+
+
+class MonitorEntry(object):
+    """
+    What we know about a monitor: its id, when we last kicked it, and the
+    Device Cloud response to hand back to clients
+    """
+
+    def __init__(self, mon_id, data, kicked):
+        self.mon_id = mon_id
+        self.data = data
+        self.kicked = kicked
+
+
+class MonitorRegistry(object):
+    """
+    In-memory record of known monitors, keyed by
+    (username, cloud_fqdn, topic, transport url).
+
+    Lets monitor setup skip the Monitor query for monitors we have already
+    found or created, and skip redundant kicks of monitors kicked recently.
+    Monitors kicked before Device Cloud was last told to back off (see
+    backed_off) are kicked again.
+    """
+
+    def __init__(self, ttl=3600, max_size=10000, lock_stripes=64):
+        self._entries = TTLCache(ttl=ttl, max_size=max_size)
+        self._locks = [RLock() for i in range(lock_stripes)]
+        # When a push was last refused
+        self._backed_off = 0
+
+    def lock(self, key):
+        """
+        Return the lock serializing setup of the monitor for key, so that
+        concurrent setups don't each query for (or create) the same monitor
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def record(self, key, mon_id, data):
+        """
+        Remember a monitor that was just found and kicked, or created
+        """
+        self._entries.set(key, MonitorEntry(mon_id, data, time.time()))
+
+    def kicked(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.kicked = time.time()
+
+    def forget(self, key):
+        self._entries.pop(key)
+
+    def backed_off(self):
+        """
+        Record that a push was refused, so Device Cloud is backing off the
+        monitor it came from. We can't tell which one, so every monitor is
+        kicked again on its next setup.
+        """
+        self._backed_off = time.time()
+
+    def needs_kick(self, entry):
+        interval = settings.MONITOR_KICK_INTERVAL
+        return entry.kicked < self._backed_off or \
+            time.time() - entry.kicked >= interval
+
+    def clear(self):
+        self._entries.clear()
+        self._backed_off = 0
+
+
+monitor_registry = MonitorRegistry()
+
+
+def _monitor_id_from_location(resp):
+    """
+    Device Cloud replies to a Monitor POST with the new resource's location,
+    of the form 'Monitor/<monId>', in a result element. Returns None if it
+    can't be found.
+    """
+    for path in (('result', 'location'), ('location',)):
+        location = resp
+        try:
+            for name in path:
+                location = location[name]
+        except (KeyError, TypeError):
+            continue
+        if isinstance(location, basestring):
+            return location.rsplit('/', 1)[-1] or None
+    return None
+
+
+def setup_monitor(conn, username, topic, endpoint_url, find, create,
+                  kick=False):
+    """
+    Make sure a monitor for topic exists on the account and is active.
+
+    Will use the monitor registry if it has a recent entry for this monitor,
+    otherwise query for existing monitors (with find()), create a new one if
+    none found (with create()), else kickstart the existing monitor. With
+    kick, a known monitor is kicked even if it was kicked recently.
+
+    Raises HTTPError/ConnectionError from Device Cloud.
+
+    Returns the monitor information from Device Cloud
+    """
+    key = (username, conn.cloud_fqdn, topic, endpoint_url)
+
+    with monitor_registry.lock(key):
+        return _setup_monitor(conn, key, find, create, kick)
+
+
+def _setup_monitor(conn, key, find, create, kick):
+    topic = key[2]
+    auth_user = settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER
+    auth_pass = settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS
+
+    entry = monitor_registry.get(key)
+    if entry is not None and entry.mon_id is not None:
+        if not kick and not monitor_registry.needs_kick(entry):
+            logger.debug('Monitor %s was kicked recently, skipping'
+                         % entry.mon_id)
+            return entry.data
+        try:
+            conn.kick_monitor(entry.mon_id, auth_user, auth_pass)
+        except HTTPError:
+            # Monitor may have been removed behind our back, look it up again
+            logger.info('Kicking known monitor %s failed, re-checking'
+                        % entry.mon_id)
+            monitor_registry.forget(key)
+        else:
+            monitor_registry.kicked(key)
+            return entry.data
+
+    monitors = find()
+
+    if monitors['resultSize'] == "0":
+        # No existing monitors found for this topic on this account,
+        # create a new one
+        # NOTE: The full url is generated by information passed in the
+        # request. If the same backend is being routed to from multiple
+        # places (reverse proxies, etc), each will generate a different url
+        logger.info('Creating a new monitor for topic %s' % topic)
+        resp = create()
+        monitor_registry.record(key, _monitor_id_from_location(resp), resp)
+    else:
+        # Should only have one monitor for a given topic
+        if len(monitors['items']) > 1:
+            logger.warning("Found multiple monitors for topic %s! " % topic +
+                           "This should not happen!")
+
+        monitor = monitors['items'][0]
+        logger.info(
+            'Found an existing monitor for topic %s, kicking it' % topic)
+        conn.kick_monitor(monitor['monId'], auth_user, auth_pass)
+        # Return the original info
+        resp = monitors
+        monitor_registry.record(key, monitor['monId'], resp)
+
+    return resp
+
+
+def remove_device_datapoint_monitors(conn, username, endpoint_url):
+    """
+    Delete the per-device DataPoint monitors (DataPoint/<device id>) pointing
+    at endpoint_url. Used when an account-wide DataPoint monitor replaces
+    them, so Device Cloud doesn't push each DataPoint twice.
+
+    Returns the number of monitors deleted
+    """
+    monitors = conn.get_monitors(urls=[endpoint_url])
+    prefix = DATAPOINT_RESOURCE + '/'
+    deleted = 0
+    for monitor in monitors.get('items', []):
+        topic = monitor.get('monTopic', '')
+        if topic.startswith(prefix):
+            logger.info('Deleting monitor %s for %s, replaced by account '
+                        'DataPoint monitor' % (monitor['monId'], topic))
+            conn.delete_monitor(monitor['monId'])
+            monitor_registry.forget(
+                (username, conn.cloud_fqdn, topic, endpoint_url))
+            deleted += 1
+    return deleted
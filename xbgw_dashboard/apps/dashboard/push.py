@@ -0,0 +1,150 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Asynchronous delivery of Device Cloud push monitor events.
+
+The monitor receiver view only parses pushes and queues them here, so Device
+Cloud's connection isn't held open while subscribers (sockets) are notified.
+A pool of dispatcher greenlets drains the queue.
+'''
+import logging
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from gevent.pool import Group
+from gevent.queue import JoinableQueue, Full, Empty
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT)
+
+
+def send_signals(batch):
+    """
+    Deliver a batch of (DeviceSignal, kwargs) pairs to the signals' receivers
+    """
+    for signal, args in batch:
+        if signal.send(**args):
+            metrics.incr('push.receiver_errors')
+
+
+class PushQueue(object):
+    """
+    Bounded queue of push batches, drained by dispatcher greenlets.
+
+    Dispatchers are started lazily on the first put, so importing this module
+    (e.g. from management commands) doesn't spawn anything.
+
+    Records the metrics push.enqueued, push.dropped, push.queue_depth and
+    push.queue_latency (ms between enqueue and dispatch).
+    """
+
+    def __init__(self, max_size=1000, workers=4, overflow=OVERFLOW_DROP_OLDEST,
+                 block_timeout=5, dispatch=send_signals):
+        """
+        Kwargs:
+            max_size (int): Maximum number of batches waiting for dispatch
+            workers (int): Number of dispatcher greenlets
+            overflow (str): What put() does when the queue is full:
+                'block' waits up to block_timeout seconds for room,
+                'drop-oldest' discards the oldest queued batch,
+                'reject' refuses the new batch.
+            block_timeout (float): See overflow
+            dispatch (callable): Called with each batch by the dispatchers
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ImproperlyConfigured(
+                'Unknown push queue overflow policy %s' % overflow)
+        self.workers = workers
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.dispatch = dispatch
+        self._queue = JoinableQueue(maxsize=max_size)
+        self._dispatchers = Group()
+
+    def _start_dispatchers(self):
+        # Dead dispatchers are removed from the group, this replaces them too
+        while len(self._dispatchers) < self.workers:
+            self._dispatchers.spawn(self._run)
+
+    def _dropped(self):
+        metrics.incr('push.dropped')
+        logger.warning('Push queue full, dropping a push batch')
+
+    def put(self, batch):
+        """
+        Queue batch for dispatch
+
+        Returns False if the batch was refused because the queue is full
+        """
+        self._start_dispatchers()
+        item = (time.time(), batch)
+
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            while True:
+                try:
+                    self._queue.put_nowait(item)
+                    break
+                except Full:
+                    try:
+                        self._queue.get_nowait()
+                    except Empty:
+                        continue
+                    self._queue.task_done()
+                    self._dropped()
+        else:
+            try:
+                if self.overflow == OVERFLOW_BLOCK:
+                    self._queue.put(item, timeout=self.block_timeout)
+                else:
+                    self._queue.put_nowait(item)
+            except Full:
+                self._dropped()
+                return False
+
+        metrics.incr('push.enqueued')
+        metrics.gauge('push.queue_depth', self._queue.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            enqueued, batch = self._queue.get()
+            try:
+                metrics.timing('push.queue_latency',
+                               (time.time() - enqueued) * 1000)
+                self.dispatch(batch)
+            except Exception:
+                logger.exception('Error dispatching push batch')
+            finally:
+                self._queue.task_done()
+                metrics.gauge('push.queue_depth', self._queue.qsize())
+
+    def join(self):
+        """
+        Wait until every queued batch has been dispatched
+        """
+        self._queue.join()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+
+def _queue_from_settings():
+    conf = settings.MONITOR_PUSH_QUEUE
+    return PushQueue(max_size=conf['MAX_SIZE'],
+                     workers=conf['WORKERS'],
+                     overflow=conf['OVERFLOW'],
+                     block_timeout=conf['BLOCK_TIMEOUT'])
+
+
+push_queue = _queue_from_settings()
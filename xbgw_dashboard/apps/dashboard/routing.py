@@ -0,0 +1,147 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+'''
+Routing of Device Cloud push monitor messages to per-device signals
+'''
+import logging
+import re
+from urllib import unquote
+from xbgw_dashboard.libs.digi.cache import TTLCache
+from signals import MONITOR_TOPIC_SIGNAL_MAP
+
+logger = logging.getLogger(__name__)
+
+# Device id embedded in a DataPoint stream name,
+# e.g. dia/channel/00000000-00000000-00000000-00000001/DIO/0
+DATAPOINT_DEVICE_ID_RE = re.compile(r'\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))')
+
+# Number of distinct push topics whose routing is remembered
+ROUTE_CACHE_SIZE = 4096
+
+
+class PushRouter(object):
+    """
+    Maps push monitor messages to the signals of the devices they concern.
+
+    Topic strings repeat for every push of a given stream, so the result of
+    parsing each one is kept in a bounded LRU. The customer id (account) of
+    each device seen in a push is remembered the same way.
+    """
+
+    def __init__(self, signal_maps, cache_size=ROUTE_CACHE_SIZE):
+        self.signal_maps = signal_maps
+        self._routes = TTLCache(max_size=cache_size)
+        self._customers = TTLCache(max_size=cache_size)
+
+    def _parse_topic(self, topic_full):
+        # reported topics come in a /##/Topic/Sub/topic/...,
+        # grab parts we care about
+        parts = topic_full.split('/', 2)
+        if len(parts) != 3:
+            logger.warning('Malformed push topic %s', topic_full)
+            return (None, None)
+        topic = parts[1]
+
+        device_id = None
+        if topic == 'DataPoint':
+            # Attempt to extract a device_id from the subtopic
+            match = DATAPOINT_DEVICE_ID_RE.match(unquote(parts[2]))
+            if match:
+                device_id = match.group('dev_id')
+            else:
+                logger.warning(
+                    'Error - No deviceId found in DataPoint subtopic!')
+        return (topic, device_id)
+
+    def route_topic(self, topic_full):
+        """
+        Returns (topic, device_id) for a full push topic. device_id is None
+        if it can't be determined from the topic alone.
+        """
+        route = self._routes.get(topic_full)
+        if route is None:
+            route = self._parse_topic(topic_full)
+            self._routes.set(topic_full, route)
+        return route
+
+    def customer_id(self, topic_full):
+        """
+        Returns the customer id a full push topic is for
+        """
+        return topic_full.split('/', 1)[0]
+
+    def device_key(self, msg):
+        """
+        Returns (topic, device_id) for a push message, or None if it isn't
+        for a device topic we handle.
+
+        Raises KeyError if the message has no topic.
+        """
+        topic, device_id = self.route_topic(msg['topic'])
+
+        if topic not in self.signal_maps:
+            logger.warning('No handler for push topic type %s!', topic)
+            return None
+
+        if topic == 'DeviceCore':
+            # Device id not in topic, need to parse out from
+            # message body directly...
+            try:
+                device_id = msg['DeviceCore']['devConnectwareId']
+            except (KeyError, TypeError):
+                logger.warning('No DeviceId found in DeviceCore event')
+                return None
+        elif device_id is None:
+            return None
+        return (topic, device_id)
+
+    def route(self, messages):
+        """
+        Returns a list of (signal, kwargs) for the messages that have
+        receivers listening.
+
+        Raises KeyError if a message has no topic.
+        """
+        batch = []
+        for msg in messages:
+            key = self.device_key(msg)
+            if key is None:
+                continue
+            topic, device_id = key
+            customer_id = self.customer_id(msg['topic'])
+            if self._customers.get(device_id) != customer_id:
+                self._customers.set(device_id, customer_id)
+
+            # dict.get, so devices nobody listens to don't get a signal made
+            signal = self.signal_maps[topic].get(device_id)
+            if signal is not None and signal.receivers:
+                batch.append((signal, {'device_id': device_id, 'data': msg}))
+        return batch
+
+    def subscriptions(self):
+        """
+        Returns the set of (topic, device_id) with receivers in this process
+        """
+        return set((topic, device_id)
+                   for topic, signals in self.signal_maps.iteritems()
+                   for device_id in signals.keys())
+
+    def has_subscribers(self, customer_id, subscriptions):
+        """
+        Whether any of subscriptions, a set of (topic, device_id), may be for
+        a device of customer_id. Devices we haven't had a push for yet count,
+        as they may be.
+        """
+        for topic, device_id in subscriptions:
+            if self._customers.get(device_id) in (customer_id, None):
+                return True
+        return False
+
+
+push_router = PushRouter(MONITOR_TOPIC_SIGNAL_MAP)
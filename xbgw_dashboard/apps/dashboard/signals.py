@@ -13,41 +13,178 @@ Created on Aug 6, 2013
 '''
 import logging
 import random
-from django.dispatch import Signal, receiver
-from django.contrib.auth.signals import user_logged_in
+import threading
+import time
+import types
+import weakref
+from django.dispatch import receiver
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.core.exceptions import ImproperlyConfigured
 from Crypto.Cipher import AES
 from django.conf import settings
 import binascii
+import metrics
+from util import credential_cache, credential_key
 
 logger = logging.getLogger(__name__)
 
 
+def _is_bound_method(receiver):
+    return isinstance(receiver, types.MethodType) and \
+        receiver.im_self is not None
+
+
+def _receiver_id(receiver):
+    if _is_bound_method(receiver):
+        return (id(receiver.im_self), id(receiver.im_func))
+    return id(receiver)
+
+
+class DeviceSignal(object):
+    """
+    The receivers of one device's push events.
+
+    Receivers are held by weak reference (bound methods through their
+    instance) and stored in a tuple that is replaced on every connect or
+    disconnect, so sending iterates a snapshot without taking a lock. A
+    receiver raising doesn't prevent delivery to the others.
+
+    Receivers are called with keyword arguments only, e.g.
+    receiver(device_id=..., data=...)
+    """
+
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+        # Since when someone has been listening for this key
+        self.created = time.time()
+        # Tuple of (receiver id, weak reference, unbound function or None)
+        self.receivers = ()
+
+    def connect(self, receiver):
+        rid = _receiver_id(receiver)
+        remove = lambda ref: self._remove(rid)
+        if _is_bound_method(receiver):
+            entry = (rid, weakref.ref(receiver.im_self, remove),
+                     receiver.im_func)
+        else:
+            entry = (rid, weakref.ref(receiver, remove), None)
+        with self.owner.lock:
+            if not any(r[0] == rid for r in self.receivers):
+                self.receivers = self.receivers + (entry,)
+
+    def disconnect(self, receiver):
+        self._remove(_receiver_id(receiver))
+
+    def _remove(self, rid):
+        with self.owner.lock:
+            self.receivers = tuple(r for r in self.receivers if r[0] != rid)
+        self.owner._discard_if_unused(self)
+
+    def send(self, **kwargs):
+        """
+        Call each receiver with kwargs
+
+        Returns the number of receivers that raised an exception
+        """
+        errors = 0
+        for rid, ref, func in self.receivers:
+            target = ref()
+            if target is None:
+                continue
+            try:
+                if func is None:
+                    target(**kwargs)
+                else:
+                    func(target, **kwargs)
+            except Exception:
+                errors += 1
+                logger.exception('Push receiver %r for %s failed'
+                                 % (func or target, self.key))
+        return errors
+
+
 class SignalDict(dict):
+    """
+    Index of per-key (e.g. per device id) DeviceSignals.
+
+    Indexing creates the key's DeviceSignal so receivers can be connected to
+    it, and the DeviceSignal is dropped again when its last receiver goes
+    away. Use get() for lookups that shouldn't create anything, such as
+    routing pushes.
 
-    def __init__(self, arglist):
+    The number of keys is reported through the metrics gauge
+    signals.<name>.size. If set, on_change is called with no arguments
+    whenever a key is added or removed.
+    """
+
+    def __init__(self, arglist, name=None):
+        # Keyword arguments receivers are called with
         self.arglist = arglist[:]
-        self.constructor = lambda: Signal(providing_args=self.arglist)
+        self.name = name
+        self.lock = threading.RLock()
+        self.on_change = None
 
     def __getitem__(self, item):
         try:
             return dict.__getitem__(self, item)
         except KeyError:
             # Add a signal for this name
-            newsignal = self.constructor()
+            newsignal = DeviceSignal(self, item)
             self[item] = newsignal
+            self._changed()
             return newsignal
 
+    def connect(self, key, receiver):
+        """
+        Connect receiver to the DeviceSignal for key
+        """
+        self[key].connect(receiver)
+
+    def disconnect(self, key, receiver):
+        """
+        Disconnect receiver from the DeviceSignal for key, dropping the
+        DeviceSignal if it was the last receiver
+        """
+        signal = self.get(key)
+        if signal is not None:
+            signal.disconnect(receiver)
+
+    def _discard_if_unused(self, signal):
+        # Only drop the entry if it's still this signal's
+        with self.lock:
+            if signal.receivers or self.get(signal.key) is not signal:
+                return
+            del self[signal.key]
+        self._changed()
+
+    def _changed(self):
+        if self.name is not None:
+            metrics.gauge('signals.%s.size' % self.name, len(self))
+        if self.on_change is not None:
+            self.on_change()
+
 
 # Mapping of monitor topics to SignalDict's for that topic
 # Note that each topic's dict might be constructed differently -
 # ex. DataPoint uses device_id and data args
 MONITOR_TOPIC_SIGNAL_MAP = {
-    'DataPoint': SignalDict(['device_id', 'data']),
-    'DeviceCore': SignalDict(['device_id', 'data'])
+    'DataPoint': SignalDict(['device_id', 'data'], name='DataPoint'),
+    'DeviceCore': SignalDict(['device_id', 'data'], name='DeviceCore')
 }
 
 
+# Credentials cached for a session are stale once a user logs in or out on it
+@receiver([user_logged_in, user_logged_out])
+def forget_credentials(sender, request, user=None, **kwargs):
+    try:
+        session_key = request.session.session_key
+    except AttributeError:
+        return
+    if session_key is not None and user is not None:
+        credential_cache.pop(credential_key(session_key, user))
+
+
 # When an user logs in, store their password encrypted
 # in the session for later use
 @receiver(user_logged_in)
@@ -8,10 +8,19 @@
 
 import logging
 
+import gevent
+from django.conf import settings as app_settings
+from gevent.pool import Pool
+from requests.exceptions import HTTPError, ConnectionError
 from signals import MONITOR_TOPIC_SIGNAL_MAP
 from socketio.namespace import BaseNamespace
 from socketio.sdjango import namespace
+from xbgw_dashboard.libs.digi.devicecloud import DeviceCloudConnector
+from caches import xbee_index, XBeeQueryError
+from jobs import StockConfigJob, job_registry
+from util import get_credentials
 from views import DevicesList, monitor_setup, monitor_devicecore_setup
+from xbee import EXT_ADDR_RE
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +28,17 @@ logger = logging.getLogger(__name__)
 @namespace('/device')
 class DeviceDataNamespace(BaseNamespace):
 
+    # DataPoint events are sent one at a time, unless the client asks for
+    # batches with enabledatabatching
+    data_batching = False
+    device_data_buffer = ()
+    flush_timer = None
+    # Jobs whose events are sent to this socket
+    followed_jobs = ()
+    # Set once the socket is gone, monitor setups still in flight then
+    # don't connect any receivers
+    disconnected = False
+
     def get_initial_acl(self):
         """ Don't allow any methods until authenticated """
         return []
@@ -43,59 +63,96 @@ class DeviceDataNamespace(BaseNamespace):
             self.lift_acl_restrictions()
 
     def on_startmonitoringdevice(self, *args):
+        # Skip devices we're already monitoring, and any duplicates
+        device_ids = []
         for device_id in args:
             if device_id is not None and device_id not in \
-                    self.monitored_devices:
-                # Check that the requested device belongs to this user
-                # If the local list of devices doesn't yet exist, do a device
-                # query.
-                if not self.request.session.get('user_devices', False):
-                    DevicesList.as_view()(self.request)
-                if device_id in self.request.session.get('user_devices', []):
-                    logger.debug("Kicking/Creating DataPoint Monitor for %s" %
-                                 device_id)
-                    mon = monitor_setup(self.request, device_id)
-                    if mon.status_code != 200:
-                        # Something went wrong with monitor setup,
-                        # return an error
-                        logger.error(
-                            'Error while trying to set up monitor for socket')
-                        self.emit(
-                            'error',
-                            "An error occurred while setting up the monitor " +
-                            "for this device.", mon.data)
-                    else:
-                        logger.debug(
-                            "Adding socket reciever for data for device %s" %
-                            device_id)
-                        # Add receiver for DataPoint events
-                        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                            .connect(self.device_data_receiver)
-                        # Add receiver for DeviceCore events
-                        MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                            .connect(self.device_status_receiver)
-                        self.monitored_devices.add(device_id)
-                        self.emit('started_monitoring', device_id)
+                    self.monitored_devices and device_id not in device_ids:
+                device_ids.append(device_id)
+
+        if not device_ids:
+            return True
+
+        # Check that the requested devices belong to this user
+        # If the local list of devices doesn't yet exist, do a device
+        # query.
+        if not self.request.session.get('user_devices', False):
+            DevicesList.as_view()(self.request)
+        user_devices = self.request.session.get('user_devices', [])
+
+        # Monitor setup is a few Device Cloud round-trips per device, run them
+        # concurrently so the last device doesn't wait on all the others.
+        # The setups die with this handler, e.g. when the socket is killed.
+        pool = Pool(app_settings.MONITOR_SETUP_CONCURRENCY)
+        try:
+            for device_id in device_ids:
+                if device_id in user_devices:
+                    pool.spawn(self.start_monitoring_device, device_id)
                 else:
                     logger.error(
-                        "User %s attempted to start monitoring device %s," +
-                        " which is not in their account!" %
-                        (self.request.user.username, device_id))
+                        "User %s attempted to start monitoring device %s, "
+                        "which is not in their account!",
+                        self.request.user.username, device_id)
                     self.emit(
                         'error',
                         "Permission denied: Attempted to monitor a device " +
                         "not in your account!")
+            pool.join()
+        finally:
+            pool.kill()
         return True
 
+    def start_monitoring_device(self, device_id):
+        """
+        Set up the Device Cloud monitor for a single device and, once ready,
+        start forwarding its events to this socket
+        """
+        logger.debug("Kicking/Creating DataPoint Monitor for %s" % device_id)
+        try:
+            mon = monitor_setup(self.request, device_id)
+        except Exception:
+            logger.exception(
+                'Error while trying to set up monitor for device %s',
+                device_id)
+            self.emit(
+                'error',
+                "An error occurred while setting up the monitor " +
+                "for this device.", device_id)
+            return
+
+        if self.disconnected:
+            return
+        if mon.status_code != 200:
+            # Something went wrong with monitor setup,
+            # return an error
+            logger.error(
+                'Error while trying to set up monitor for socket')
+            self.emit(
+                'error',
+                "An error occurred while setting up the monitor " +
+                "for this device.", mon.data)
+        else:
+            logger.debug(
+                "Adding socket reciever for data for device %s" %
+                device_id)
+            # Add receiver for DataPoint events
+            MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].connect(
+                device_id, self.device_data_receiver)
+            # Add receiver for DeviceCore events
+            MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].connect(
+                device_id, self.device_status_receiver)
+            self.monitored_devices.add(device_id)
+            self.emit('started_monitoring', device_id)
+
     def on_stopmonitoringdevice(self, *args):
         for device_id in args:
             if device_id in self.monitored_devices:
                 logger.debug("Removing socket reciever for data for device %s"
                              % device_id)
-                MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                    .disconnect(self.device_data_receiver)
-                MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                    .disconnect(self.device_status_receiver)
+                MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect(
+                    device_id, self.device_data_receiver)
+                MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].disconnect(
+                    device_id, self.device_status_receiver)
                 self.monitored_devices.remove(device_id)
                 self.emit('stopped_monitoring', device_id)
         return True
@@ -114,13 +171,117 @@ class DeviceDataNamespace(BaseNamespace):
                       mon.data)
         return True
 
+    def on_enabledatabatching(self, *args):
+        """
+        The client understands device_data_batch events. Buffer DataPoint
+        events and send them as lists from now on.
+        """
+        if not self.data_batching:
+            self.data_batching = True
+            self.device_data_buffer = []
+        return True
+
+    def on_startstockconfigjob(self, device_id, radios=None):
+        """
+        Start a job applying the Cloud Kit stock configuration to the given
+        radios of gateway device_id, or all of its radios. Progress is sent
+        as job_started, job_progress and job_done events.
+        """
+        if not self.request.session.get('user_devices', False):
+            DevicesList.as_view()(self.request)
+        if device_id not in self.request.session.get('user_devices', []):
+            logger.error(
+                "User %s attempted to configure device %s, which is not in "
+                "their account!", self.request.user.username, device_id)
+            self.emit('error', "Permission denied: Attempted to configure "
+                      "a device not in your account!")
+            return True
+
+        if radios is not None and not (
+                isinstance(radios, list) and
+                all(isinstance(radio, basestring) and EXT_ADDR_RE.match(radio)
+                    for radio in radios)):
+            self.emit('error', "Radios must be a list of extended "
+                      "addresses.", device_id)
+            return True
+
+        username, password, cloud_fqdn = get_credentials(self.request)
+        owner = (username, cloud_fqdn)
+        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        if not radios:
+            try:
+                radios = [xbee['xpExtAddr'] for xbee in xbee_index.lookup(
+                    owner, conn, gateway=device_id)]
+            except (HTTPError, ConnectionError, XBeeQueryError):
+                logger.exception('Error listing XBees of %s', device_id)
+                self.emit('error', "An error occurred while listing the "
+                          "XBees of this device.", device_id)
+                return True
+
+        # Checked right before adding the job, with no switch in between
+        if not job_registry.can_start(owner):
+            self.emit('error', "Too many configuration jobs are running, "
+                      "wait for one to finish.", device_id)
+            return True
+        job = StockConfigJob(owner, conn, device_id, radios,
+                             concurrency=app_settings.JOBS['CONCURRENCY'],
+                             throttle=job_registry.throttle(owner))
+        job_registry.add(job)
+        self.follow_job(job)
+        job.start()
+        return True
+
+    def on_resumejob(self, job_id, after=0):
+        """
+        Follow a job again, e.g. after reconnecting. Events with a sequence
+        number above after are sent again.
+        """
+        if not isinstance(after, (int, long)) or isinstance(after, bool) or \
+                after < 0:
+            self.emit('error', "After must be a non-negative event sequence "
+                      "number.", job_id)
+            return True
+        username, password, cloud_fqdn = get_credentials(self.request)
+        job = job_registry.get(job_id, (username, cloud_fqdn))
+        if job is None:
+            self.emit('job_unknown', job_id)
+        else:
+            self.follow_job(job, after)
+        return True
+
+    def on_canceljob(self, job_id):
+        username, password, cloud_fqdn = get_credentials(self.request)
+        job = job_registry.get(job_id, (username, cloud_fqdn))
+        if job is not None:
+            job.cancel()
+        return True
+
+    def follow_job(self, job, after=0):
+        if not self.followed_jobs:
+            self.followed_jobs = set()
+        self.followed_jobs.add(job)
+        job.follow(self.job_event_receiver, after)
+
+    def job_event_receiver(self, name, event):
+        self.emit(name, event)
+
     def disconnect(self, **kwargs):
         logger.debug("disconnecting socket & signal recievers")
+        self.disconnected = True
+        # Jobs keep running, a new socket can resume following them
+        for job in self.followed_jobs:
+            job.unfollow(self.job_event_receiver)
+        self.followed_jobs = ()
+        if self.flush_timer is not None:
+            self.flush_timer.kill(block=False)
+            self.flush_timer = None
+        if self.device_data_buffer:
+            self.device_data_buffer = []
         for device_id in self.monitored_devices:
-            MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][device_id]\
-                .disconnect(self.device_data_receiver)
-            MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'][device_id]\
-                .disconnect(self.device_status_receiver)
+            MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect(
+                device_id, self.device_data_receiver)
+            MONITOR_TOPIC_SIGNAL_MAP['DeviceCore'].disconnect(
+                device_id, self.device_status_receiver)
         self.monitored_devices.clear()
         super(DeviceDataNamespace, self).disconnect(**kwargs)
 
@@ -128,9 +289,33 @@ class DeviceDataNamespace(BaseNamespace):
         # Validate that we're only sending data this socket is supposed to
         # monitor
         if kwargs['device_id'] in self.monitored_devices:
-            self.emit('device_data', kwargs['data'])
+            if self.data_batching:
+                self.buffer_device_data(kwargs['data'])
+            else:
+                self.emit('device_data', kwargs['data'])
         return True
 
+    def buffer_device_data(self, data):
+        """
+        Add a DataPoint event to the outgoing batch, sending the batch once it
+        is full or has waited long enough
+        """
+        self.device_data_buffer.append(data)
+        batch_settings = app_settings.DEVICE_DATA_BATCH
+        if len(self.device_data_buffer) >= batch_settings['MAX_SIZE']:
+            self.flush_device_data()
+        elif self.flush_timer is None:
+            self.flush_timer = gevent.spawn_later(batch_settings['INTERVAL'],
+                                                  self.flush_device_data)
+
+    def flush_device_data(self):
+        timer, self.flush_timer = self.flush_timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        if self.device_data_buffer:
+            batch, self.device_data_buffer = self.device_data_buffer, []
+            self.emit('device_data_batch', batch)
+
     def device_status_receiver(self, **kwargs):
         # Validate that we're only sending data this socket is supposed to
         # monitor
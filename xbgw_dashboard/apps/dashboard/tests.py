@@ -14,14 +14,23 @@ Replace this with more appropriate tests for your application.
 """
 from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.management import call_command
+from StringIO import StringIO
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
 from django.test.client import RequestFactory
 from mock import patch, MagicMock
 from django.contrib.auth import get_user_model, login
-from views import login_user, logout_user
+from views import login_user, logout_user, stream_datapoints
 from django.contrib.sessions.middleware import SessionMiddleware
-from models import Dashboard
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from models import Dashboard, StoredDataPoint, StoredRange
 from xbgw_dashboard.libs.digi.models import DeviceCloudUser
+from xbgw_dashboard.libs.digi.auth import auth_cache
 from xbgw_dashboard.libs.digi.tests import TEST_RESPONSES
+from xbgw_dashboard.libs.digi.devicecloud import XBEE_PAGE_SIZE
+from xbgw_dashboard.libs.digi import xmlparse
 import json
 from sockets import DeviceDataNamespace
 from socketio.virtsocket import Socket
@@ -29,7 +38,26 @@ import util
 import base64
 from django.conf import settings
 from rest_framework.test import APITestCase
-from signals import MONITOR_TOPIC_SIGNAL_MAP
+from signals import MONITOR_TOPIC_SIGNAL_MAP, SignalDict
+from monitors import monitor_registry, setup_monitor, \
+    remove_device_datapoint_monitors
+from push import push_queue, PushQueue
+from routing import PushRouter
+from broker import push_broker, UnixSocketBroker
+from jobs import StockConfigJob, RateLimiter, JobRegistry, job_registry
+from caches import device_list_cache, DeviceListCache, xbee_index, \
+    XBeeIndex, XBeeQueryError, settings_cache
+from datapoints import datapoint_buffer, datapoint_store, DataPointBuffer, \
+    DataPointStore, missing_ranges
+import metrics
+import downsample
+from requests.exceptions import ConnectionError, HTTPError
+import gevent
+import os
+import time
+import shutil
+import stat
+import tempfile
 
 User = get_user_model()
 
@@ -62,6 +90,15 @@ class MockedCloudTestCase(APITestCase):
         # By default cloud cred check will return valid, individual test can change this if desired
         self.set_auth_result((True, {}))
 
+        # Start each test without any remembered monitors
+        monitor_registry.clear()
+        datapoint_buffer.clear()
+        device_list_cache.clear()
+        xbee_index.clear()
+        settings_cache.clear()
+        util.credential_cache.clear()
+        auth_cache.clear()
+
     def do_session_middleware_stuff(self, request):
         """
         If using the RequestFactory, middleware is skipped which breaks auth. Use this to re-add session info to request
@@ -319,6 +356,288 @@ class DevicesViewTest(MockedCloudAuthenticatedTestCase):
         self.assertTrue(self.patched_post.called)
         self.assertIn("<DeviceCore><devMac>123456</devMac></DeviceCore>", self.patched_post.call_args[1]['data'])
 
+    def test_device_list_cached(self):
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+        patcher.start().return_value = ('existinguser', 'pass', 'existingserver')
+        self.addCleanup(patcher.stop)
+        self.client.get(reverse('devices-list'))
+        resp = self.client.get(reverse('devices-list'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertIn('url', json.loads(resp.content)['items'][0].keys())
+        # Provisioning a device invalidates the account's list
+        self.patched_post.return_value.json.return_value = {}
+        self.client.post(reverse('devices-list'), {'mac': '123456'})
+        self.client.get(reverse('devices-list'))
+        self.assertEqual(self.patched_get.call_count, 2)
+
+
+class DeviceListCacheTest(TestCase):
+
+    key = ('user', 'cloud')
+    device_id = "00000000-00000000-00000000-00000001"
+
+    def setUp(self):
+        self.cache = DeviceListCache(ttl=30, max_accounts=2)
+        self.cache.set(self.key, json.loads(TEST_RESPONSES['DeviceCore']['GET']))
+
+    def test_get_copy(self):
+        devices = self.cache.get(self.key)
+        devices['items'][0]['url'] = 'url'
+        self.assertNotIn('url', self.cache.get(self.key)['items'][0])
+        self.assertIsNone(self.cache.get(('other', 'cloud')))
+
+    def test_pushed_update(self):
+        self.cache.update_messages([
+            {'topic': '1/DeviceCore/1', 'DeviceCore': {
+                'devConnectwareId': self.device_id, 'dpConnectionStatus': '1',
+                'dpNotQueried': '1'}},
+            {'topic': '1/DataPoint/x', 'DataPoint': {}}])
+        device = self.cache.get(self.key)['items'][0]
+        self.assertEqual(device['dpConnectionStatus'], '1')
+        self.assertNotIn('dpNotQueried', device)
+        self.assertEqual(self.cache.update_device({'devConnectwareId': 'other'}), 0)
+
+    def test_invalidate(self):
+        self.cache.invalidate(self.key)
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertEqual(self.cache.update_device({'devConnectwareId': self.device_id}), 0)
+
+    def test_eviction_forgets_devices(self):
+        self.cache.set(('user2', 'cloud'), {'items': []})
+        self.cache.set(('user3', 'cloud'), {'items': []})
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertEqual(dict(self.cache._accounts), {})
+
+
+class XBeeListViewTest(MockedCloudAuthenticatedTestCase):
+
+    device_id = "00000000-00000000-00000000-00000001"
+    xbees = {'items': [{'xpExtAddr': '00:13:A2:00:00:00:00:01', 'devConnectwareId': device_id},
+                       {'xpExtAddr': '00:13:A2:00:00:00:00:02', 'devConnectwareId': device_id}]}
+
+    def setUp(self):
+        super(XBeeListViewTest, self).setUp()
+        self.patched_get.return_value.json.return_value = self.xbees
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+        patcher.start().return_value = ('existinguser', 'pass', 'existingserver')
+        self.addCleanup(patcher.stop)
+
+    def test_explicit_lookup_indexed(self):
+        for addr in ('00:13:A2:00:00:00:00:01', '00:13:A2:00:00:00:00:02'):
+            resp = self.client.get(reverse('xbee-list'), {'ext_addr': addr})
+            self.assertEqual(resp.status_code, 200)
+            json_resp = json.loads(resp.content)
+            self.assertEqual([x['xpExtAddr'] for x in json_resp['items']], [addr])
+            self.assertIn('config-url', json_resp['items'][0].keys())
+        self.assertEqual(self.patched_get.call_count, 1)
+        self.assertEqual(self.patched_get.call_args[1]['params']['condition'], '')
+
+    def test_explicit_lookup_error(self):
+        self.client.get(reverse('xbee-list'), {'ext_addr': '00:13:A2:00:00:00:00:01'})
+        error = MagicMock(status_code=400, headers={'content-type': 'application/json'})
+        error.json.return_value = {'error': 'bad condition'}
+        self.patched_get.return_value.raise_for_status.side_effect = HTTPError(response=error)
+        # Not in the index, so Device Cloud is asked for it
+        resp = self.client.get(reverse('xbee-list'), {'ext_addr': "00:13:A2:00:00:00:00:0'"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(json.loads(resp.content), {'error': 'bad condition'})
+        self.assertEqual(self.patched_get.call_args[1]['params']['condition'],
+                         "(xpExtAddr='00:13:A2:00:00:00:00:0'')")
+
+    def test_gateway_discovery_merged(self):
+        resp = self.client.get(reverse('device-xbee-list', kwargs={'device_id': self.device_id}))
+        self.assertEqual(json.loads(resp.content)['resultSize'], "2")
+        self.patched_get.return_value.json.return_value = {'items': [self.xbees['items'][0]]}
+        self.client.get(reverse('device-xbee-list', kwargs={'device_id': self.device_id}),
+                        {'cache': 'false', 'clear': 'true'})
+        self.assertEqual(self.patched_get.call_args[1]['params']['clear'], 'true')
+        resp = self.client.get(reverse('device-xbee-list', kwargs={'device_id': self.device_id}))
+        self.assertEqual(json.loads(resp.content)['resultSize'], "1")
+        self.assertEqual(self.patched_get.call_count, 2)
+
+
+class XBeeConfigListViewTest(MockedCloudAuthenticatedTestCase):
+
+    device_id = "00000000-00000000-00000000-00000001"
+    path = reverse('xbee-config-list', kwargs={'device_id': device_id})
+
+    def setUp(self):
+        super(XBeeConfigListViewTest, self).setUp()
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+        patcher.start().return_value = ('existinguser', 'pass', 'existingserver')
+        self.addCleanup(patcher.stop)
+
+    def settings(self, device_id, radio, cache):
+        if radio == '00:13:A2:00:00:00:00:02':
+            return {'sci_reply': {'error': 'timeout'}}
+        return {'sci_reply': {'send_message': {'device': {'rci_reply': {'do_command': {
+            'query_setting': {'radio': {'ID': radio}}}}}}}}
+
+    @patch('xbgw_dashboard.apps.dashboard.views.DeviceCloudConnector.get_device_settings')
+    def test_config_list_read(self, patched_settings):
+        patched_settings.side_effect = self.settings
+        radios = ['00:13:A2:00:00:00:00:01', '00:13:A2:00:00:00:00:02', '00:13:A2:00:00:00:00:01']
+        resp = self.client.get(self.path, {'radio': radios})
+        self.assertEqual(resp.status_code, 200)
+        json_resp = json.loads(''.join(resp.streaming_content))
+        self.assertEqual(patched_settings.call_count, 2)
+        ok = json_resp['00:13:A2:00:00:00:00:01']
+        self.assertEqual(ok['status'], 200)
+        self.assertEqual(ok['data']['radio']['ID'], '00:13:A2:00:00:00:00:01')
+        self.assertIn('kit-stock-config-apply-url', ok['data'])
+        self.assertEqual(json_resp['00:13:A2:00:00:00:00:02']['status'], 500)
+
+    def test_config_list_bad_radio(self):
+        self.assertEqual(self.client.get(self.path).status_code, 400)
+        resp = self.client.get(self.path, {'radio': ["00:13:A2:00:00:00:00:01'"]})
+        self.assertEqual(resp.status_code, 400)
+
+
+class XBeeConfigViewTest(MockedCloudAuthenticatedTestCase):
+
+    device_id = "00000000-00000000-00000000-00000001"
+    radio = '00:13:A2:00:00:00:00:01'
+    path = reverse('xbee-config', kwargs={'device_id': device_id, 'radio': radio})
+
+    def setUp(self):
+        super(XBeeConfigViewTest, self).setUp()
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+        patcher.start().return_value = ('existinguser', 'pass', 'existingserver')
+        self.addCleanup(patcher.stop)
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.DeviceCloudConnector.get_device_settings')
+        self.patched_settings = patcher.start()
+        self.patched_settings.return_value = {'sci_reply': {'send_message': {'device': {'rci_reply': {
+            'do_command': {'query_setting': {'radio': {'ID': '1'}}}}}}}}
+        self.addCleanup(patcher.stop)
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.DeviceCloudConnector.set_device_settings')
+        self.patched_set = patcher.start()
+        self.patched_set.return_value = {'sci_reply': {}}
+        self.addCleanup(patcher.stop)
+
+    def put(self, config):
+        return self.client.put(self.path, json.dumps(config), content_type='application/json')
+
+    def test_config_cached(self):
+        resp = self.client.get(self.path)
+        self.assertEqual(resp['X-Settings-Cache'], 'MISS')
+        self.assertFalse(resp.has_header('Age'))
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['X-Settings-Cache'], 'HIT')
+        self.assertEqual(resp['Age'], '0')
+        self.assertEqual(json.loads(resp.content)['radio']['ID'], '1')
+        self.assertEqual(self.patched_settings.call_count, 1)
+        resp = self.client.get(self.path, {'refresh': 'true'})
+        self.assertEqual(resp['X-Settings-Cache'], 'MISS')
+        self.assertEqual(self.patched_settings.call_count, 2)
+
+    def test_error_not_cached(self):
+        self.patched_settings.return_value = {'sci_reply': {'error': 'timeout'}}
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(json.loads(resp.content)['errors'],
+                         [{'path': 'sci_reply/error', 'target': None, 'error': 'timeout'}])
+        self.assertEqual(self.client.get(self.path)['X-Settings-Cache'], 'MISS')
+
+    def test_write_through(self):
+        self.client.get(self.path)
+        resp = self.put({'radio': {'ID': 5, 'NI': 'node'}})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get(self.path)
+        self.assertEqual(resp['X-Settings-Cache'], 'HIT')
+        self.assertEqual(json.loads(resp.content)['radio'], {'ID': '5', 'NI': 'node'})
+        # The device's state is unknown after a failed write
+        self.patched_set.return_value = {'sci_reply': {'error': 'failed'}}
+        self.assertEqual(self.put({'radio': {'ID': 6}}).status_code, 500)
+        self.assertEqual(self.client.get(self.path)['X-Settings-Cache'], 'MISS')
+
+    def test_stock_config_write_through(self):
+        self.client.get(self.path)
+        resp = self.client.put(reverse('xbee-stock-config', kwargs={'device_id': self.device_id, 'radio': self.radio}))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.patched_settings.call_count, 2)
+        resp = self.client.get(self.path)
+        self.assertEqual(resp['X-Settings-Cache'], 'HIT')
+        self.assertEqual(json.loads(resp.content)['config-kit-stock-values'], {})
+
+
+class XBeeIndexTest(TestCase):
+
+    key = ('user', 'cloud')
+    gateway = "00000000-00000000-00000000-00000001"
+
+    def xbee(self, addr, gateway=gateway, node_id=''):
+        return {'xpExtAddr': addr, 'devConnectwareId': gateway, 'xpNodeId': node_id}
+
+    def setUp(self):
+        self.index = XBeeIndex(refresh=60, max_age=600)
+        self.conn = MagicMock()
+        self.conn.get_xbees.return_value = {'items': [
+            self.xbee('00:13:A2:00:00:00:00:02'),
+            self.xbee('00:13:A2:00:00:00:00:01'),
+            self.xbee('00:13:A2:00:00:00:00:03', gateway='other')]}
+
+    def addrs(self, items):
+        return [item['xpExtAddr'][-2:] for item in items]
+
+    def test_lookup(self):
+        items = self.index.lookup(self.key, self.conn, addrs=['00:13:a2:00:00:00:00:01', '00:13:A2:00:00:00:00:03'])
+        self.assertEqual(self.addrs(items), ['01', '03'])
+        self.assertEqual(self.addrs(self.index.lookup(self.key, self.conn, gateway=self.gateway)), ['01', '02'])
+        self.assertEqual(len(self.index.lookup(self.key, self.conn)), 3)
+        # One query for the whole account
+        self.conn.get_xbees.assert_called_once_with(start=0, size=XBEE_PAGE_SIZE)
+        # Callers get copies
+        items[0]['url'] = 'url'
+        self.assertNotIn('url', self.index.lookup(self.key, self.conn, addrs=['00:13:A2:00:00:00:00:01'])[0])
+
+    def test_load_pages(self):
+        pages = [{'resultTotalRows': '3', 'items': [self.xbee('00:13:A2:00:00:00:00:0%d' % i)]}
+                 for i in (1, 2, 3)]
+        self.conn.get_xbees.side_effect = pages
+        self.assertEqual(self.addrs(self.index.lookup(self.key, self.conn)), ['01', '02', '03'])
+        self.assertEqual([c[1]['start'] for c in self.conn.get_xbees.call_args_list], [0, 1, 2])
+
+    def test_lookup_missing(self):
+        self.index.lookup(self.key, self.conn)
+        self.conn.get_xbees.return_value = {'items': [self.xbee('00:13:A2:00:00:00:00:04')]}
+        items = self.index.lookup(self.key, self.conn, addrs=['00:13:A2:00:00:00:00:01', '00:13:a2:00:00:00:00:04', 'unknown'])
+        self.assertEqual(self.addrs(items), ['01', '04'])
+        # Only the addresses missing from the index are queried for
+        self.conn.get_xbees.assert_called_with(addrs=['00:13:a2:00:00:00:00:04', 'unknown'])
+        # And are in the index from then on
+        self.index.lookup(self.key, self.conn, addrs=['00:13:A2:00:00:00:00:04'])
+        self.assertEqual(self.conn.get_xbees.call_count, 2)
+
+    def test_error(self):
+        self.conn.get_xbees.return_value = {'error': 'failed'}
+        self.assertRaises(XBeeQueryError, self.index.lookup, self.key, self.conn)
+
+    @patch('xbgw_dashboard.apps.dashboard.caches.time.time')
+    def test_background_refresh(self, patched_time):
+        patched_time.return_value = 1000
+        self.index.lookup(self.key, self.conn)
+        self.conn.get_xbees.return_value = {'items': [self.xbee('00:13:A2:00:00:00:00:04')]}
+        patched_time.return_value = 1061
+        # Stale index still answers while it's refreshed
+        self.assertEqual(len(self.index.lookup(self.key, self.conn)), 3)
+        gevent.sleep(0)
+        self.assertEqual(self.addrs(self.index.lookup(self.key, self.conn)), ['04'])
+
+    def test_merge_discovery(self):
+        self.index.lookup(self.key, self.conn)
+        # Cleared discovery replaces the gateway's nodes
+        self.index.merge(self.key, {'items': [self.xbee('00:13:A2:00:00:00:00:02', node_id='NEW'),
+                                              self.xbee('00:13:A2:00:00:00:00:05')]},
+                         gateway=self.gateway)
+        items = self.index.lookup(self.key, self.conn, gateway=self.gateway)
+        self.assertEqual(self.addrs(items), ['02', '05'])
+        self.assertEqual(items[0]['xpNodeId'], 'NEW')
+        # Otherwise results are added
+        self.index.merge(self.key, {'items': self.xbee('00:13:A2:00:00:00:00:06')})
+        self.assertEqual(len(self.index.lookup(self.key, self.conn)), 4)
+        self.assertEqual(self.conn.get_xbees.call_count, 1)
 
 
 class DeviceDetailViewTest(MockedCloudAuthenticatedTestCase):
@@ -488,6 +807,9 @@ class DeviceDataPointViewTest(MockedCloudAuthenticatedTestCase):
         self.patched_get.return_value.text = result_text
         self.patched_get.return_value.json.return_value = json.loads(result_text)
 
+    def streamed_json(self, resp):
+        return json.loads(''.join(resp.streaming_content))
+
     def test_unauthenticated_datapoint_read(self):
         self.client.logout()
         resp = self.client.get(reverse('device-datapoint-list', kwargs={'device_id': "00000000-00000000-00000000-00000001", 'stream_id': "00000000-00000000-00000000-00000001/DIO/0"}))
@@ -501,11 +823,349 @@ class DeviceDataPointViewTest(MockedCloudAuthenticatedTestCase):
     def test_device_datapoint_read(self):
         resp = self.client.get(reverse('device-datapoint-list', kwargs={'device_id': "00000000-00000000-00000000-00000001", 'stream_id': "00000000-00000000-00000000-00000001/DIO/0"}))
         self.assertEqual(resp.status_code, 200)
-        json_resp = json.loads(resp.content)
+        json_resp = self.streamed_json(resp)
         self.assertIsNotNone(json_resp)
         self.assertEqual(str(len(json_resp['items'])), json_resp['resultSize'])
         self.assertEqual(json_resp['items'][0]['data'], "0")
 
+    def credentials_setup(self):
+        # Pretend the view can decrypt credentials
+        patcher = patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+        patcher.start().return_value = ('existinguser', 'pass', 'existingserver')
+        self.addCleanup(patcher.stop)
+
+    def buffer_setup(self, monitored_for):
+        # Monitor the device
+        self.credentials_setup()
+        session = self.client.session
+        session['user_devices'] = [self.device_id]
+        session.save()
+        self.receiver = MagicMock()
+        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].connect(self.device_id, self.receiver)
+        self.addCleanup(MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect, self.device_id, self.receiver)
+        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'][self.device_id].created = time.time() - monitored_for
+        self.now = int(time.time()) * 1000
+        for offset, point_id in ((-20000, 'a'), (-10000, 'b')):
+            datapoint_buffer.add({'id': point_id, 'streamId': self.stream_id,
+                                  'timestamp': self.now + offset, 'data': 1})
+
+    device_id = "00000000-00000000-00000000-00000001"
+    stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+    path = reverse('device-datapoint-list', kwargs={'device_id': device_id, 'stream_id': stream_id})
+
+    def test_device_datapoint_read_from_buffer(self):
+        self.buffer_setup(monitored_for=3600)
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 15})
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(self.patched_get.called)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['resultSize'], "1")
+        self.assertEqual([p['id'] for p in json_resp['items']], ['b'])
+
+    def test_device_datapoint_read_buffer_gap(self):
+        # Buffer covers from 25s ago (30s monitored, minus grace), fetch before
+        self.buffer_setup(monitored_for=30)
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 60})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.patched_get.called)
+        params = self.patched_get.call_args[1]['params']
+        covered_from = params['endTime']
+        self.assertTrue(self.now - 26000 <= covered_from <= self.now - 24000)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual([p['id'] for p in json_resp['items']],
+                         ['6e6b1b57-d8f7-11e2-b0f0-4040463f606d', 'a', 'b'])
+        self.assertEqual(json_resp['resultSize'], "3")
+
+    def test_device_datapoint_read_not_own_device(self):
+        self.buffer_setup(monitored_for=3600)
+        session = self.client.session
+        session['user_devices'] = []
+        session.save()
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 15})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.patched_get.called)
+        self.assertFalse('endTime' in self.patched_get.call_args[1]['params'])
+        # Device Cloud's description of the query is passed through
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['requestedSize'], "1000")
+        self.assertEqual(json_resp['requestedStartTime'], "0")
+
+    def test_stream_datapoints_error(self):
+        def points():
+            yield {'id': 'a'}
+            raise ConnectionError()
+        resp = stream_datapoints(points(), {'requestedStartTime': '0'})
+        # Still valid JSON, ending with the error
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['items'], [{'id': 'a'}])
+        self.assertEqual(json_resp['resultSize'], "1")
+        self.assertEqual(json_resp['requestedStartTime'], "0")
+        self.assertIn('error', json_resp)
+        self.assertEqual(self.streamed_json(stream_datapoints([], {})),
+                         {'items': [], 'resultSize': "0"})
+
+
+    @override_settings(DATAPOINT_STORE={'ENABLED': True, 'SETTLE_TIME': 60, 'RETENTION_DAYS': 30})
+    def test_device_datapoint_read_from_store(self):
+        self.buffer_setup(monitored_for=3600)
+        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect(self.device_id, self.receiver)
+        result = json.loads(TEST_RESPONSES['DataPoint']['GET'])
+        result['items'][0]['timestamp'] = str(self.now - 1800000)
+        self.patched_get.return_value.json.return_value = result
+        start = self.now / 1000 - 3600
+        resp = self.client.get(self.path, {'startTime': start})
+        self.assertEqual(resp.status_code, 200)
+        # Whole range fetched from Device Cloud, and stored
+        params = self.patched_get.call_args[1]['params']
+        self.assertEqual(params['startTime'], start * 1000)
+        self.assertTrue(params['endTime'] >= self.now)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['items'][0]['data'], "0")
+        self.assertEqual(StoredDataPoint.objects.count(), 1)
+        # Settled part is now served locally, only the rest is fetched again
+        self.patched_get.reset_mock()
+        resp = self.client.get(self.path, {'startTime': start})
+        self.assertEqual(self.streamed_json(resp)['resultSize'], "1")
+        params = self.patched_get.call_args[1]['params']
+        self.assertTrue(self.now - 61000 <= params['startTime'] <= self.now - 59000)
+
+    @override_settings(DATAPOINT_STORE={'ENABLED': True, 'SETTLE_TIME': 0, 'RETENTION_DAYS': 30})
+    def test_device_datapoint_read_store_and_buffer(self):
+        # Monitored for 30s: store for before that, pushed points after
+        self.buffer_setup(monitored_for=30)
+        StoredRange.objects.create(stream_id=self.stream_id, start=0, end=self.now)
+        datapoint_store.save_points([{'id': 'old', 'streamId': self.stream_id,
+                                      'timestamp': self.now - 60000}])
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 120})
+        self.assertFalse(self.patched_get.called)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual([p['id'] for p in json_resp['items']], ['old', 'a', 'b'])
+
+    @override_settings(DATAPOINT_STORE={'ENABLED': True, 'SETTLE_TIME': 0, 'RETENTION_DAYS': 30})
+    def test_device_datapoint_read_store_write_failed(self):
+        self.buffer_setup(monitored_for=30)
+        datapoint_store.add_messages([{'DataPoint': {'id': 'a', 'streamId': self.stream_id,
+                                                     'timestamp': self.now - 20000}}])
+        with patch.object(datapoint_store, 'save_points', side_effect=DatabaseError()):
+            datapoint_store.flush()
+        self.addCleanup(datapoint_store._unstored.clear)
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 15})
+        self.assertEqual(resp.status_code, 200)
+        # The span of the lost point isn't recorded as stored
+        self.assertEqual(StoredRange.objects.filter(end__gt=self.now - 20000).count(), 0)
+
+    def test_device_datapoint_read_pages(self):
+        first = json.loads(TEST_RESPONSES['DataPoint']['GET'])
+        first['items'] = [dict(first['items'][0], id=str(i)) for i in range(1000)]
+        last = json.loads(TEST_RESPONSES['DataPoint']['GET'])
+        self.patched_get.return_value.json.side_effect = [first, last]
+        self.credentials_setup()
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['resultSize'], "1001")
+        self.assertEqual(len(json_resp['items']), 1001)
+        self.assertEqual(self.patched_get.call_count, 2)
+
+    def test_device_datapoint_read_error(self):
+        self.patched_get.return_value.raise_for_status.side_effect = HTTPError(response=MagicMock(status_code=404, text='Not found'))
+        self.credentials_setup()
+        resp = self.client.get(self.path)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_device_datapoint_read_rollup(self):
+        self.buffer_setup(monitored_for=3600)
+        datapoint_buffer.add({'id': 'c', 'streamId': self.stream_id,
+                              'timestamp': self.now - 5000, 'data': "4"})
+        resp = self.client.get(self.path, {'startTime': self.now / 1000 - 60,
+                                           'rollup': '1d', 'agg': 'max'})
+        self.assertEqual(resp.status_code, 200)
+        json_resp = self.streamed_json(resp)
+        self.assertEqual(json_resp['resultSize'], "1")
+        self.assertEqual(json_resp['items'][0]['data'], 4)
+
+    def test_device_datapoint_read_bad_downsample(self):
+        for params in ({'rollup': '1y'}, {'maxPoints': 'x'},
+                       {'agg': 'median', 'rollup': '1m'}, {'agg': 'lttb'}):
+            resp = self.client.get(self.path, params)
+            self.assertEqual(resp.status_code, 400)
+
+
+class DownsampleTest(TestCase):
+
+    def points(self, values, step=1000):
+        return [{'id': str(i), 'timestamp': str(i * step), 'data': str(value)}
+                for i, value in enumerate(values)]
+
+    def test_parse_params(self):
+        self.assertEqual(downsample.parse_params({}), {})
+        self.assertEqual(downsample.parse_params({'rollup': '5m', 'agg': 'min'}),
+                         {'rollup': 300000, 'agg': 'min'})
+        self.assertEqual(downsample.parse_params({'maxPoints': '10', 'agg': 'lttb'}),
+                         {'max_points': 10, 'agg': 'lttb'})
+        for params in ({'rollup': '0s'}, {'rollup': 'm'}, {'maxPoints': '2'},
+                       {'agg': 'lttb', 'rollup': '1m', 'maxPoints': '10'}):
+            self.assertRaises(ValueError, downsample.parse_params, params)
+
+    def test_rollup(self):
+        points = self.points([1, 2, 'x', 6, 'y'], step=30000)
+        for agg, values in (('avg', [1.5, 6.0, 'y']), ('min', [1.0, 6.0, 'y']),
+                            ('max', [2.0, 6.0, 'y']), ('last', ['2', '6', 'y'])):
+            result = list(downsample.downsample(points, 0, 100000, rollup=60000, agg=agg))
+            self.assertEqual([p['data'] for p in result], values)
+            self.assertEqual([p['timestamp'] for p in result], [0, 60000, 120000])
+
+    def test_max_points(self):
+        points = self.points(range(100))
+        self.assertEqual(len(list(downsample.downsample(points, 0, 100000, max_points=100))), 100)
+        result = list(downsample.downsample(points, 0, 100000, max_points=10))
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result[0]['data'], 4.5)
+
+    def test_max_points_lazy(self):
+        consumed = []
+        def points():
+            for point in self.points(range(100)):
+                consumed.append(point)
+                yield point
+        result = downsample.downsample(points(), 0, 100000, max_points=10)
+        self.assertEqual(next(iter(result))['data'], 4.5)
+        # Only the first buckets were read
+        self.assertTrue(len(consumed) < 20)
+
+    def test_rollup_max_points(self):
+        # 1 sample in the first minute, 3 in the second
+        points = [{'timestamp': str(timestamp), 'data': str(value)} for timestamp, value in
+                  ((0, 0), (60000, 10), (70000, 10), (80000, 10))]
+        result = list(downsample.downsample(points, 0, 240000, rollup=60000,
+                                            max_points=1))
+        # Average of the samples, not of the minutes' averages
+        self.assertEqual([p['data'] for p in result], [7.5])
+
+    def test_lttb(self):
+        values = [0] * 50 + [10] + [0] * 49
+        result = downsample.downsample(self.points(values), 0, 100000,
+                                       max_points=5, agg='lttb')
+        self.assertEqual(len(result), 5)
+        # Ends are kept, and so is the spike
+        self.assertEqual(result[0]['id'], '0')
+        self.assertEqual(result[-1]['id'], '99')
+        self.assertTrue('50' in [p['id'] for p in result])
+
+
+class DataPointStoreTest(TestCase):
+
+    stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+
+    def point(self, point_id, timestamp):
+        return {'id': point_id, 'streamId': self.stream_id,
+                'timestamp': timestamp, 'data': point_id}
+
+    def test_missing_ranges(self):
+        self.assertEqual(missing_ranges(0, 100, []), [(0, 100)])
+        self.assertEqual(missing_ranges(0, 100, [(10, 20), (30, 40), (90, 200)]),
+                         [(0, 10), (20, 30), (40, 90)])
+        self.assertEqual(missing_ranges(15, 35, [(10, 20), (30, 40)]), [(20, 30)])
+        self.assertEqual(missing_ranges(0, 100, [(-10, 200)]), [])
+
+    def test_save_points(self):
+        datapoint_store.save_points([self.point('b', 2000), self.point('a', "1000"),
+                                     {'streamId': self.stream_id, 'timestamp': 'bad'}])
+        # Already stored
+        datapoint_store.save_points([self.point('a', 1000), self.point('c', 3000)])
+        points = list(datapoint_store.points(self.stream_id, 0, 3000))
+        self.assertEqual([p['id'] for p in points], ['a', 'b'])
+        self.assertEqual(StoredDataPoint.objects.count(), 3)
+
+    def test_pushed_points(self):
+        datapoint_store.add_messages([{'DataPoint': self.point('a', 1000)},
+                                      {'DeviceCore': {}}])
+        self.assertEqual(StoredDataPoint.objects.count(), 0)
+        datapoint_store.flush()
+        self.assertEqual(StoredDataPoint.objects.count(), 1)
+
+    def test_pushed_points_error(self):
+        store = DataPointStore()
+        store.add_messages([{'DataPoint': self.point('b', 2000)},
+                            {'DataPoint': self.point('a', 1000)}])
+        with patch.object(store, 'save_points', side_effect=DatabaseError()):
+            self.assertFalse(store.flush())
+        self.assertEqual(store.unstored_from(self.stream_id, 0), 1000)
+        self.assertEqual(store.unstored_from('other', 0), None)
+        self.assertTrue(store.flush())
+        # Left to be backfilled once pushes start after them
+        self.assertEqual(store.unstored_from(self.stream_id, 1500), None)
+        self.assertEqual(store.unstored_from(self.stream_id, 0), None)
+
+    def test_ranges(self):
+        datapoint_store.add_range(self.stream_id, 100, 200)
+        datapoint_store.add_range(self.stream_id, 300, 400)
+        datapoint_store.add_range('other', 0, 1000)
+        self.assertEqual(datapoint_store.ranges(self.stream_id, 0, 1000),
+                         [(100, 200), (300, 400)])
+        # Merges overlapping and adjacent ranges
+        datapoint_store.add_range(self.stream_id, 150, 300)
+        self.assertEqual(datapoint_store.ranges(self.stream_id, 0, 1000), [(100, 400)])
+        self.assertEqual(datapoint_store.ranges(self.stream_id, 400, 1000), [])
+
+    def test_prune(self):
+        datapoint_store.save_points([self.point('a', 1000), self.point('b', 3000)])
+        datapoint_store.add_range(self.stream_id, 0, 1500)
+        datapoint_store.add_range(self.stream_id, 1800, 4000)
+        self.assertEqual(datapoint_store.prune(2000), 1)
+        self.assertEqual(datapoint_store.ranges(self.stream_id, 0, 5000), [(2000, 4000)])
+        self.assertEqual(StoredDataPoint.objects.get().point_id, 'b')
+
+    def test_prune_command(self):
+        datapoint_store.save_points([self.point('a', 1000), self.point('b', int(time.time() * 1000))])
+        call_command('prune_datapoints', days=1, stdout=StringIO())
+        self.assertEqual(StoredDataPoint.objects.get().point_id, 'b')
+
+
+class DataPointBufferTest(TestCase):
+
+    stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+
+    def setUp(self):
+        self.signals = SignalDict(['device_id', 'data'])
+        self.buffer = DataPointBuffer(self.signals, max_points=2, grace=5)
+        self.receiver = MagicMock()
+
+    def point(self, point_id, timestamp):
+        return {'id': point_id, 'streamId': self.stream_id,
+                'timestamp': timestamp}
+
+    def test_points(self):
+        # Out of order, duplicate and malformed points
+        self.buffer.add(self.point('b', 2000))
+        self.buffer.add(self.point('a', "1000"))
+        self.buffer.add(self.point('a', "1000"))
+        self.buffer.add({'streamId': self.stream_id, 'timestamp': 'bad'})
+        self.assertEqual([p['id'] for p in self.buffer.points(self.stream_id, 0)], ['a', 'b'])
+        self.assertEqual([p['id'] for p in self.buffer.points(self.stream_id, 1500)], ['b'])
+        self.assertEqual(self.buffer.points('other', 0), [])
+
+    def test_add_messages(self):
+        self.buffer.add_messages([{'DataPoint': self.point('a', 1000)},
+                                  {'DeviceCore': {}}])
+        self.assertEqual(len(self.buffer.points(self.stream_id, 0)), 1)
+
+    def test_covered_from(self):
+        # Not monitored
+        self.assertEqual(self.buffer.covered_from(self.stream_id), None)
+        self.assertEqual(self.buffer.covered_from('nodevice'), None)
+        self.signals.connect('00000000-00000000-00000000-00000001', self.receiver)
+        signal = self.signals['00000000-00000000-00000000-00000001']
+        signal.created = 100
+        self.assertEqual(self.buffer.covered_from(self.stream_id), 105000)
+        # Points evicted for room leave a gap
+        for point_id, timestamp in (('a', 200000), ('b', 300000), ('c', 400000)):
+            self.buffer.add(self.point(point_id, timestamp))
+        self.assertEqual(self.buffer.covered_from(self.stream_id), 200001)
+        self.signals.disconnect('00000000-00000000-00000000-00000001', self.receiver)
+        self.assertEqual(self.buffer.covered_from(self.stream_id), None)
+
 
 # ******************************
 #            Device Serial
@@ -590,6 +1250,8 @@ class MonitorReceiverTest(APITestCase):
         MONITOR_TOPIC_SIGNAL_MAP['DataPoint']['00000000-00000000-00000000-00000001'].connect(receiver_mock)
         resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
         self.assertEqual(resp.status_code, 200)
+        # Receivers are notified asynchronously
+        push_queue.join()
         # Check that the signal reciever was called properly
         self.assertTrue(receiver_mock.called)
         self.assertEqual(receiver_mock.call_count, 1)
@@ -597,6 +1259,22 @@ class MonitorReceiverTest(APITestCase):
         self.assertEqual(kwargs['device_id'], '00000000-00000000-00000000-00000001')
         self.assertEqual(kwargs['data'], self.mon_push_body["Document"]["Msg"])
 
+    def test_receiver_refused_kicks_monitors(self):
+        conn = MagicMock(cloud_fqdn='cloud')
+        find = MagicMock(return_value={'resultSize': '1', 'items': [{'monId': '00001'}]})
+        setup = lambda: setup_monitor(conn, 'user', 'DataPoint/dev', 'url',
+                                      find=find, create=MagicMock())
+        setup()
+        setup()
+        self.assertEqual(conn.kick_monitor.call_count, 1)
+        # For a device nobody listens to
+        body = json.loads(self.mon_push_content.replace('00000001', '0000000B'))
+        resp = self.client.put(self.path, body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 503)
+        # Resubscribing kicks the backed off monitor
+        setup()
+        self.assertEqual(conn.kick_monitor.call_count, 2)
+
     def test_reciever_other_resource(self):
         other_body = """{
                           "Document": {
@@ -612,6 +1290,340 @@ class MonitorReceiverTest(APITestCase):
         self.assertEqual(resp.status_code, 503)
         self.assertFalse(receiver_mock.called)
 
+    def test_receiver_queue_full(self):
+        receiver_mock = MagicMock()
+        MONITOR_TOPIC_SIGNAL_MAP['DataPoint']['00000000-00000000-00000000-00000001'].connect(receiver_mock)
+        full_queue = PushQueue(max_size=1, workers=0, overflow='reject')
+        full_queue.put([])
+        with patch.object(push_broker, 'queue', full_queue):
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(receiver_mock.called)
+
+    @override_settings(MONITOR_DATAPOINT_SCOPE='account')
+    def test_receiver_account_partly_listened(self):
+        signal_maps = {'DataPoint': SignalDict(['device_id', 'data']),
+                       'DeviceCore': SignalDict(['device_id', 'data'])}
+        receiver_mock = MagicMock()
+        signal_maps['DataPoint']['00000000-00000000-00000000-00000001'].connect(receiver_mock)
+        body = json.loads(self.mon_push_content.replace('00000001', '00000002'))
+        other_account = json.loads(self.mon_push_content.replace('00000001', '00000003')
+                                   .replace('"1\\/', '"2\\/'))
+        with patch.object(push_broker, 'router', PushRouter(signal_maps)):
+            # The listened device's account may be the same, drop the push
+            resp = self.client.put(self.path, body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 200)
+            resp = self.client.put(self.path, self.mon_push_body, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 200)
+            push_queue.join()
+            self.assertEqual(receiver_mock.call_count, 1)
+            # Now known to be on account 1, nobody listens to account 2
+            resp = self.client.put(self.path, other_account, **{'HTTP_AUTHORIZATION': self.good_auth_header})
+            self.assertEqual(resp.status_code, 503)
+
+class PushQueueTest(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.dispatch = MagicMock()
+
+    def test_dispatch(self):
+        queue = PushQueue(max_size=10, workers=2, dispatch=self.dispatch)
+        self.assertTrue(queue.put(['a']))
+        self.assertTrue(queue.put(['b']))
+        queue.join()
+        self.assertEqual(self.dispatch.call_count, 2)
+        self.dispatch.assert_any_call(['a'])
+        self.dispatch.assert_any_call(['b'])
+        self.assertEqual(len(queue), 0)
+        stats = metrics.snapshot()
+        self.assertEqual(stats['counters']['push.enqueued'], 2)
+        self.assertEqual(stats['gauges']['push.queue_depth'], 0)
+        self.assertEqual(stats['timings']['push.queue_latency']['count'], 2)
+
+    def test_dispatch_error(self):
+        # A failing dispatch shouldn't stop later batches
+        self.dispatch.side_effect = [Exception('boom'), None]
+        queue = PushQueue(max_size=10, workers=1, dispatch=self.dispatch)
+        queue.put(['a'])
+        queue.put(['b'])
+        queue.join()
+        self.assertEqual(self.dispatch.call_count, 2)
+
+    def test_overflow_drop_oldest(self):
+        # No dispatchers, so nothing drains the queue
+        queue = PushQueue(max_size=2, workers=0, overflow='drop-oldest',
+                          dispatch=self.dispatch)
+        for batch in (['a'], ['b'], ['c']):
+            self.assertTrue(queue.put(batch))
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(metrics.snapshot()['counters']['push.dropped'], 1)
+        queue.workers = 1
+        queue._start_dispatchers()
+        queue.join()
+        self.assertEqual([args[0] for args, kwargs in self.dispatch.call_args_list],
+                         [['b'], ['c']])
+
+    def test_overflow_reject(self):
+        queue = PushQueue(max_size=1, workers=0, overflow='reject',
+                          dispatch=self.dispatch)
+        self.assertTrue(queue.put(['a']))
+        self.assertFalse(queue.put(['b']))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(metrics.snapshot()['counters']['push.dropped'], 1)
+
+    def test_overflow_block(self):
+        queue = PushQueue(max_size=1, workers=0, overflow='block',
+                          block_timeout=0.01, dispatch=self.dispatch)
+        self.assertTrue(queue.put(['a']))
+        # Times out waiting for room
+        self.assertFalse(queue.put(['b']))
+        # Room is made while blocked
+        gevent.spawn_later(0.01, queue._queue.get)
+        queue.block_timeout = 1
+        self.assertTrue(queue.put(['c']))
+
+    def test_bad_policy(self):
+        self.assertRaises(ImproperlyConfigured, PushQueue, overflow='bogus')
+
+class PushRouterTest(TestCase):
+
+    device_id = '00000000-00000000-00000000-00000001'
+
+    def setUp(self):
+        self.signal_maps = {
+            'DataPoint': SignalDict(['device_id', 'data']),
+            'DeviceCore': SignalDict(['device_id', 'data']),
+        }
+        self.router = PushRouter(self.signal_maps, cache_size=2)
+        self.receiver = MagicMock()
+
+    def test_route_topic(self):
+        self.assertEqual(
+            self.router.route_topic('1/DataPoint/dia/channel/%s/DIO/0' % self.device_id),
+            ('DataPoint', self.device_id))
+        # Quoted subtopic
+        self.assertEqual(
+            self.router.route_topic('1/DataPoint/dia%%2Fchannel%%2F%s%%2FDIO%%2F0' % self.device_id),
+            ('DataPoint', self.device_id))
+        self.assertEqual(self.router.route_topic('1/DataPoint/nodevice'),
+                         ('DataPoint', None))
+        self.assertEqual(self.router.route_topic('1/DeviceCore/123'),
+                         ('DeviceCore', None))
+        self.assertEqual(self.router.route_topic('bad'), (None, None))
+
+    def test_route_topic_memoized(self):
+        topic = '1/DataPoint/dia/channel/%s/DIO/0' % self.device_id
+        self.router.route_topic(topic)
+        with patch.object(self.router, '_parse_topic') as parse_mock:
+            self.assertEqual(self.router.route_topic(topic),
+                             ('DataPoint', self.device_id))
+            self.assertFalse(parse_mock.called)
+
+    def test_route(self):
+        self.signal_maps['DataPoint'][self.device_id].connect(self.receiver)
+        self.signal_maps['DeviceCore'][self.device_id].connect(self.receiver)
+        datapoint = {'topic': '1/DataPoint/dia/channel/%s/DIO/0' % self.device_id}
+        devicecore = {'topic': '1/DeviceCore/123',
+                      'DeviceCore': {'devConnectwareId': self.device_id}}
+        other = {'topic': '1/OtherTopic/'}
+        batch = self.router.route([datapoint, devicecore, other])
+        self.assertEqual(batch, [
+            (self.signal_maps['DataPoint'][self.device_id],
+             {'device_id': self.device_id, 'data': datapoint}),
+            (self.signal_maps['DeviceCore'][self.device_id],
+             {'device_id': self.device_id, 'data': devicecore}),
+        ])
+
+    def test_has_subscribers(self):
+        subs = set([('DataPoint', self.device_id)])
+        self.assertTrue(self.router.has_subscribers('1', subs))
+        self.router.route([{'topic': '1/DataPoint/dia/channel/%s/DIO/0' % self.device_id}])
+        self.assertTrue(self.router.has_subscribers('1', subs))
+        self.assertFalse(self.router.has_subscribers('2', subs))
+        self.assertFalse(self.router.has_subscribers('1', set()))
+
+    def test_route_no_listeners(self):
+        msg = {'topic': '1/DataPoint/dia/channel/%s/DIO/0' % self.device_id}
+        self.assertEqual(self.router.route([msg]), [])
+        # Shouldn't create signals for devices nobody listens to
+        self.assertFalse(self.device_id in self.signal_maps['DataPoint'])
+
+    def test_route_missing_topic(self):
+        self.assertRaises(KeyError, self.router.route, [{}])
+
+class SignalDictTest(TestCase):
+
+    device_id = '00000000-00000000-00000000-00000001'
+
+    def setUp(self):
+        metrics.reset()
+        self.signals = SignalDict(['device_id', 'data'], name='Test')
+
+    def test_get_does_not_allocate(self):
+        self.assertEqual(self.signals.get(self.device_id), None)
+        self.assertEqual(len(self.signals), 0)
+
+    def test_connect_disconnect(self):
+        receiver = MagicMock()
+        other = MagicMock()
+        self.signals.connect(self.device_id, receiver)
+        self.signals.connect(self.device_id, other)
+        self.assertEqual(len(self.signals), 1)
+        self.assertEqual(metrics.snapshot()['gauges']['signals.Test.size'], 1)
+        self.signals[self.device_id].send(device_id=self.device_id, data=1)
+        self.assertTrue(receiver.called)
+        self.signals.disconnect(self.device_id, receiver)
+        self.assertTrue(self.device_id in self.signals)
+        # Dropped with its last receiver
+        self.signals.disconnect(self.device_id, other)
+        self.assertFalse(self.device_id in self.signals)
+        self.assertEqual(metrics.snapshot()['gauges']['signals.Test.size'], 0)
+        # Disconnecting an unknown device is harmless
+        self.signals.disconnect(self.device_id, other)
+
+    def test_signal_disconnect(self):
+        receiver = MagicMock()
+        self.signals[self.device_id].connect(receiver)
+        self.signals[self.device_id].disconnect(receiver)
+        self.assertEqual(len(self.signals), 0)
+
+    def test_receiver_collected(self):
+        class Receiver(object):
+            def __call__(self, **kwargs):
+                pass
+        receiver = Receiver()
+        self.signals.connect(self.device_id, receiver)
+        self.assertEqual(len(self.signals), 1)
+        del receiver
+        self.assertEqual(len(self.signals), 0)
+
+    def test_bound_method_receiver(self):
+        class Namespace(object):
+            def __init__(self):
+                self.received = []
+            def receiver(self, **kwargs):
+                self.received.append(kwargs)
+        namespace = Namespace()
+        self.signals.connect(self.device_id, namespace.receiver)
+        # Connecting the same method twice only registers it once
+        self.signals.connect(self.device_id, namespace.receiver)
+        self.signals[self.device_id].send(device_id=self.device_id, data=1)
+        self.assertEqual(namespace.received, [{'device_id': self.device_id, 'data': 1}])
+        del namespace
+        self.assertEqual(len(self.signals), 0)
+
+    def test_receiver_error_isolated(self):
+        failing = MagicMock(side_effect=Exception('boom'))
+        receiver = MagicMock()
+        self.signals.connect(self.device_id, failing)
+        self.signals.connect(self.device_id, receiver)
+        errors = self.signals[self.device_id].send(device_id=self.device_id, data=1)
+        self.assertEqual(errors, 1)
+        receiver.assert_called_once_with(device_id=self.device_id, data=1)
+
+class UnixSocketBrokerTest(TestCase):
+
+    device_id = '00000000-00000000-00000000-00000001'
+
+    def make_broker(self, name, signal_maps=None):
+        if signal_maps is None:
+            signal_maps = {'DataPoint': SignalDict(['device_id', 'data'])}
+        broker = UnixSocketBroker(self.path, name=name,
+                                  router=PushRouter(signal_maps),
+                                  queue=PushQueue(max_size=10, workers=1))
+        self.brokers.append(broker)
+        return broker
+
+    def msg(self, device_id):
+        return {'topic': '1/DataPoint/dia/channel/%s/DIO/0' % device_id}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.brokers = []
+        self.receiver_mock = MagicMock()
+        signal_maps = {'DataPoint': SignalDict(['device_id', 'data'])}
+        signal_maps['DataPoint'].connect(self.device_id, self.receiver_mock)
+        self.subscriber = self.make_broker('subscriber', signal_maps)
+        self.subscriber.start()
+
+    def tearDown(self):
+        for broker in self.brokers:
+            broker.stop()
+        shutil.rmtree(self.path)
+
+    def test_path_permissions(self):
+        # Created if missing, only accessible to us
+        broker = self.make_broker('new')
+        broker.path = os.path.join(self.path, 'new')
+        broker.start()
+        self.assertEqual(stat.S_IMODE(os.stat(broker.path).st_mode), 0700)
+        # Or made so
+        broker = self.make_broker('open')
+        broker.path = os.path.join(self.path, 'open')
+        os.mkdir(broker.path)
+        os.chmod(broker.path, 0777)
+        broker.start()
+        self.assertEqual(stat.S_IMODE(os.stat(broker.path).st_mode), 0700)
+        # Refused if owned by someone else
+        broker = self.make_broker('other_user')
+        broker.path = os.path.join(self.path, 'other_user')
+        os.mkdir(broker.path)
+        with patch('os.getuid', return_value=os.getuid() + 1):
+            self.assertRaises(ImproperlyConfigured, broker.start)
+
+    def test_forward(self):
+        publisher = self.make_broker('publisher')
+        msg = self.msg(self.device_id)
+        accepted = publisher.publish([msg, self.msg('00000000-00000000-00000000-00000002')])
+        self.assertEqual(accepted, 1)
+        with gevent.Timeout(2):
+            while not self.receiver_mock.called:
+                gevent.sleep(0.01)
+        self.receiver_mock.assert_called_once_with(device_id=self.device_id, data=msg)
+
+    def test_no_subscribers(self):
+        publisher = self.make_broker('publisher')
+        accepted = publisher.publish([self.msg('00000000-00000000-00000000-00000002')])
+        self.assertEqual(accepted, 0)
+
+    def test_subscriptions_changed(self):
+        publisher = self.make_broker('publisher')
+        self.subscriber.router.signal_maps['DataPoint'].disconnect(self.device_id, self.receiver_mock)
+        self.subscriber.subscriptions_changed()
+        gevent.sleep(0)
+        self.assertEqual(publisher.publish([self.msg(self.device_id)]), 0)
+
+    def test_stale_peer(self):
+        # Peer process that's gone, leaving its subscriptions behind
+        self.subscriber.stop()
+        stale_subs = os.path.join(self.path, '99999999.subs')
+        with open(stale_subs, 'w') as f:
+            json.dump([['DataPoint', self.device_id]], f)
+        publisher = self.make_broker('publisher')
+        self.assertEqual(publisher.publish([self.msg(self.device_id)]), 0)
+        self.assertFalse(os.path.exists(stale_subs))
+
+    def test_peer_not_keeping_up(self):
+        # The subscriber stops reading, until its socket buffer is full
+        self.subscriber._listener.kill()
+        metrics.reset()
+        publisher = self.make_broker('publisher')
+        msg = self.msg(self.device_id)
+        with gevent.Timeout(2):
+            while not metrics.snapshot()['counters'].get('broker.dropped'):
+                publisher.publish([msg])
+        # Dropped rather than waited on
+        self.assertEqual(publisher.publish([msg]), 0)
+
+    def test_chunks(self):
+        publisher = self.make_broker('publisher')
+        publisher.MAX_DATAGRAM = 150
+        messages = [self.msg(self.device_id) for i in range(3)]
+        chunks = list(publisher._chunks(messages))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(sum([json.loads(c) for c in chunks], []), messages)
+
 class MonitorSetupTest(MockedCloudAuthenticatedTestCase):
 
     path = reverse('monitor_setup', kwargs={'device_id': "00000000-00000000-00000000-00000001"})
@@ -667,6 +1679,24 @@ class MonitorSetupTest(MockedCloudAuthenticatedTestCase):
         self.assertTrue(self.patched_put.called)
         self.assertEqual(self.patched_put.call_count, 1)
 
+    @patch('xbgw_dashboard.apps.dashboard.views.get_credentials')
+    def test_setup_kicks_without_subscribers(self, patched_credentials):
+        patched_credentials.return_value = ('user', 'pass', 'cloud')
+        device_id = "00000000-00000000-00000000-0000000A"
+        path = reverse('monitor_setup', kwargs={'device_id': device_id})
+        # Nobody is listening for the device here, so it's kicked every time
+        self.client.get(path)
+        self.client.get(path)
+        self.assertEqual(self.patched_put.call_count, 2)
+        # Until somebody is
+        receiver = MagicMock()
+        MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].connect(device_id, receiver)
+        self.addCleanup(MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].disconnect,
+                        device_id, receiver)
+        self.client.get(path)
+        self.assertEqual(self.patched_put.call_count, 2)
+        self.assertEqual(self.patched_get.call_count, 1)
+
 class MonitorDeviceCoreSetupTest(MockedCloudAuthenticatedTestCase):
 
     path = reverse('monitor_setup_devicecore')
@@ -723,10 +1753,203 @@ class MonitorDeviceCoreSetupTest(MockedCloudAuthenticatedTestCase):
         self.assertEqual(self.patched_put.call_count, 1)
 
 
+class MonitorRegistryTest(TestCase):
+
+    def setUp(self):
+        monitor_registry.clear()
+        self.conn = MagicMock(cloud_fqdn='cloud')
+        self.find = MagicMock(return_value={
+            'resultSize': '1', 'items': [{'monId': '00001'}]})
+        self.create = MagicMock(return_value={'location': 'Monitor/00002'})
+
+    def setup(self, topic='DataPoint/dev'):
+        return setup_monitor(self.conn, 'user', topic, 'url',
+                             find=self.find, create=self.create)
+
+    def test_existing_monitor_remembered(self):
+        resp = self.setup()
+        self.assertEqual(resp['items'][0]['monId'], '00001')
+        self.assertEqual(self.find.call_count, 1)
+        self.assertEqual(self.conn.kick_monitor.call_count, 1)
+        # Second setup within the kick window makes no Device Cloud calls
+        self.assertEqual(self.setup(), resp)
+        self.assertEqual(self.find.call_count, 1)
+        self.assertEqual(self.conn.kick_monitor.call_count, 1)
+        # Other topics are tracked separately
+        self.setup(topic='DataPoint/dev2')
+        self.assertEqual(self.find.call_count, 2)
+
+    def test_created_monitor_remembered(self):
+        self.find.return_value = {'resultSize': '0', 'items': []}
+        self.assertEqual(self.setup(), self.create.return_value)
+        self.setup()
+        self.assertEqual(self.create.call_count, 1)
+        self.assertEqual(self.find.call_count, 1)
+        self.assertEqual(
+            monitor_registry.get(('user', 'cloud', 'DataPoint/dev', 'url'))
+            .mon_id, '00002')
+
+    def test_created_monitor_reply(self):
+        # As parsed from Device Cloud's reply to the Monitor POST
+        reply = xmlparse.parse('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+                               '<result>\n  <location>Monitor/00003</location>\n</result>')
+        self.find.return_value = {'resultSize': '0', 'items': []}
+        self.create.return_value = reply
+        self.setup()
+        self.assertEqual(
+            monitor_registry.get(('user', 'cloud', 'DataPoint/dev', 'url'))
+            .mon_id, '00003')
+
+    @patch('xbgw_dashboard.apps.dashboard.monitors.time.time')
+    def test_kick_after_backoff(self, patched_time):
+        patched_time.return_value = 1000
+        self.setup()
+        # A push was refused, so the monitor is backed off
+        patched_time.return_value = 1010
+        monitor_registry.backed_off()
+        self.setup()
+        self.assertEqual(self.conn.kick_monitor.call_count, 2)
+        # Kicked since, so not again
+        patched_time.return_value = 1020
+        self.setup()
+        self.assertEqual(self.conn.kick_monitor.call_count, 2)
+        # Unless asked to
+        setup_monitor(self.conn, 'user', 'DataPoint/dev', 'url',
+                      find=self.find, create=self.create, kick=True)
+        self.assertEqual(self.conn.kick_monitor.call_count, 3)
+        self.assertEqual(self.find.call_count, 1)
+
+    @patch('xbgw_dashboard.apps.dashboard.monitors.time.time')
+    def test_kick_after_interval(self, patched_time):
+        patched_time.return_value = 1000
+        self.setup()
+        patched_time.return_value = 1000 + settings.MONITOR_KICK_INTERVAL
+        self.setup()
+        self.assertEqual(self.find.call_count, 1)
+        self.assertEqual(self.conn.kick_monitor.call_count, 2)
+        self.conn.kick_monitor.assert_called_with(
+            '00001', settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
+            settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
+
+    @patch('xbgw_dashboard.apps.dashboard.monitors.time.time')
+    def test_kick_error_rechecks(self, patched_time):
+        patched_time.return_value = 1000
+        self.setup()
+        patched_time.return_value = 1000 + settings.MONITOR_KICK_INTERVAL
+        self.conn.kick_monitor.side_effect = [HTTPError(), None]
+        self.setup()
+        self.assertEqual(self.find.call_count, 2)
+        self.assertEqual(self.conn.kick_monitor.call_count, 3)
+
+
+class MonitorMigrationTest(TestCase):
+
+    def test_remove_device_datapoint_monitors(self):
+        conn = MagicMock(cloud_fqdn='cloud')
+        conn.get_monitors.return_value = {'items': [
+            {'monId': '1', 'monTopic': 'DataPoint/dev1'},
+            {'monId': '2', 'monTopic': 'DataPoint'},
+            {'monId': '3', 'monTopic': '[operation=U]DeviceCore'},
+            {'monId': '4', 'monTopic': 'DataPoint/dev2'},
+        ]}
+        monitor_registry.record(('user', 'cloud', 'DataPoint/dev1', 'url'),
+                                '1', {})
+        deleted = remove_device_datapoint_monitors(conn, 'user', 'url')
+        self.assertEqual(deleted, 2)
+        conn.get_monitors.assert_called_with(urls=['url'])
+        self.assertEqual([c[0][0] for c in conn.delete_monitor.call_args_list],
+                         ['1', '4'])
+        self.assertIsNone(
+            monitor_registry.get(('user', 'cloud', 'DataPoint/dev1', 'url')))
+
+
 # ******************************
 #            Sockets
 # ******************************
 
+class StockConfigJobTest(TestCase):
+
+    def setUp(self):
+        self.conn = MagicMock()
+        self.conn.get_device_settings.side_effect = self.settings
+        self.conn.set_device_settings.return_value = {'sci_reply': {}}
+        self.events = []
+
+    def settings(self, device_id, radio):
+        if radio == '02':
+            return {'sci_reply': {'error': 'timeout'}}
+        # Nothing set, so the whole stock configuration is applied
+        return {'sci_reply': {'send_message': {'device': {'rci_reply': {
+            'do_command': {'query_setting': {}}}}}}}
+
+    def listener(self, name, event):
+        self.events.append((name, event))
+
+    def run_job(self, radios, cancel=False):
+        job = StockConfigJob(('user', 'cloud'), self.conn, 'gw', radios,
+                             concurrency=2, rate=0)
+        job.follow(self.listener)
+        if cancel:
+            job.cancel()
+        job.start()
+        job.join()
+        return job
+
+    def test_job_runs(self):
+        job = self.run_job(['01', '02'])
+        self.assertEqual([name for name, _ in self.events],
+                         ['job_started', 'job_progress', 'job_progress', 'job_done'])
+        self.assertEqual([event['seq'] for _, event in self.events], [1, 2, 3, 4])
+        self.assertEqual(self.events[-1][1]['results'], {'01': 200, '02': 500})
+        self.assertEqual(self.events[-1][1]['id'], job.id)
+        self.assertEqual(self.conn.set_device_settings.call_count, 1)
+        self.assertIn('diff_applied', job.results['01']['data'])
+
+    def test_resume(self):
+        job = self.run_job(['01', '02'])
+        resumed = []
+        job.follow(lambda name, event: resumed.append(event['seq']), after=2)
+        self.assertEqual(resumed, [3, 4])
+        self.assertFalse(job.listeners)
+
+    def test_cancel(self):
+        self.run_job(['01', '02'], cancel=True)
+        self.assertEqual([name for name, _ in self.events], ['job_started', 'job_done'])
+        self.assertTrue(self.events[-1][1]['cancelled'])
+        self.assertFalse(self.conn.get_device_settings.called)
+
+    @patch('xbgw_dashboard.apps.dashboard.jobs.gevent.sleep')
+    @patch('xbgw_dashboard.apps.dashboard.jobs.time.time')
+    def test_rate_limiter(self, patched_time, patched_sleep):
+        patched_time.return_value = 1000
+        throttle = RateLimiter(10)
+        for _ in range(3):
+            throttle()
+        self.assertEqual([round(c[0][0], 3) for c in patched_sleep.call_args_list], [0.1, 0.2])
+
+    def test_registry_owner(self):
+        registry = JobRegistry()
+        job = StockConfigJob(('user', 'cloud'), self.conn, 'gw', [])
+        registry.add(job)
+        self.assertIs(registry.get(job.id, ('user', 'cloud')), job)
+        self.assertIsNone(registry.get(job.id, ('other', 'cloud')))
+
+    def test_registry_limits(self):
+        registry = JobRegistry(max_running=1, rate=10)
+        owner = ('user', 'cloud')
+        # An owner's jobs share one rate limit
+        throttle = registry.throttle(owner)
+        self.assertIs(registry.throttle(owner), throttle)
+        self.assertIsNot(registry.throttle(('other', 'cloud')), throttle)
+        job = StockConfigJob(owner, self.conn, 'gw', [], throttle=throttle)
+        registry.add(job)
+        self.assertFalse(registry.can_start(owner))
+        self.assertTrue(registry.can_start(('other', 'cloud')))
+        job.start()
+        job.join()
+        self.assertTrue(registry.can_start(owner))
+
+
 class MockSocketIOServer(object):
     """Mock a SocketIO server"""
 
@@ -763,6 +1986,131 @@ class DeviceNamespaceTest(TestCase):
         self.ns.process_packet(pkt)
         assert self.environ['socketio'].error.called
 
+    @patch('xbgw_dashboard.apps.dashboard.sockets.monitor_setup')
+    def test_start_monitoring_concurrently(self, patched_setup):
+        in_flight = [0]
+        max_in_flight = [0]
+
+        def fake_setup(request, device_id):
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            gevent.sleep(0.01)
+            in_flight[0] -= 1
+            return MagicMock(status_code=500 if device_id == 'bad' else 200)
+        patched_setup.side_effect = fake_setup
+
+        self.ns.request = MagicMock()
+        self.ns.request.session = {'user_devices': ['dev1', 'dev2', 'bad']}
+        self.ns.monitored_devices = set()
+        self.ns.emit = MagicMock()
+        self.addCleanup(self.ns.disconnect, silent=True)
+
+        self.ns.on_startmonitoringdevice('dev1', 'dev2', 'dev1', 'bad',
+                                         'notmine')
+
+        self.assertEqual(patched_setup.call_count, 3)
+        self.assertEqual(max_in_flight[0], 3)
+        self.assertEqual(self.ns.monitored_devices, set(['dev1', 'dev2']))
+        events = [c[0][0] for c in self.ns.emit.call_args_list]
+        self.assertEqual(events.count('started_monitoring'), 2)
+        self.assertEqual(events.count('error'), 2)
+
+    @patch('xbgw_dashboard.apps.dashboard.sockets.monitor_setup')
+    def test_start_monitoring_after_disconnect(self, patched_setup):
+        def fake_setup(request, device_id):
+            if device_id == 'dev1':
+                self.ns.disconnect(silent=True)
+            else:
+                gevent.sleep(10)
+            return MagicMock(status_code=200)
+        patched_setup.side_effect = fake_setup
+
+        self.ns.request = MagicMock()
+        self.ns.request.session = {'user_devices': ['dev1', 'dev2']}
+        self.ns.monitored_devices = set()
+        self.ns.emit = MagicMock()
+
+        handler = gevent.spawn(self.ns.on_startmonitoringdevice,
+                               'dev1', 'dev2')
+        gevent.sleep(0.01)
+        # The socket's handler is killed while dev2 is still being set up
+        handler.kill()
+
+        self.assertEqual(self.ns.monitored_devices, set())
+        self.assertIsNone(MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].get('dev1'))
+        self.assertFalse(self.ns.emit.called)
+
+    @patch('xbgw_dashboard.apps.dashboard.jobs.apply_stock_config')
+    @patch('xbgw_dashboard.apps.dashboard.sockets.xbee_index')
+    @patch('xbgw_dashboard.apps.dashboard.sockets.get_credentials')
+    def test_stock_config_job(self, patched_credentials, patched_index, patched_apply):
+        patched_credentials.return_value = ('user', 'pass', 'cloud')
+        patched_index.lookup.return_value = [{'xpExtAddr': '01'}, {'xpExtAddr': '02'}]
+        patched_apply.return_value = (200, None)
+        self.ns.request = MagicMock()
+        self.ns.request.session = {'user_devices': ['gw']}
+        self.ns.emit = MagicMock()
+        self.ns.monitored_devices = set()
+
+        self.ns.on_startstockconfigjob('notmine')
+        self.assertEqual(self.ns.emit.call_args[0][0], 'error')
+        for radios in ('0013A2', ['01', None], ["01'"]):
+            self.ns.on_startstockconfigjob('gw', radios)
+            self.assertEqual(self.ns.emit.call_args[0][0], 'error')
+        self.assertFalse(patched_apply.called)
+        self.ns.on_startstockconfigjob('gw')
+        job_id = self.ns.emit.call_args[0][1]['id']
+        job_registry.get(job_id, ('user', 'cloud')).join()
+        events = [c[0][0] for c in self.ns.emit.call_args_list[4:]]
+        self.assertEqual(events, ['job_started', 'job_progress', 'job_progress', 'job_done'])
+        self.assertEqual(patched_apply.call_count, 2)
+
+        # A new socket picks up where the old one left off
+        self.ns.disconnect(silent=True)
+        self.ns.emit.reset_mock()
+        self.ns.on_resumejob(job_id, 3)
+        self.assertEqual([c[0][0] for c in self.ns.emit.call_args_list], ['job_done'])
+        self.ns.on_resumejob('unknown')
+        self.ns.emit.assert_called_with('job_unknown', 'unknown')
+        for after in ('3', -1, 1.5, None, True):
+            self.ns.emit.reset_mock()
+            self.ns.on_resumejob(job_id, after)
+            self.assertEqual([c[0][0] for c in self.ns.emit.call_args_list], ['error'])
+
+    def setup_batching(self):
+        self.ns.request = MagicMock()
+        self.ns.monitored_devices = set(['dev1'])
+        self.ns.emit = MagicMock()
+        self.addCleanup(self.ns.disconnect, silent=True)
+        self.ns.on_enabledatabatching()
+
+    def test_device_data_unbatched(self):
+        self.ns.monitored_devices = set(['dev1'])
+        self.ns.emit = MagicMock()
+        self.ns.device_data_receiver(device_id='dev1', data=1)
+        self.ns.device_data_receiver(device_id='dev2', data=2)
+        self.ns.emit.assert_called_once_with('device_data', 1)
+
+    @override_settings(DEVICE_DATA_BATCH={'INTERVAL': 0.01, 'MAX_SIZE': 10})
+    def test_device_data_batch_interval(self):
+        self.setup_batching()
+        self.ns.device_data_receiver(device_id='dev1', data=1)
+        self.ns.device_data_receiver(device_id='dev2', data=2)
+        self.ns.device_data_receiver(device_id='dev1', data=3)
+        self.assertFalse(self.ns.emit.called)
+        gevent.sleep(0.05)
+        self.ns.emit.assert_called_once_with('device_data_batch', [1, 3])
+
+    @override_settings(DEVICE_DATA_BATCH={'INTERVAL': 10, 'MAX_SIZE': 2})
+    def test_device_data_batch_size(self):
+        self.setup_batching()
+        self.ns.device_data_receiver(device_id='dev1', data=1)
+        self.ns.device_data_receiver(device_id='dev1', data=2)
+        self.ns.emit.assert_called_once_with('device_data_batch', [1, 2])
+        self.assertEqual(self.ns.flush_timer, None)
+        self.ns.device_data_receiver(device_id='dev1', data=3)
+        self.assertNotEqual(self.ns.flush_timer, None)
+
 # ******************************
 #            API Browser
 # ******************************
@@ -780,6 +2128,7 @@ class UtilModuleTest(TestCase):
 
     def setUp(self):
         self.factory = RequestFactory()
+        util.credential_cache.clear()
 
     def test_get_credentials_no_cloud(self):
         request = self.factory.get('url')
@@ -798,7 +2147,38 @@ class UtilModuleTest(TestCase):
         self.assertEqual(password, 'pass')
         self.assertEqual(cloud, 'custom_cloud')
 
-    def test_key_search(self):
-        d = {'a': {'deeply': {'nested': {'dict': {'key': 'value'}}}}}
-        self.assertTrue(util.is_key_in_nested_dict(d, 'nested'))
-        self.assertFalse(util.is_key_in_nested_dict(d, 'nope'))
+    @patch('xbgw_dashboard.apps.dashboard.util.get_password_for_session')
+    def test_get_credentials_session_cached(self, patched_password):
+        patched_password.return_value = 'pass'
+        request = self.factory.get('url')
+        SessionMiddleware().process_request(request)
+        request.session.save()
+        request.user = MagicMock(username='user', cloud_fqdn='cloud')
+        for _ in range(2):
+            self.assertEqual(util.get_credentials(request), ('user', 'pass', 'cloud'))
+        self.assertEqual(patched_password.call_count, 1)
+        # Logging out forgets them
+        user_logged_out.send(sender=None, request=request, user=request.user)
+        util.get_credentials(request)
+        self.assertEqual(patched_password.call_count, 2)
+        # Failures aren't cached
+        user_logged_in.send(sender=None, request=request, user=request.user)
+        patched_password.return_value = None
+        util.get_credentials(request)
+        util.get_credentials(request)
+        self.assertEqual(patched_password.call_count, 4)
+
+    @patch('xbgw_dashboard.apps.dashboard.util.get_password_for_session')
+    def test_get_credentials_session_user(self, patched_password):
+        patched_password.return_value = 'pass'
+        request = self.factory.get('url')
+        SessionMiddleware().process_request(request)
+        request.session.save()
+        request.user = MagicMock(username='user', cloud_fqdn='cloud', pk=1)
+        util.get_credentials(request)
+        # The session cookie alone doesn't get the cached credentials
+        request.user.is_authenticated.return_value = False
+        util.get_credentials(request)
+        request.user = MagicMock(username='other', cloud_fqdn='cloud', pk=2)
+        util.get_credentials(request)
+        self.assertEqual(patched_password.call_count, 3)
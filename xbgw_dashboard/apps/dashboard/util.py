@@ -19,9 +19,37 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from Crypto.Cipher import AES
 import binascii
+from xbgw_dashboard.libs.digi.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# (session key, user pk) -> (username, password, cloud_fqdn), so requests of a
+# session don't decrypt its password again. Dropped on login and logout (see
+# signals.forget_credentials).
+credential_cache = TTLCache(ttl=settings.CREDENTIAL_CACHE['TTL'],
+                            max_size=settings.CREDENTIAL_CACHE['MAX_SESSIONS'])
+
+
+def credential_key(session_key, user):
+    """
+    Key of the credentials cached for user on session_key
+    """
+    return session_key, user.pk
+
+
+def _credential_key(request):
+    # Only sessions of an authenticated user have cached credentials, the
+    # cookie alone isn't enough
+    try:
+        if not request.user.is_authenticated():
+            return None
+        session_key = request.session.session_key
+    except AttributeError:
+        return None
+    if session_key is None:
+        return None
+    return credential_key(session_key, request.user)
+
 
 def get_password_for_session(request):
     """
@@ -67,14 +95,21 @@ def get_credentials(request):
     if not auth or auth[0].lower() != b'basic' or len(auth) != 2:
         # No authentication header, see if we can pull from session info
         # instead
+        key = _credential_key(request)
+        if key is not None:
+            credentials = credential_cache.get(key)
+            if credentials is not None:
+                return credentials
         try:
             username = request.user.username
             cloud_fqdn = request.user.cloud_fqdn
             password = get_password_for_session(request)
-            return username, password, cloud_fqdn
         except (AttributeError, KeyError):
             logger.error('Unable to determine credentials for request')
             return None, None, None
+        if key is not None and password is not None:
+            credential_cache.set(key, (username, password, cloud_fqdn))
+        return username, password, cloud_fqdn
 
     try:
         auth_parts = base64.b64decode(auth[1]).decode(HTTP_HEADER_ENCODING)\
@@ -101,14 +136,14 @@ def get_credentials(request):
     return username, password, cloud_fqdn
 
 
-def is_key_in_nested_dict(d, key):
+def with_errors(reply, errors):
     """
-    Return bool for existence of key in the dict d or its nested dictionaries
+    Add the errors found in a Device Cloud reply (see
+    devicecloud.reply_errors) to it under 'errors', so clients get them by
+    path and target device
+
+    Returns the reply
     """
-    found = False
-    if key in d:
-        return True
-    for k in d:
-        if isinstance(d[k], dict):
-            found |= is_key_in_nested_dict(d[k], key)
-    return found
+    if isinstance(reply, dict):
+        reply['errors'] = errors
+    return reply
@@ -6,7 +6,11 @@
 # Copyright (c) 2015 Digi International Inc., All Rights Reserved.
 #
 
+import itertools
+import json
 import logging
+from gevent.pool import Pool
+from django.http import StreamingHttpResponse
 from django.shortcuts import render_to_response
 from django.contrib.auth import get_user_model
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
@@ -24,19 +28,34 @@ from serializers import DashboardSerializer, UserSerializer
 from permissions import IsOwner
 from authentication import MonitorBasicAuthentication
 from django.conf import settings as app_settings
+from monitors import monitor_registry, setup_monitor, \
+    remove_device_datapoint_monitors
 from signals import MONITOR_TOPIC_SIGNAL_MAP
-from util import get_credentials, is_key_in_nested_dict
-from xbgw_dashboard.libs.digi.devicecloud import DeviceCloudConnector
+from broker import push_broker
+from caches import device_list_cache, xbee_index, XBeeQueryError, \
+    settings_cache
+from jobs import apply_stock_config
+import downsample
+from datapoints import datapoint_buffer, datapoint_store, missing_ranges, \
+    stream_device_id
+import metrics
+from util import get_credentials, with_errors
+from xbgw_dashboard.libs.digi.devicecloud import DeviceCloudConnector, \
+    request_flights, reply_errors
 from requests.exceptions import HTTPError, ConnectionError
 import re
 from datetime import datetime, timedelta
-from urllib import unquote
+from calendar import timegm
 from distutils.util import strtobool
 import base64
-from xbee import compare_config_with_stock
+from xbee import EXT_ADDR_RE, compare_config_with_stock
 
 logger = logging.getLogger(__name__)
 
+# Count Device Cloud reads shared between concurrent requests
+request_flights.on_coalesce = \
+    lambda key: metrics.incr('devicecloud.coalesced')
+
 
 # Ensure the csrf cookie is set here, client may do posts via ajax on pages
 # with no templated form
@@ -84,71 +103,37 @@ def monitor_receiver(request):
     if type(messages) is not list:
         messages = [messages]
 
-    monitor_has_listeners = False
-    for msg in messages:
-        try:
-            topic_full = msg['topic']
-        except KeyError:
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-
-        # reported topics come in a /##/Topic/Sub/topic/...,
-        # grab parts we care about
-        (topic, subtopic) = topic_full.split('/', 2)[1:]
-        subtopic = unquote(subtopic)
+    # Keep this worker's cached device lists current
+    device_list_cache.update_messages(messages)
 
-        try:
-            signal_map = MONITOR_TOPIC_SIGNAL_MAP[topic]
-        except KeyError:
-            logger.warning(
-                'No signal map exists for monitor topic %s!' % topic)
-
-        # Each topic may be handled differently. For example, datapoint signals
-        # are keyed off device id
-        signal = None
-        args = {}
-
-        if topic == 'DataPoint':
-            # Attempt to extract a device_id from the subtopic
-            reg_pattern = "\S*(?P<dev_id>((-?([0-9A-F]{8})){4}))"
-            match = re.match(reg_pattern, subtopic)
-            if match:
-                device_id = match.groupdict()['dev_id']
-                signal = signal_map[device_id]
-                args['device_id'] = device_id
-                args['data'] = msg
-            else:
-                logger.warning(
-                    'Error - No deviceId found in DataPoint subtopic!')
-        elif topic == 'DeviceCore':
-            # Device id not in topic, need to parse out from
-            # message body directly...
-            try:
-                device_id = msg['DeviceCore']['devConnectwareId']
-                signal = signal_map[device_id]
-                args['device_id'] = device_id
-                args['data'] = msg
-            except KeyError:
-                logger.warning('No DeviceId found in DeviceCore event')
-        else:
-            logger.warning('No handler for push topic type %s!' % topic)
+    # Hand the messages to whichever workers have sockets listening for
+    # their devices, keyed off topic. Receivers are notified asynchronously.
+    try:
+        accepted = push_broker.publish(messages)
+    except KeyError:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        # If we have no receivers, monitor should be marked inactive
-        # As of 2.10, Device Cloud will retry up to 16 min apart over 24 hours,
-        # then flag
-        if signal is not None and len(signal.receivers):
-            monitor_has_listeners = True
-            logger.debug(
-                "%d registered receivers found for this push, sending signal"
-                % len(signal.receivers))
-            signal.send_robust(sender=None, **args)
-
-    if monitor_has_listeners:
-        logger.info('Push event with receivers handled')
+    if accepted:
+        logger.info('Push event with receivers queued')
+        return Response()
+    elif app_settings.MONITOR_DATAPOINT_SCOPE == 'account' and any(
+            push_broker.has_subscribers(
+                push_broker.router.customer_id(msg['topic']))
+            for msg in messages):
+        # The account's monitor also feeds its devices that are listened to,
+        # don't have it backed off for the ones that aren't
+        logger.info('Dropping push for devices with no receivers')
         return Response()
     else:
+        # If we have no receivers, monitor should be marked inactive
+        # As of 2.10, Device Cloud will retry up to 16 min apart over 24
+        # hours, then flag
         # TODO what status code to return? DC will use anything > 3xx
         logger.info("Received a push with no receivers, responding with 503 " +
                     "to make monitor inactive")
+        # Kick monitors again when they're next set up, rather than leaving
+        # them backed off until the kick interval is up
+        monitor_registry.backed_off()
         return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
@@ -160,7 +145,12 @@ def monitor_setup(request, device_id):
     View to handle monitor setup for a device
 
     Will query for existing monitors, create a new one if none found, else
-    kickstart existing monitor.
+    kickstart existing monitor. Monitors found or kicked recently are served
+    from the in-memory monitor registry.
+
+    If the MONITOR_DATAPOINT_SCOPE setting is 'account', a single DataPoint
+    monitor is used for all devices on the account instead, replacing any
+    per-device monitors.
 
     Returns the monitor information from Device Cloud
     ------------------------------------------
@@ -179,41 +169,41 @@ def monitor_setup(request, device_id):
         logger.error('Rejecting attempt to create monitor to ' + endpoint_url)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    # With nobody listening here, pushes for the device may have been refused
+    # and its monitor backed off, so kick it even if it was kicked recently
+    signal = MONITOR_TOPIC_SIGNAL_MAP['DataPoint'].get(device_id)
+    kick = signal is None or not signal.receivers
+
     try:
-        monitors = conn.get_datapoint_monitor_for_device(device_id,
-                                                         endpoint_url)
-
-        if monitors['resultSize'] == "0":
-            # No existing monitors found for this device on this account,
-            # create a new one
-            # NOTE: The full url is generated by information passed in the
-            # request. If the same backend is being routed to from multiple
-            # places (reverse proxies, etc), each will generate a different url
-            logger.info('Creating a new DataPoint monitor for device %s'
-                        % device_id)
-            resp = conn.create_datapoint_monitor(
-                device_id,
-                endpoint_url,
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
-                description="XBee ZigBee Cloud Kit Monitor")
+        if app_settings.MONITOR_DATAPOINT_SCOPE == 'account':
+            # One DataPoint monitor covers every device on the account, pushes
+            # are routed to the device locally by monitor_receiver
+            def find_account_monitor():
+                # Runs only when the monitor isn't already known, migrate away
+                # from any per-device monitors this one replaces
+                remove_device_datapoint_monitors(conn, username, endpoint_url)
+                return conn.get_datapoint_monitor_for_account(endpoint_url)
+
+            resp = setup_monitor(
+                conn, username, 'DataPoint', endpoint_url, kick=kick,
+                find=find_account_monitor,
+                create=lambda: conn.create_account_datapoint_monitor(
+                    endpoint_url,
+                    app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
+                    app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
+                    description="XBee ZigBee Cloud Kit Monitor"))
         else:
-            # Should only have one monitor for a given device/topic
-            if len(monitors['items']) > 1:
-                logger.warning("Found multiple monitors for this device! " +
-                               "This should not happen!")
-
-            monitor = monitors['items'][0]
-            logger.info(
-                'Found an existing DataPoint monitor for %s, kicking it'
-                % device_id)
-            conn.kick_monitor(
-                monitor['monId'],
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
-            # Return the original info
-            resp = monitors
-
+            resp = setup_monitor(
+                conn, username, 'DataPoint/' + device_id, endpoint_url,
+                kick=kick,
+                find=lambda: conn.get_datapoint_monitor_for_device(
+                    device_id, endpoint_url),
+                create=lambda: conn.create_datapoint_monitor(
+                    device_id,
+                    endpoint_url,
+                    app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
+                    app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
+                    description="XBee ZigBee Cloud Kit Monitor"))
     except HTTPError, e:
         return Response(status=e.response.status_code, data=e.response.text)
     except ConnectionError, e:
@@ -228,7 +218,8 @@ def monitor_devicecore_setup(request):
     View to handle DeviceCore monitor setup for an user
 
     Will query for existing monitors, create a new one if none found, else
-    kickstart existing monitor.
+    kickstart existing monitor. Monitors found or kicked recently are served
+    from the in-memory monitor registry.
 
     Returns the monitor information from Device Cloud
     ------------------------------------------
@@ -248,38 +239,14 @@ def monitor_devicecore_setup(request):
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        monitors = conn.get_devicecore_monitor(endpoint_url)
-
-        if monitors['resultSize'] == "0":
-            # No existing monitors found for this device on this account,
-            # create a new one
-            # NOTE: The full url is generated by information passed in the
-            # request. If the same backend is being routed to from multiple
-            # places (reverse proxies, etc), each will generate a different
-            # url.
-            logger.info('Creating a new DeviceCore monitor for user %s'
-                        % username)
-            resp = conn.create_devicecore_monitor(
+        resp = setup_monitor(
+            conn, username, '[operation=U]DeviceCore', endpoint_url,
+            find=lambda: conn.get_devicecore_monitor(endpoint_url),
+            create=lambda: conn.create_devicecore_monitor(
                 endpoint_url,
                 app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
                 app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS,
-                description="XBee ZigBee Cloud Kit Monitor")
-        else:
-            # Should only have one monitor for a given device/topic
-            if len(monitors['items']) > 1:
-                logger.warning("Found multiple monitors for user %s! " +
-                               "This should not happen!" % username)
-
-            monitor = monitors['items'][0]
-            logger.info(
-                'Found an existing DeviceCore monitor for user, kicking it')
-            conn.kick_monitor(
-                monitor['monId'],
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER,
-                app_settings.SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS)
-            # Return the original info
-            resp = monitors
-
+                description="XBee ZigBee Cloud Kit Monitor"))
     except HTTPError, e:
         return Response(status=e.response.status_code, data=e.response.text)
     except ConnectionError, e:
@@ -474,16 +441,19 @@ class DevicesList(APIView):
         if not username or not password or not cloud_fqdn:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+        devices = device_list_cache.get((username, cloud_fqdn))
+        if devices is None:
+            conn = DeviceCloudConnector(username, password, cloud_fqdn)
 
-        try:
-            devices = conn.get_device_list(
-                device_types=app_settings.SUPPORTED_DEVICE_TYPES)
-        except HTTPError, e:
-            return Response(status=e.response.status_code,
-                            data=e.response.text)
-        except ConnectionError, e:
-            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            try:
+                devices = conn.get_device_list(
+                    device_types=app_settings.SUPPORTED_DEVICE_TYPES)
+            except HTTPError, e:
+                return Response(status=e.response.status_code,
+                                data=e.response.text)
+            except ConnectionError, e:
+                return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            device_list_cache.set((username, cloud_fqdn), devices)
 
         if 'items' in devices:
             # Save a cached local list of devices for this user, which we can
@@ -548,6 +518,7 @@ class DevicesList(APIView):
         # clear out the session device list cache
         if 'user_devices' in request.session:
             del request.session['user_devices']
+        device_list_cache.invalidate((username, cloud_fqdn))
 
         return Response(data=resp)
 
@@ -660,8 +631,10 @@ class XBGWDeviceIO(APIView):
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        if is_key_in_nested_dict(resp, 'error'):
-            return Response(status=status.HTTP_400_BAD_REQUEST, data=resp)
+        errors = reply_errors(resp)
+        if errors:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data=with_errors(resp, errors))
 
         return Response(data=resp)
 
@@ -783,13 +756,60 @@ class DeviceIO(APIView):
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        if is_key_in_nested_dict(resp, 'error'):
+        errors = reply_errors(resp)
+        if errors:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=resp)
+                            data=with_errors(resp, errors))
 
         return Response(data=resp)
 
 
+def _get_settings(conn, device_id, radio=None, cache=False, refresh=False):
+    """
+    Settings of radio (or the gateway itself), answered from settings_cache
+    unless refresh is set or Device Cloud's cache was requested
+
+    Raises HTTPError/ConnectionError from Device Cloud
+
+    Returns (settings response, age in seconds or None if just queried)
+    """
+    key = settings_cache.key(conn, device_id, radio)
+    if not cache and not refresh:
+        cached = settings_cache.get(key)
+        if cached is not None:
+            return cached
+    settings = conn.get_device_settings(device_id, radio=radio, cache=cache)
+    if not cache:
+        settings_cache.set(key, settings)
+    return settings, None
+
+
+def _settings_written(conn, device_id, radio, settings, response):
+    """
+    Write settings through to settings_cache, or forget the cached settings
+    if the device reported an error (response None if unknown)
+    """
+    key = settings_cache.key(conn, device_id, radio)
+    if response is None or reply_errors(response):
+        settings_cache.invalidate(key)
+    else:
+        settings_cache.update(key, settings)
+
+
+def _settings_response(age, **kwargs):
+    """
+    Response with headers telling whether the settings came from
+    settings_cache, and how old they are
+    """
+    response = Response(**kwargs)
+    if age is None:
+        response['X-Settings-Cache'] = 'MISS'
+    else:
+        response['X-Settings-Cache'] = 'HIT'
+        response['Age'] = str(int(age))
+    return response
+
+
 class GatewayConfig(APIView):
     """
     View to show settings configuration for an individual gateway
@@ -801,6 +821,12 @@ class GatewayConfig(APIView):
 
     * `cache` - true to return cached settings from Device Cloud, false to
                 query settings from the gateway. (Default: false)
+    * `refresh` - With `cache` false, settings queried from the gateway in
+                  the last `SETTINGS_CACHE_TTL` seconds are returned, unless
+                  this is true. (Default: false)
+
+    The `X-Settings-Cache` header is `HIT` when recent settings were
+    returned, with their age in seconds in the `Age` header, or `MISS`.
 
     *PUT* - Set device settings via SCI/RCI set_setting. Accepts a json object
             of the form `{"setting_group" : {"key":"value", ...}, ...}`
@@ -820,24 +846,27 @@ class GatewayConfig(APIView):
         conn = DeviceCloudConnector(username, password, cloud_fqdn)
 
         cache = bool(strtobool(request.QUERY_PARAMS.get('cache', 'False')))
+        refresh = bool(strtobool(request.QUERY_PARAMS.get('refresh', 'False')))
 
         try:
-            settings = conn.get_device_settings(device_id, cache=cache)
+            settings, age = _get_settings(conn, device_id, cache=cache,
+                                          refresh=refresh)
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(settings, 'error'):
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=settings)
+        # Device cloud always returns 200, errors are shown as elements in
+        # the body. They are listed, with the device they are for, as the
+        # reply is parsed.
+        errors = reply_errors(settings)
+        if errors:
+            return _settings_response(
+                age, status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                data=with_errors(settings, errors))
 
-        return Response(data=settings)
+        return _settings_response(age, data=settings)
 
     def put(self, request, device_id=None):
         # Basic sanity check on the values we're trying to send
@@ -860,18 +889,21 @@ class GatewayConfig(APIView):
             settings = conn.set_device_settings(
                 device_id=device_id, settings=request.DATA)
         except HTTPError, e:
+            _settings_written(conn, device_id, None, request.DATA, None)
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
+            _settings_written(conn, device_id, None, request.DATA, None)
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        _settings_written(conn, device_id, None, request.DATA, settings)
 
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(settings, 'error'):
+        # Device cloud always returns 200, errors are shown as elements in
+        # the body. They are listed, with the device they are for, as the
+        # reply is parsed.
+        errors = reply_errors(settings)
+        if errors:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=settings)
+                            data=with_errors(settings, errors))
 
         return Response(data=settings)
 
@@ -948,9 +980,10 @@ class XBGWDeviceSerial(APIView):
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        if is_key_in_nested_dict(response, 'error'):
+        errors = reply_errors(response)
+        if errors:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=response)
+                            data=with_errors(response, errors))
 
         return Response(data=response)
 
@@ -1010,13 +1043,13 @@ class DeviceSerial(APIView):
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(response, 'error'):
+        # Device cloud always returns 200, errors are shown as elements in
+        # the body. They are listed, with the device they are for, as the
+        # reply is parsed.
+        errors = reply_errors(response)
+        if errors:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=response)
+                            data=with_errors(response, errors))
 
         return Response(data=response)
 
@@ -1069,12 +1102,20 @@ class DevicesDatapointList(APIView):
     View to show DataPoints in a given DataStream
     ------------------------------------------
 
-    *GET* - Show historical DataPoints for the specified stream
+    *GET* - Show historical DataPoints for the specified stream. Every page
+    of Device Cloud's results is included, streamed as they are fetched.
 
     Optional Query Parameters:
 
     * `startTime` - POSIX timestamp in seconds. Defaults to 5 minutes in the
                     past.
+    * `rollup` - Aggregate points into buckets of this interval, e.g. `30s`,
+                 `1m`, `1h` or `1d`.
+    * `agg` - How buckets are aggregated: `avg` (default), `min`, `max` or
+              `last`. With `maxPoints` alone, `lttb` selects the points that
+              best preserve the shape of the series.
+    * `maxPoints` - Maximum number of points to return. Longer results are
+                    aggregated into equal time buckets over the query range.
 
      _Authentication Required_
     """
@@ -1101,24 +1142,172 @@ class DevicesDatapointList(APIView):
             time = datetime.utcnow() - timedelta(minutes=5)
         time_no_micro = time.replace(microsecond=0)
         iso_time = time_no_micro.isoformat()+'z'
+        start_millis = timegm(time_no_micro.utctimetuple()) * 1000
 
         try:
-            data_points = conn.get_datapoints(stream_id, iso_time)
+            reduction = downsample.parse_params(request.GET)
+        except ValueError, e:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=str(e))
+
+        # Describes local results, Device Cloud's own is passed through
+        envelope = {'requestedStartTime': str(start_millis),
+                    'requestedEndTime': '-1'}
+        try:
+            # Local copies of DataPoints are only used for the user's own
+            # devices, they hold data for every account.
+            if stream_device_id(stream_id) not in \
+                    request.session.get('user_devices', []):
+                metrics.incr('datapoints.buffer_miss')
+                envelope = {}
+                points = started(conn.iter_datapoints(stream_id, iso_time,
+                                                      envelope=envelope))
+            elif app_settings.DATAPOINT_STORE['ENABLED']:
+                points = self.get_stored(conn, stream_id, start_millis)
+            else:
+                points = self.get_buffered(conn, stream_id, start_millis)
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        # There's a bug in Device Cloud related to fetching XBee Gateway data
-        # streams. We get back XML, even when we requested JSON. To remedy
-        # this, parse out the 'result' key and change 'DataPoint' to 'items'.
-        if 'result' in data_points:
-            logger.info("Parsing XML-y response into expected JSON format")
-            data_points = data_points['result']
-            data_points['items'] = data_points.pop('DataPoint', [])
+        if reduction:
+            metrics.incr('datapoints.downsampled')
+            end_millis = timegm(datetime.utcnow().utctimetuple()) * 1000
+            points = downsample.downsample(points, start_millis, end_millis,
+                                           **reduction)
+
+        return stream_datapoints(points, envelope)
+
+    def get_buffered(self, conn, stream_id, start):
+        """
+        Points pushed to us for monitored devices are buffered, use them for
+        as much of the requested range as they cover and only ask Device
+        Cloud for the rest
+        """
+        covered_from = datapoint_buffer.covered_from(stream_id)
+        if covered_from is None:
+            metrics.incr('datapoints.buffer_miss')
+            return started(conn.iter_datapoints(stream_id, start))
+
+        fetched = []
+        if covered_from > start:
+            metrics.incr('datapoints.buffer_partial')
+            fetched = started(conn.iter_datapoints(stream_id, start,
+                                                   covered_from))
+        else:
+            metrics.incr('datapoints.buffer_hit')
+            covered_from = start
+        return itertools.chain(fetched,
+                               datapoint_buffer.points(stream_id, covered_from))
+
+    def get_stored(self, conn, stream_id, start):
+        """
+        Use the local DataPoint store, filling any gaps in it from Device
+        Cloud, and the buffer of pushed points for the most recent points of
+        monitored devices
+        """
+        now = timegm(datetime.utcnow().utctimetuple()) * 1000
+        covered_from = datapoint_buffer.covered_from(stream_id)
+        limit = now if covered_from is None else max(start, covered_from)
+        # Device Cloud may still receive points timestamped shortly before
+        # now, only trust older ranges to be complete
+        settled = now - app_settings.DATAPOINT_STORE['SETTLE_TIME'] * 1000
+
+        if covered_from is not None:
+            # The store was fed the same pushes as the buffer, up to any
+            # that failed to be written
+            datapoint_store.flush()
+            stored_until = min(now, settled)
+            unstored = datapoint_store.unstored_from(stream_id, covered_from)
+            if unstored is not None:
+                stored_until = min(stored_until, unstored)
+            datapoint_store.add_range(stream_id, covered_from, stored_until)
+
+        points = []
+        if start < limit:
+            gaps = missing_ranges(start, limit,
+                                  datapoint_store.ranges(stream_id, start,
+                                                         limit))
+            if gaps:
+                metrics.incr('datapoints.store_backfill')
+                # Fetch all the gaps in one query, a page at a time
+                gap_start, gap_end = gaps[0][0], gaps[-1][1]
+                for page in conn.iter_datapoint_pages(stream_id, gap_start,
+                                                      gap_end):
+                    datapoint_store.save_points(page)
+                datapoint_store.add_range(stream_id, gap_start,
+                                          min(gap_end, settled))
+            else:
+                metrics.incr('datapoints.store_hit')
+            points = datapoint_store.points(stream_id, start, limit)
 
-        return Response(data=data_points)
+        if covered_from is not None:
+            points = itertools.chain(points,
+                                     datapoint_buffer.points(stream_id, limit))
+        return points
+
+
+def started(points):
+    """
+    Start an iterator of DataPoints, so errors getting the first one (such as
+    the first Device Cloud request failing) are raised here rather than once
+    the response is being streamed
+    """
+    points = iter(points)
+    try:
+        first = next(points)
+    except StopIteration:
+        return []
+    return itertools.chain([first], points)
+
+
+# Number of DataPoints encoded per chunk of a streamed response
+STREAM_CHUNK_POINTS = 100
+
+
+def stream_datapoints(points, envelope):
+    """
+    Response listing points in the form of a Device Cloud DataPoint query
+    with the fields of envelope, encoding them as they are consumed so a long
+    history is never held in memory. resultSize comes last, once known.
+
+    If getting the points fails part way, it's too late for an error status:
+    the points so far are followed by an error member instead.
+    """
+    def chunks():
+        head = json.dumps(envelope)[1:-1]
+        yield '{%s"items": [' % (head + ', ' if head else '')
+        count = 0
+        chunk = []
+        error = None
+        try:
+            for point in points:
+                chunk.append(json.dumps(point))
+                if len(chunk) == STREAM_CHUNK_POINTS:
+                    yield (',' if count else '') + ','.join(chunk)
+                    count += len(chunk)
+                    chunk = []
+        except Exception:
+            logger.exception('Error streaming DataPoints')
+            error = 'Error getting DataPoints, the result is incomplete'
+        if chunk:
+            yield (',' if count else '') + ','.join(chunk)
+            count += len(chunk)
+        if error is not None:
+            yield '], "error": %s, "resultSize": "%d"}' % (json.dumps(error),
+                                                          count)
+        else:
+            yield '], "resultSize": "%d"}' % count
+
+    return StreamingHttpResponse(chunks(), content_type='application/json')
+
+
+def _xbee_list(items):
+    """
+    XbeeCore records in the form of a Device Cloud XbeeCore query result
+    """
+    return {'resultSize': str(len(items)), 'items': items}
 
 
 def _add_config_links(xbee, request):
@@ -1143,8 +1332,9 @@ class XBeeList(APIView):
 
     Optional Query Parameters:
 
-    * `cache`: true to return Device Cloud cached XbeeCore list,
-               false to fetch XBee list from gateway. (Default: true)
+    * `cache`: true to return Device Cloud cached XbeeCore list (as indexed
+               by the dashboard), false to fetch XBee list from gateway.
+               (Default: true)
     * `clear`: Specifies whether the gateway's cache will be cleared before
                performing discovery. (Default: false)
 
@@ -1176,24 +1366,30 @@ class XBeeList(APIView):
             clear = False
 
         try:
-            xbees = conn.get_xbees(device_id, cache=cache, clear=clear)
+            if cache:
+                # Device Cloud's cached list is mirrored by the XBee index
+                xbees = _xbee_list(xbee_index.lookup(
+                    (username, cloud_fqdn), conn, gateway=device_id))
+            else:
+                xbees = conn.get_xbees(device_id, cache=cache, clear=clear)
+                # A discovery after clearing the gateway's cache lists all
+                # of its nodes
+                xbee_index.merge((username, cloud_fqdn), xbees,
+                                 gateway=device_id if clear else None)
         except HTTPError, e:
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(xbees, 'error'):
+        except XBeeQueryError, e:
+            # Device cloud always returns 200, errors are shown as elements
+            # in the body.
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=xbees)
-        else:
-            for xbee in xbees['items']:
-                # Inject config URLs
-                _add_config_links(xbee, request)
+                            data=e.response)
+
+        for xbee in xbees['items']:
+            # Inject config URLs
+            _add_config_links(xbee, request)
 
         return Response(data=xbees)
 
@@ -1214,6 +1410,10 @@ class XBeeExplicitList(APIView):
         Can be specified multiple times (e.g.
         `?ext_addr=foo&ext_addr=bar` to find multiple XBees)
 
+    Results come from an index of the account's XBees, refreshed from Device
+    Cloud in the background. Addresses missing from it are looked up in
+    Device Cloud.
+
      _Authentication Required_
     """
 
@@ -1238,7 +1438,10 @@ class XBeeExplicitList(APIView):
             logger.debug("Querying for XBees, ext_addr=%s", addrs)
 
         try:
-            xbees = conn.get_xbees(device_id=None, addrs=addrs)
+            # Answered from the account's XBee index, addresses it doesn't
+            # have are queried for
+            xbees = _xbee_list(xbee_index.lookup((username, cloud_fqdn), conn,
+                                                 addrs=addrs))
         except HTTPError, e:
             resp = e.response.text
             # If one of the extended addresses has an unexpected character
@@ -1251,22 +1454,138 @@ class XBeeExplicitList(APIView):
                             data=resp)
         except ConnectionError, e:
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(xbees, 'error'):
+        except XBeeQueryError, e:
+            # Device cloud always returns 200, errors are shown as elements
+            # in the body.
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=xbees)
-        else:
-            for xbee in xbees['items']:
-                # Inject config URLs
-                _add_config_links(xbee, request)
+                            data=e.response)
+
+        for xbee in xbees['items']:
+            # Inject config URLs
+            _add_config_links(xbee, request)
 
         return Response(data=xbees)
 
 
+def _query_radio_config(conn, request, device_id, radio, cache,
+                        refresh=False):
+    """
+    Query the settings of an XBee radio, and compare them with Cloud Kit
+    stock settings
+
+    Returns (status code, response data, age of the settings in seconds or
+    None if just queried)
+    """
+    try:
+        settings, age = _get_settings(conn, device_id, radio=radio,
+                                      cache=cache, refresh=refresh)
+    except HTTPError, e:
+        return e.response.status_code, e.response.text, None
+    except ConnectionError, e:
+        return status.HTTP_503_SERVICE_UNAVAILABLE, None, None
+
+    # Device cloud always returns 200, errors are shown as elements in
+    # the body. They are listed, with the device they are for, as the
+    # reply is parsed.
+    errors = reply_errors(settings)
+    if errors:
+        return (status.HTTP_500_INTERNAL_SERVER_ERROR,
+                with_errors(settings, errors), age)
+
+    # Compare the config with Cloud Kit stock settings, return diff
+    try:
+        device = settings['sci_reply']['send_message']['device']
+        settings = device['rci_reply']['do_command']['query_setting']
+    except KeyError:
+        settings = {}
+
+    resp = settings
+    settings['config-kit-stock-values'] = \
+        compare_config_with_stock(resp)
+    # Add link to stock configuration URL
+    settings['kit-stock-config-apply-url'] = reverse(
+        'xbee-stock-config', request=request,
+        kwargs={'device_id': device_id, 'radio': radio})
+
+    return status.HTTP_200_OK, settings, age
+
+
+class XBeeConfigList(APIView):
+    """
+    View to show settings configuration for several XBee radios at once
+    ------------------------------------------
+
+    *GET* - Show SCI/RCI query_setting for each radio, as an object keyed by
+            radio. Each value holds the `status` and `data` the individual
+            config view would return, and the `age` in seconds of recent
+            settings returned instead of querying the radio (or null).
+            Radios are queried concurrently, and each result is sent as soon
+            as its query completes.
+
+    Required Query Parameters:
+
+    * `radio` - Extended address of a radio. Specify multiple times (e.g.
+                `?radio=foo&radio=bar`) to query multiple radios.
+
+    Optional Query Parameters:
+
+    * `cache` - true to return cached settings from Device Cloud, false to
+                query settings through the gateway. (Default: false)
+    * `refresh` - With `cache` false, settings queried in the last
+                  `SETTINGS_CACHE_TTL` seconds are returned, unless this is
+                  true. (Default: false)
+
+     _Authentication Required_
+    """
+
+    def get(self, request, device_id, format=None):
+        """
+        Query Device Cloud to return current settings of several radios
+        """
+        username, password, cloud_fqdn = get_credentials(request)
+
+        if not username or not password or not cloud_fqdn:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data="Bad credentials")
+
+        radios = []
+        for radio in request.QUERY_PARAMS.getlist('radio'):
+            if not EXT_ADDR_RE.match(radio):
+                return Response(status=status.HTTP_400_BAD_REQUEST,
+                                data="Invalid radio %s" % radio)
+            if radio not in radios:
+                radios.append(radio)
+        if not radios:
+            return Response(status=status.HTTP_400_BAD_REQUEST,
+                            data="radio parameter required")
+
+        try:
+            cache = bool(strtobool(request.QUERY_PARAMS.get('cache', 'False')))
+            refresh = bool(strtobool(
+                request.QUERY_PARAMS.get('refresh', 'False')))
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        conn = DeviceCloudConnector(username, password, cloud_fqdn)
+
+        def query(radio):
+            code, data, age = _query_radio_config(conn, request, device_id,
+                                                  radio, cache, refresh)
+            return radio, {'status': code, 'data': data, 'age': age}
+
+        pool = Pool(app_settings.XBEE_CONFIG_CONCURRENCY)
+        results = pool.imap_unordered(query, radios)
+
+        def chunks():
+            yield '{'
+            for i, (radio, result) in enumerate(results):
+                yield '%s%s: %s' % (',' if i else '', json.dumps(radio),
+                                    json.dumps(result))
+            yield '}'
+
+        return StreamingHttpResponse(chunks(),
+                                     content_type='application/json')
+
+
 class XBeeConfig(APIView):
     """
     View to show settings configuration for an individual XBee radio
@@ -1278,6 +1597,12 @@ class XBeeConfig(APIView):
 
     * `cache` - true to return cached settings from Device Cloud, false to
                 query settings through the gateway. (Default: false)
+    * `refresh` - With `cache` false, settings queried from the radio in the
+                  last `SETTINGS_CACHE_TTL` seconds are returned, unless this
+                  is true. (Default: false)
+
+    The `X-Settings-Cache` header is `HIT` when recent settings were
+    returned, with their age in seconds in the `Age` header, or `MISS`.
 
     *PUT* - Set device settings via SCI/RCI set_setting. Accepts a json object
             of the form `{"setting_group" : {"key":"value", ...}, ...}`
@@ -1297,40 +1622,11 @@ class XBeeConfig(APIView):
         conn = DeviceCloudConnector(username, password, cloud_fqdn)
 
         cache = bool(strtobool(request.QUERY_PARAMS.get('cache', 'False')))
+        refresh = bool(strtobool(request.QUERY_PARAMS.get('refresh', 'False')))
 
-        try:
-            settings = conn.get_device_settings(
-                    device_id=device_id, radio=radio, cache=cache)
-        except HTTPError, e:
-            return Response(status=e.response.status_code,
-                            data=e.response.text)
-        except ConnectionError, e:
-            return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(settings, 'error'):
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=settings)
-
-        # Compare the config with Cloud Kit stock settings, return diff
-        try:
-            device = settings['sci_reply']['send_message']['device']
-            settings = device['rci_reply']['do_command']['query_setting']
-        except KeyError:
-            settings = {}
-
-        resp = settings
-        settings['config-kit-stock-values'] = \
-            compare_config_with_stock(resp)
-        # Add link to stock configuration URL
-        settings['kit-stock-config-apply-url'] = reverse(
-            'xbee-stock-config', request=request,
-            kwargs={'device_id': device_id, 'radio': radio})
-
-        return Response(data=settings)
+        code, settings, age = _query_radio_config(conn, request, device_id,
+                                                  radio, cache, refresh)
+        return _settings_response(age, status=code, data=settings)
 
     def put(self, request, device_id, radio):
         BAD_FORM = {
@@ -1360,18 +1656,21 @@ class XBeeConfig(APIView):
             settings = conn.set_device_settings(
                 device_id=device_id, radio=radio, settings=request.DATA)
         except HTTPError, e:
+            _settings_written(conn, device_id, radio, request.DATA, None)
             return Response(status=e.response.status_code,
                             data=e.response.text)
         except ConnectionError, e:
+            _settings_written(conn, device_id, radio, request.DATA, None)
             return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        _settings_written(conn, device_id, radio, request.DATA, settings)
 
-        # We need a bit of extra parsing to determine if the request really
-        # succeeded. Device cloud always returns 200, errors are shown as
-        # elements in the body. Our (overly) simple scheme will check for the
-        # presence of any error element
-        if is_key_in_nested_dict(settings, 'error'):
+        # Device cloud always returns 200, errors are shown as elements in
+        # the body. They are listed, with the device they are for, as the
+        # reply is parsed.
+        errors = reply_errors(settings)
+        if errors:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=settings)
+                            data=with_errors(settings, errors))
 
         return Response(data=settings)
 
@@ -1394,58 +1693,5 @@ class XBeeStockConfig(APIView):
 
         conn = DeviceCloudConnector(username, password, cloud_fqdn)
 
-        # Query present configuration, calculate diff.
-        try:
-            settings = conn.get_device_settings(
-                device_id=device_id, radio=radio)
-        except HTTPError, e:
-            return Response(status=e.response.status_code,
-                            data=e.response.text)
-        except ConnectionError, e:
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-        # Check for any errors in query
-        if is_key_in_nested_dict(settings, 'error'):
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data=settings)
-
-        # Extract the settings from the response.
-        try:
-            device = settings['sci_reply']['send_message']['device']
-            settings_resp = device['rci_reply']['do_command']['query_setting']
-        except KeyError:
-            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            data={
-                                "error": "Could not parse settings",
-                                "settings": settings})
-
-        # Compare the config with Cloud Kit stock settings, return diff
-        diff = compare_config_with_stock(settings_resp)
-
-        # If there is a difference, send the new config to the device
-        if diff:
-            try:
-                response = conn.set_device_settings(
-                    device_id=device_id, radio=radio, settings=diff)
-            except HTTPError, e:
-                return Response(status=e.response.status_code,
-                                data=e.response.text)
-            except ConnectionError, e:
-                return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
-
-            # Make return value give both the SCI reply and the diff that was
-            # applied.
-            response = {
-                "diff_applied": diff,
-                "response": response
-            }
-
-            if is_key_in_nested_dict(response, 'error'):
-                return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                data=response)
-            else:
-                return Response(status=status.HTTP_200_OK,
-                                data=response)
-        else:
-            # No configuration needs to be applied.
-            return Response(status=status.HTTP_200_OK)
+        code, data = apply_stock_config(conn, device_id, radio)
+        return Response(status=code, data=data)
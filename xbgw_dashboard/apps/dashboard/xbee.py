@@ -13,6 +13,12 @@ Created on Aug 30, 2013
 
 @author: skravik
 '''
+import re
+
+# Extended address of a radio, e.g. 00:13:A2:00:40:A1:2B:01, as accepted in
+# URLs and socket events
+EXT_ADDR_PATTERN = r'[0-9A-F:]+'
+EXT_ADDR_RE = re.compile(r'^%s$' % EXT_ADDR_PATTERN)
 
 _COMM_BUTTON = '1'
 _ASSOC_IND = '1'
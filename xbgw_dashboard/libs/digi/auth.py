@@ -6,11 +6,16 @@
 # Copyright (c) 2015 Digi International Inc., All Rights Reserved.
 #
 
+import copy
+import hashlib
+import hmac
 import logging
+import os
 import traceback
 
 from django.contrib.auth import get_user_model
 from devicecloud import DeviceCloudConnector
+from cache import TTLCache
 from requests.exceptions import HTTPError
 from django.conf import settings
 
@@ -18,6 +23,22 @@ logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+_dc_setting = settings.LIB_DIGI_DEVICECLOUD
+
+# Credentials verified with Device Cloud, keyed by a salted hash of username,
+# cloud and password. Holds the user for valid credentials, False for
+# rejected ones.
+auth_cache = TTLCache(ttl=_dc_setting.get('AUTH_CACHE_TTL', 60),
+                      max_size=_dc_setting.get('AUTH_CACHE_MAX_SIZE', 10000))
+# Random per process, so keys can't be precomputed from known passwords
+_auth_salt = os.urandom(32)
+
+
+def _auth_key(username, cloud_fqdn, password):
+    credentials = u'\0'.join((username, cloud_fqdn, password))
+    return hmac.new(_auth_salt, credentials.encode('utf-8'),
+                    hashlib.sha256).digest()
+
 
 class DeviceCloudBackend(object):
     """
@@ -58,6 +79,12 @@ class DeviceCloudBackend(object):
                     "provided and no default set" % username)
                 return None
 
+        key = _auth_key(dc_username, cloud_fqdn, password)
+        user = auth_cache.get(key)
+        if user is not None:
+            # Callers (e.g. login) modify the user they get
+            return copy.copy(user) if user else None
+
         conn = DeviceCloudConnector(dc_username, password, cloud_fqdn)
         login_valid = None
         try:
@@ -93,7 +120,10 @@ class DeviceCloudBackend(object):
                     'Creating new user for username - %s, cloud_fqdn - %s' %
                     (normalized_username, cloud_fqdn))
                 pass
+            auth_cache.set(key, copy.copy(user))
             return user
+        auth_cache.set(key, False,
+                       ttl=dc_setting.get('AUTH_CACHE_FAILURE_TTL', 10))
         return None
 
     def get_user(self, user_id):
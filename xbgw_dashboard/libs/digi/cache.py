@@ -0,0 +1,143 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Small in-process caching helpers shared by the Device Cloud library
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Bounded, least-recently-used mapping whose entries expire after a time to
+    live.
+
+    Entries live in process memory only, so each worker keeps its own copy.
+    All operations take a lock, making a single instance safe to share
+    between threads or (monkey patched) greenlets.
+    """
+
+    def __init__(self, ttl=None, max_size=None, refresh_on_get=False,
+                 on_evict=None):
+        """
+        Kwargs:
+            ttl (float): Seconds an entry stays valid. None never expires.
+            max_size (int): Maximum number of entries kept. When exceeded, the
+                            least recently used entry is evicted. None for no
+                            limit.
+            refresh_on_get (bool): If True, a successful lookup restarts the
+                            entry's time to live (i.e. expire on idle time)
+            on_evict (callable): Called as on_evict(key, value) whenever an
+                            entry is dropped because it expired or the cache
+                            was full.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh_on_get = refresh_on_get
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _expiry(self, ttl):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+    def _evict(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default if missing or expired
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                self._evict(key, value)
+                return default
+            if self.refresh_on_get:
+                expires = self._expiry(None)
+            # Re-insert to mark as most recently used
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value under key. ttl overrides the cache default for this entry.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, self._expiry(ttl))
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    old_key, (old_value, _) = self._data.popitem(last=False)
+                    self._evict(old_key, old_value)
+
+    def get_or_set(self, key, factory, ttl=None):
+        """
+        Return the value for key, storing the result of factory() first if
+        no valid entry exists
+        """
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                value = factory()
+                self.set(key, value, ttl)
+            return value
+
+    def pop(self, key, default=None):
+        """
+        Remove key, returning its value (or default if absent or expired)
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                self._evict(key, value)
+                return default
+            return value
+
+    def purge(self):
+        """
+        Drop all expired entries, returning how many were removed
+        """
+        now = time.time()
+        with self._lock:
+            expired = [(k, v) for k, (v, expires) in self._data.iteritems()
+                       if expires is not None and expires <= now]
+            for key, value in expired:
+                del self._data[key]
+                self._evict(key, value)
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return self._data.keys()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
@@ -10,15 +10,32 @@
 Simple library to handle common Device Cloud operations
 
 """
+import copy
 import logging
+import sys
+import threading
+import time
+from cookielib import DefaultCookiePolicy
 import requests
 import xmltodict
-from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from cache import TTLCache
+import sci
+import xmlparse
 
 logger = logging.getLogger(__name__)
 
 ws_uri = "https://{fqdn}/ws/{resource}/{path_filter}"
 
+# Keep-alive connection pooling. Sessions are shared by every connector for
+# the same account within a worker process.
+# Maximum number of kept-alive connections to a single Device Cloud host
+SESSION_POOL_MAXSIZE = 10
+# Sessions unused for this many seconds are closed and dropped
+SESSION_IDLE_TIMEOUT = 300
+# Upper bound on the number of accounts with a pooled session
+SESSION_POOL_MAX_ACCOUNTS = 500
+
 USERINFO_RESOURCE = 'UserInfo'
 DEVICECORE_RESOURCE = 'DeviceCore'
 DATASTREAM_RESOURCE = 'DataStream'
@@ -27,18 +44,35 @@ SCI_RESOURCE = 'sci'
 MONITOR_RESOURCE = 'Monitor'
 XBEE_RESOURCE = 'XbeeCore'
 
+# Number of DataPoints requested per page when iterating over a stream
+DATAPOINT_PAGE_SIZE = 1000
+# Number of XbeeCore records requested per page when listing an account
+XBEE_PAGE_SIZE = 1000
+
+
+# Paths of the elements read from SCI settings replies
+GATEWAY_SETTINGS_PATH = ('sci_reply', 'send_message', 'device', 'rci_reply',
+                         'query_setting')
+XBEE_SETTINGS_PATH = ('sci_reply', 'send_message', 'device', 'rci_reply',
+                      'do_command', 'query_setting')
 
-def _parse_response(response):
+
+def _parse_response(response, select=None):
     """
     Convert the Requests response content to a python dictionary by parsing out
     json/xml
+
+    Kwargs:
+        select (tuple): Path of the only XML subtree needed, see
+                        xmlparse.parse
     """
     if 'application/xml' in response.headers['Content-Type']:
-        # XML content, run through xmltodict
-        return xmltodict.parse(response.text)
+        # XML content, parsed from the raw bytes as they are read
+        return xmlparse.parse(response.iter_content(xmlparse.CHUNK_SIZE),
+                              select=select)
     elif 'application/json' in response.headers['Content-Type']:
         # JSON content, use request's built in parser
-        return response.json()
+        return _parse_json(response)
     else:
         logger.warning('Recieved non xml/json content from Device Cloud: %s' %
                        response.headers['Content-Type'])
@@ -51,6 +85,279 @@ def _parse_response(response):
         return response.text
 
 
+def _find_errors(value, path, target, errors):
+    if isinstance(value, list):
+        for item in value:
+            _find_errors(item, path, target, errors)
+    elif isinstance(value, dict):
+        for key, item in value.iteritems():
+            if key == xmlparse.ERROR:
+                errors.append({'path': '/'.join(path + [key]),
+                               'target': target, 'error': item})
+                continue
+            path.append(key)
+            if key == xmlparse.TARGET:
+                # One or more targets, each with its own id
+                for element in item if isinstance(item, list) else [item]:
+                    if isinstance(element, dict):
+                        _find_errors(element, path, element.get('@id'),
+                                     errors)
+            else:
+                _find_errors(item, path, target, errors)
+            path.pop()
+
+
+class _ErrorHook(object):
+    """
+    json object_hook noting whether any object has an error member
+    """
+
+    def __init__(self):
+        self.found = False
+
+    def __call__(self, obj):
+        if xmlparse.ERROR in obj:
+            self.found = True
+        return obj
+
+
+def _parse_json(response):
+    """
+    Parse a JSON reply, listing its errors like xmlparse does. They are only
+    searched for if the decoder saw an error member.
+    """
+    hook = _ErrorHook()
+    reply = response.json(object_hook=hook)
+    if not hook.found and isinstance(reply, dict):
+        document = xmlparse.Document()
+        document.update(reply)
+        return document
+    return reply
+
+
+def reply_errors(reply):
+    """
+    The errors a Device Cloud reply reports in its body. Device Cloud
+    returns 200 for failed SCI requests, with error elements in the reply.
+
+    XML replies list their errors as they are parsed, other replies (e.g.
+    JSON) are searched.
+
+    Returns a list of {'path', 'target', 'error'}, see xmlparse.Document
+    """
+    if isinstance(reply, xmlparse.Document):
+        return reply.errors
+    errors = []
+    _find_errors(reply, [], None, errors)
+    return errors
+
+
+def normalize_datapoints(data_points):
+    """
+    Put a DataPoint query response in the usual JSON form, with the points as
+    a list in 'items'
+    """
+    # There's a bug in Device Cloud related to fetching XBee Gateway data
+    # streams. We get back XML, even when we requested JSON. To remedy
+    # this, parse out the 'result' key and change 'DataPoint' to 'items'.
+    if 'result' in data_points:
+        logger.info("Parsing XML-y response into expected JSON format")
+        data_points = data_points['result']
+        data_points['items'] = data_points.pop('DataPoint', [])
+        if '@pageCursor' in data_points:
+            data_points['pageCursor'] = data_points.pop('@pageCursor')
+
+    # A single point comes back as an object from XML
+    items = data_points.get('items', [])
+    if type(items) is not list:
+        data_points['items'] = [items]
+    return data_points
+
+
+class PooledSession(requests.Session):
+    """
+    Requests session shared through the SessionPool.
+
+    It refuses all cookies, so nothing Device Cloud sets for one connector
+    (e.g. a JSESSIONID) is replayed on another's requests. It is closed
+    only once requests already using it are done.
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self._lock = threading.Lock()
+        self._active = 0
+        self._retired = False
+
+    def request(self, *args, **kwargs):
+        with self._lock:
+            self._active += 1
+        try:
+            return super(PooledSession, self).request(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._active -= 1
+                close = self._retired and not self._active
+            if close:
+                self.close()
+
+    def retire(self):
+        """
+        Close the session now, or once the requests in flight finish
+        """
+        with self._lock:
+            self._retired = True
+            close = not self._active
+        if close:
+            self.close()
+
+
+class SessionPool(object):
+    """
+    Registry of Requests sessions keyed by (username, cloud_fqdn).
+
+    Each session holds a keep-alive connection pool, so reusing it across
+    requests saves the TCP and TLS handshakes to Device Cloud. Sessions carry
+    no credentials (those are passed per request by the connector) and keep
+    no cookies, which makes it safe for concurrent greenlets to share one.
+    """
+
+    def __init__(self, maxsize=SESSION_POOL_MAXSIZE,
+                 idle_timeout=SESSION_IDLE_TIMEOUT,
+                 max_accounts=SESSION_POOL_MAX_ACCOUNTS):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._sessions = TTLCache(ttl=idle_timeout, max_size=max_accounts,
+                                  refresh_on_get=True,
+                                  on_evict=self._close_session)
+        self._next_purge = 0
+
+    @staticmethod
+    def _close_session(key, session):
+        logger.debug("Closing idle Device Cloud session for %s@%s" % key)
+        session.retire()
+
+    def _new_session(self):
+        session = PooledSession()
+        session.headers.update({'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_maxsize=self.maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, username, cloud_fqdn):
+        """
+        Return the shared session for this account, creating it if needed
+        """
+        # Periodically sweep out sessions for accounts that have gone idle
+        now = time.time()
+        if now >= self._next_purge:
+            self._next_purge = now + self.idle_timeout
+            self._sessions.purge()
+        return self._sessions.get_or_set((username, cloud_fqdn),
+                                         self._new_session)
+
+    def close(self, username, cloud_fqdn):
+        """
+        Close and forget the session for this account, if any
+        """
+        session = self._sessions.pop((username, cloud_fqdn))
+        if session is not None:
+            session.retire()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# Process-wide pool used by all connectors
+session_pool = SessionPool()
+
+
+class FlightAborted(Exception):
+    """
+    Raised to callers waiting on a coalesced call whose caller was
+    interrupted (e.g. its greenlet killed) before func returned
+    """
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls. While a call for a key is running,
+    other callers with the same key wait for it and get a copy of its result
+    (or its exception) instead of making their own.
+
+    Safe to use between threads or (monkey patched) greenlets.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        # Calls made, and calls answered by another caller's result
+        self.calls = 0
+        self.coalesced = 0
+        # Called with the key whenever a call is coalesced
+        self.on_coalesce = None
+
+    def do(self, key, func):
+        """
+        Return func(), or a copy of the result of the call already running
+        for key
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            if self.on_coalesce is not None:
+                self.on_coalesce(key)
+            flight.done.wait()
+            if flight.error is not None:
+                if not issubclass(flight.error[0], Exception):
+                    # GreenletExit, gevent.Timeout and the like are meant
+                    # for the leader only
+                    raise FlightAborted(flight.error[0].__name__)
+                raise flight.error[0], flight.error[1], flight.error[2]
+            # Callers may modify what they get back
+            return copy.deepcopy(flight.result)
+
+        result = None
+        try:
+            result = func()
+            return result
+        except BaseException:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.waiters and flight.error is None:
+                    # Before the leader's caller can modify it
+                    flight.result = copy.deepcopy(result)
+            flight.done.set()
+
+    def __len__(self):
+        return len(self._flights)
+
+
+# Process-wide coalescing of Device Cloud reads, shared by all connectors
+request_flights = SingleFlight()
+
+
 class DeviceCloudConnector(object):
 
     def __init__(self, username, password, cloud_fqdn):
@@ -62,40 +369,61 @@ class DeviceCloudConnector(object):
                                 'login.etherios.com')
         """
         self.cloud_fqdn = cloud_fqdn
-        # Requests session, defaults
-        r = requests.Session()
-        r.auth = (username, password)
-        r.headers.update({'Accept': 'application/json'})
-        self.r = r
+        self.auth = (username, password)
+        # Pooled Requests session, shared with other connectors for this
+        # account. Credentials are added to each request instead of the
+        # session.
+        self.r = session_pool.get(username, cloud_fqdn)
 
     # Helper methods to wrap common requests logic
+    @staticmethod
+    def _log_response(response, streamed):
+        # Reading the body of a streamed response would consume it
+        if logger.isEnabledFor(logging.DEBUG) and not streamed:
+            logger.debug("Response %s: %s" % (response.status_code,
+                                               response.text))
+
     def _get(self, *args, **kwargs):
+        kwargs.setdefault('auth', self.auth)
         response = self.r.get(*args, **kwargs)
         logger.info("GET on %s" % response.url)
-        logger.debug("Response %s: %s" % (response.status_code, response.text))
+        self._log_response(response, kwargs.get('stream'))
         response.raise_for_status()
         return response
 
+    def _get_parsed(self, uri, params=None):
+        """
+        GET uri and parse the response. An identical read already in flight
+        with the same credentials is shared rather than repeated.
+        """
+        key = (self.auth, uri, tuple(sorted((params or {}).items())))
+        return request_flights.do(
+            key, lambda: _parse_response(self._get(uri, params=params,
+                                                   stream=True)))
+
     def _post(self, *args, **kwargs):
+        kwargs.setdefault('auth', self.auth)
         response = self.r.post(*args, **kwargs)
         logger.info("POST on %s" % response.url)
         logger.debug("POST data: %s" % kwargs['data'])
-        logger.debug("Response %s: %s" % (response.status_code, response.text))
+        self._log_response(response, kwargs.get('stream'))
         response.raise_for_status()
         return response
 
     def _put(self, *args, **kwargs):
+        kwargs.setdefault('auth', self.auth)
         response = self.r.put(*args, **kwargs)
         logger.info("PUT on %s" % response.url)
         logger.debug("PUT data: %s" % kwargs['data'])
-        logger.debug("Response %s: %s" % (response.status_code, response.text))
+        self._log_response(response, kwargs.get('stream'))
         response.raise_for_status()
         return response
 
     def _delete(self, *args, **kwargs):
+        kwargs.setdefault('auth', self.auth)
         response = self.r.delete(*args, **kwargs)
         logger.info("DELETE on %s" % response.url)
-        logger.debug("Response %s: %s" % (response.status_code, response.text))
+        self._log_response(response, kwargs.get('stream'))
         response.raise_for_status()
         return response
 
@@ -154,14 +482,16 @@ class DeviceCloudConnector(object):
 
         uri = ws_uri.format(
             resource=DEVICECORE_RESOURCE, fqdn=self.cloud_fqdn, path_filter="")
-        r = self._get(uri, params=params)
+        return self._get_parsed(uri, params=params)
 
-        return _parse_response(r)
-
-    def get_xbees(self, device_id=None, cache=True, clear=False, addrs=None):
+    def get_xbees(self, device_id=None, cache=True, clear=False, addrs=None,
+                  start=None, size=None):
         """
         Do an XbeeCore GET for this device's XBees.
 
+        start and size select a page of the records, Device Cloud returns
+        its default page size from the first one otherwise.
+
         TODO Write a better docstring.
         """
         conditions = []
@@ -187,12 +517,14 @@ class DeviceCloudConnector(object):
             'clear': "true" if clear else "false",
             'condition': cond
         }
+        if start is not None:
+            params['start'] = start
+        if size is not None:
+            params['size'] = size
 
         uri = ws_uri.format(
             resource=XBEE_RESOURCE, fqdn=self.cloud_fqdn, path_filter="")
-        r = self._get(uri, params=params)
-
-        return _parse_response(r)
+        return self._get_parsed(uri, params=params)
 
     def provision_device(self, mac):
         """
@@ -234,18 +566,22 @@ class DeviceCloudConnector(object):
         uri = ws_uri.format(
             resource=DATASTREAM_RESOURCE, fqdn=self.cloud_fqdn,
             path_filter=stream_path)
-        r = self._get(uri)
-
-        return _parse_response(r)
+        return self._get_parsed(uri)
 
-    def get_datapoints(self, stream_id, start_time=None):
+    def get_datapoints(self, stream_id, start_time=None, end_time=None,
+                       size=None, page_cursor=None):
         """
-        Get a list of DataStreams available to the user.
+        Get a page of DataPoints from a DataStream.
 
         Args:
             stream_id (str) - the stream ID to query data from
             start_time - timestamp, either epoch time (millis since start of
                             1970) or ISO 8601
+            end_time - timestamp, as start_time. Only DataPoints before it are
+                            returned.
+            size (int) - maximum number of DataPoints to return
+            page_cursor (str) - pageCursor of the previous page, to get the
+                            next one
 
         Returns:
             Python object loaded from Device Cloud JSON response
@@ -253,12 +589,60 @@ class DeviceCloudConnector(object):
         params = {
             'startTime': start_time
         }
+        if end_time is not None:
+            params['endTime'] = end_time
+        if size is not None:
+            params['size'] = size
+        if page_cursor is not None:
+            params['pageCursor'] = page_cursor
         uri = ws_uri.format(
             resource=DATAPOINT_RESOURCE, fqdn=self.cloud_fqdn,
             path_filter=stream_id)
-        r = self._get(uri, params=params)
+        return self._get_parsed(uri, params=params)
 
-        return _parse_response(r)
+    def iter_datapoint_pages(self, stream_id, start_time=None, end_time=None,
+                             size=DATAPOINT_PAGE_SIZE, envelope=None):
+        """
+        Generator over every page of DataPoints in a time range, following
+        Device Cloud's pageCursor. Pages are only requested as the previous
+        one is consumed.
+
+        Args as get_datapoints.
+
+        Kwargs:
+            envelope (dict) - if given, updated with the fields of the first
+                            page describing the query, e.g. requestedEndTime
+                            (all but items, resultSize and pageCursor)
+
+        Yields:
+            Lists of DataPoints, oldest first
+        """
+        page_cursor = None
+        while True:
+            page = normalize_datapoints(self.get_datapoints(
+                stream_id, start_time, end_time, size, page_cursor))
+            if envelope is not None and page_cursor is None:
+                envelope.update(
+                    (key, value) for key, value in page.iteritems()
+                    if key not in ('items', 'resultSize', 'pageCursor'))
+            items = page['items']
+            if items:
+                yield items
+            page_cursor = page.get('pageCursor')
+            # Device Cloud returns a cursor even with the last page
+            if not page_cursor or len(items) < size:
+                return
+
+    def iter_datapoints(self, stream_id, start_time=None, end_time=None,
+                        size=DATAPOINT_PAGE_SIZE, envelope=None):
+        """
+        Generator over every DataPoint in a time range, see
+        iter_datapoint_pages.
+        """
+        for page in self.iter_datapoint_pages(stream_id, start_time,
+                                              end_time, size, envelope):
+            for point in page:
+                yield point
 
     def get_device_settings(self, device_id, radio=None, cache=False):
         """
@@ -272,47 +656,25 @@ class DeviceCloudConnector(object):
             cache (bool) - Whether to use Device Cloud cache. Default False.
 
         Returns:
-            Python dict representation of xml response (using xmltodict lib)
+            Python dict representation of xml response, as xmltodict would
+            give it, but with only the query_setting element and any errors
         """
         if radio:
             if not radio.endswith("!"):
                 radio = radio + '!'
 
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    '@cache': str(cache),
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'do_command': {
-                            '@target': 'xbee',
-                            'query_setting': {
-                                '@addr': radio,
-                            },
-                        },
-                    },
-                },
-            },
-        }
-
-        if not radio:
-            req = post_dict['sci_request']['send_message']['rci_request']
-            del req['do_command']
-            req['query_setting'] = {}
-
-        post_body = xmltodict.unparse(post_dict)
+        if radio:
+            command = sci.XBEE_QUERY_SETTING.render(addr=sci.attr(radio))
+        else:
+            command = sci.QUERY_SETTING
+        post_body = sci.rci_request(device_id, command, cache=cache)
 
         uri = ws_uri.format(
             resource=SCI_RESOURCE, fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
+        r = self._post(uri, data=post_body, stream=True)
 
-        return _parse_response(r)
+        return _parse_response(
+            r, select=XBEE_SETTINGS_PATH if radio else GATEWAY_SETTINGS_PATH)
 
     def set_device_settings(self, device_id, radio=None, settings={}):
         """
@@ -329,41 +691,19 @@ class DeviceCloudConnector(object):
             Python dict representation of xml response (using xmltodict lib)
         """
         settings = settings.copy()
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    '@cache': "False",
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_setting': settings,
-                    },
-                },
-            },
-        }
-
         if radio:
             if not radio.endswith("!"):
                 radio = radio + '!'
-
-            request = post_dict['sci_request']['send_message']['rci_request']
-            del request['set_setting']
-            request['do_command'] = {
-                '@target': 'xbee',
-                'set_setting': settings
-            }
-            request['do_command']['set_setting']['@addr'] = radio
-
-        post_body = xmltodict.unparse(post_dict)
+            settings['@addr'] = radio
+            command = sci.XBEE_COMMAND.render(
+                command=sci.element('set_setting', settings))
+        else:
+            command = sci.element('set_setting', settings)
+        post_body = sci.rci_request(device_id, command, cache=False)
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
-        r = self._post(uri, data=post_body)
+        r = self._post(uri, data=post_body, stream=True)
 
         return _parse_response(r)
 
@@ -378,28 +718,9 @@ class DeviceCloudConnector(object):
                                 pins
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': {
-                                'OM': enable_mask,
-                            },
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
+        command = sci.SET_STATE.render(
+            state=sci.element('OM', enable_mask))
+        post_body = sci.rci_request(device_id, command)
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -417,28 +738,9 @@ class DeviceCloudConnector(object):
             io_mask (str) - hex string of bit map that specifies pin levels
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': {
-                                'IO': io_mask,
-                            },
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
+        command = sci.SET_STATE.render(
+            state=sci.element('IO', io_mask))
+        post_body = sci.rci_request(device_id, command)
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -457,29 +759,9 @@ class DeviceCloudConnector(object):
             io_mask (str) - hex string of bit map that specifies pin levels
 
         """
-        # Note: using an ordered dict to ensure OM command comes first in
-        # rendered xml
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'set_state': {
-                            'Executable': OrderedDict(
-                                [('OM', enable_mask), ('IO', io_mask)])
-                        },
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
+        command = sci.SET_STATE.render(
+            state=sci.element('OM', enable_mask) + sci.element('IO', io_mask))
+        post_body = sci.rci_request(device_id, command)
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -528,6 +810,16 @@ class DeviceCloudConnector(object):
             topic, url, auth_user, auth_pass, description, batch_size=1000,
             batch_duration=1)
 
+    def create_account_datapoint_monitor(self, url, auth_user, auth_pass,
+                                         description=None):
+        """
+        Create a single Device Cloud monitor for the DataPoint resource,
+        covering every device on the account, and enabling batching
+        """
+        return self.create_monitor(
+            DATAPOINT_RESOURCE, url, auth_user, auth_pass, description,
+            batch_size=1000, batch_duration=1)
+
     def create_devicecore_monitor(self, url, auth_user, auth_pass,
                                   description=None):
         """
@@ -570,6 +862,12 @@ class DeviceCloudConnector(object):
 
         return self.get_monitors(topics, [url])
 
+    def get_datapoint_monitor_for_account(self, url):
+        """
+        Wrapper around get_monitors, with the account-wide DataPoint topic
+        """
+        return self.get_monitors([DATAPOINT_RESOURCE], [url])
+
     def get_devicecore_monitor(self, url):
         """
         Wrapper around get_monitors, with the devicecore topic
@@ -598,6 +896,16 @@ class DeviceCloudConnector(object):
 
         return _parse_response(r)
 
+    def delete_monitor(self, monitor_id):
+        """
+        Delete the monitor with the given id
+
+        Returns: None
+        """
+        uri = ws_uri.format(resource=MONITOR_RESOURCE,
+                            fqdn=self.cloud_fqdn, path_filter=monitor_id)
+        self._delete(uri)
+
     def send_serial_data(self, device_id, data_b64, target_name=''):
         """
         Send data out the serial port of the device using the SCI Data Service
@@ -611,27 +919,9 @@ class DeviceCloudConnector(object):
                                 mode. Defaults to empty.
 
         """
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'data_service': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'requests': {
-                        'device_request': {
-                            '@target_name': target_name,
-                            '@format': 'base64',
-                            '#text': data_b64,
-                        }
-                    },
-                },
-            },
-        }
-
-        post_body = xmltodict.unparse(post_dict)
+        post_body = sci.DATA_SERVICE_REQUEST.render(
+            target_name=sci.attr(target_name), data=sci.text(data_b64),
+            device_id=sci.attr(device_id))
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
@@ -640,30 +930,11 @@ class DeviceCloudConnector(object):
         return _parse_response(r)
 
     def send_xbgw_commands(self, device_id, command_dict):
-        post_dict = {
-            'sci_request': {
-                '@version': '1.0',
-                'send_message': {
-                    'targets': {
-                        'device': {
-                            '@id': device_id,
-                        },
-                    },
-                    'rci_request': {
-                        '@version': '1.1',
-                        'do_command': {
-                            '@target': 'xbgw'
-                        }
-                    }
-                }
-            }
-        }
-
         # Put commands into do_command body
-        rci_request = post_dict['sci_request']['send_message']['rci_request']
-        rci_request['do_command'].update(command_dict)
-
-        post_body = xmltodict.unparse(post_dict)
+        do_command = {'@target': 'xbgw'}
+        do_command.update(command_dict)
+        post_body = sci.rci_request(
+            device_id, sci.element('do_command', do_command))
 
         uri = ws_uri.format(resource=SCI_RESOURCE,
                             fqdn=self.cloud_fqdn, path_filter="")
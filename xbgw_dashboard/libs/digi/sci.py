@@ -0,0 +1,118 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Precompiled SCI/RCI request bodies
+
+The fixed envelope of each request is split into literal text and slots
+once, so a request is rendered with a single join instead of building and
+serializing a dict tree. Output is identical to xmltodict.unparse of the
+equivalent dicts.
+"""
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+_SLOT_RE = re.compile(r'\{(\w+)\}')
+
+
+class Template(object):
+    """
+    Request text with {name} slots. Slot values are inserted as given, so
+    they must already be XML: see attr(), text() and element().
+    """
+
+    def __init__(self, source):
+        parts = _SLOT_RE.split(source)
+        # Literal text at even indexes, slot names at odd ones
+        self._parts = parts
+        self._slots = [(i, parts[i]) for i in xrange(1, len(parts), 2)]
+
+    def render(self, **values):
+        parts = list(self._parts)
+        for i, name in self._slots:
+            parts[i] = values[name]
+        return u''.join(parts)
+
+
+def attr(value):
+    """
+    value as a quoted attribute value
+    """
+    return quoteattr(value)
+
+
+def text(value):
+    """
+    value as escaped character data
+    """
+    return escape(unicode(value))
+
+
+def element(name, value):
+    """
+    Render value as element name, the way xmltodict.unparse does: dicts
+    give children, with '@' keys as attributes and '#text' as text, lists
+    give repeated elements and None an empty one.
+    """
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    rendered = []
+    for item in value:
+        if item is None:
+            item = {}
+        elif not isinstance(item, dict):
+            rendered.append(u'<%s>%s</%s>' % (name, text(item), name))
+            continue
+        attrs = []
+        children = []
+        cdata = u''
+        for key, child in item.items():
+            if key == '#text':
+                if child is not None:
+                    cdata = text(child)
+            elif key.startswith('@'):
+                attrs.append(u' %s=%s' % (key[1:], attr(child)))
+            else:
+                children.append(element(key, child))
+        rendered.append(u'<%s%s>%s%s</%s>' % (name, u''.join(attrs),
+                                              u''.join(children), cdata,
+                                              name))
+    return u''.join(rendered)
+
+
+RCI_REQUEST = Template(
+    u'<?xml version="1.0" encoding="utf-8"?>\n'
+    u'<sci_request version="1.0"><send_message{cache}>'
+    u'<rci_request version="1.1">{command}</rci_request>'
+    u'<targets><device id={device_id}></device></targets>'
+    u'</send_message></sci_request>')
+
+DATA_SERVICE_REQUEST = Template(
+    u'<?xml version="1.0" encoding="utf-8"?>\n'
+    u'<sci_request version="1.0"><data_service><requests>'
+    u'<device_request format="base64" target_name={target_name}>{data}'
+    u'</device_request></requests>'
+    u'<targets><device id={device_id}></device></targets>'
+    u'</data_service></sci_request>')
+
+QUERY_SETTING = u'<query_setting></query_setting>'
+XBEE_QUERY_SETTING = Template(
+    u'<do_command target="xbee"><query_setting addr={addr}>'
+    u'</query_setting></do_command>')
+XBEE_COMMAND = Template(u'<do_command target="xbee">{command}</do_command>')
+SET_STATE = Template(u'<set_state><Executable>{state}</Executable></set_state>')
+
+
+def rci_request(device_id, command, cache=None):
+    """
+    SCI send_message request carrying the RCI command (rendered XML) to
+    device_id. cache, if not None, sets the message's cache attribute.
+    """
+    return RCI_REQUEST.render(
+        cache=u' cache=%s' % attr(str(cache)) if cache is not None else u'',
+        command=command, device_id=attr(device_id))
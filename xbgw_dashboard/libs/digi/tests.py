@@ -15,12 +15,24 @@ Replace this with more appropriate tests for your application.
 from mock import patch, MagicMock
 from django.contrib.auth import get_user_model
 from django.test import TestCase
-from auth import DeviceCloudBackend
+from auth import DeviceCloudBackend, auth_cache
 from forms import DeviceCloudAuthenticationForm
-from devicecloud import DeviceCloudConnector
+from devicecloud import DeviceCloudConnector, SessionPool, SingleFlight, \
+    FlightAborted, request_flights, XBEE_SETTINGS_PATH, reply_errors, _parse_response
+from cache import TTLCache
+from greenlet import GreenletExit
+import sci
+import xmlparse
+import xmltodict
 from requests.exceptions import HTTPError, ConnectionError
-from requests import Response
+from requests import Request, Response
+from requests.cookies import extract_cookies_to_jar
+from httplib import HTTPMessage
+from requests.packages.urllib3.response import HTTPResponse
+from StringIO import StringIO
 import json
+import threading
+import time
 
 User = get_user_model()
 
@@ -224,6 +236,279 @@ class DeviceCloudConnectorTestCase(TestCase):
         self.cloud = DeviceCloudConnector("user", "pass", "cloud")
 
 
+class SessionPoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(maxsize=2, idle_timeout=60, max_accounts=2)
+
+    def test_session_reused_per_account(self):
+        session = self.pool.get('user', 'cloud')
+        self.assertIs(session, self.pool.get('user', 'cloud'))
+        self.assertIsNot(session, self.pool.get('user', 'othercloud'))
+        self.assertIsNot(session, self.pool.get('otheruser', 'cloud'))
+
+    def test_session_has_no_credentials(self):
+        session = self.pool.get('user', 'cloud')
+        self.assertIsNone(session.auth)
+        self.assertEqual(session.get_adapter('https://cloud')._pool_maxsize, 2)
+
+    def test_session_keeps_no_cookies(self):
+        session = self.pool.get('user', 'cloud')
+        response = MagicMock()
+        response._original_response.msg = HTTPMessage(
+            StringIO('Set-Cookie: JSESSIONID=abc; Path=/\r\n\r\n'))
+        request = Request('GET', 'https://cloud/ws/DeviceCore').prepare()
+        extract_cookies_to_jar(session.cookies, request, response)
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_eviction_waits_for_requests(self):
+        session = self.pool.get('user1', 'cloud')
+        closes = []
+        session.close = lambda: closes.append(1)
+        def send(*args, **kwargs):
+            # Evicted while this request is in flight
+            self.pool.get('user2', 'cloud')
+            self.pool.get('user3', 'cloud')
+            self.assertEqual(closes, [])
+            return MagicMock()
+        with patch('requests.sessions.Session.request', side_effect=send):
+            session.get('https://cloud/ws/DeviceCore')
+        self.assertEqual(closes, [1])
+
+    def test_account_limit(self):
+        first = self.pool.get('user1', 'cloud')
+        self.pool.get('user2', 'cloud')
+        self.pool.get('user3', 'cloud')
+        self.assertEqual(len(self.pool), 2)
+        self.assertIsNot(first, self.pool.get('user1', 'cloud'))
+
+    @patch('xbgw_dashboard.libs.digi.cache.time.time')
+    def test_idle_eviction(self, patched_time):
+        patched_time.return_value = 1000
+        session = self.pool.get('user', 'cloud')
+        patched_time.return_value = 1059
+        self.assertIs(session, self.pool.get('user', 'cloud'))
+        patched_time.return_value = 1120
+        self.assertIsNot(session, self.pool.get('user', 'cloud'))
+
+    def test_connectors_share_session(self):
+        conn1 = DeviceCloudConnector('pooluser', 'pass1', 'cloud')
+        conn2 = DeviceCloudConnector('pooluser', 'pass2', 'cloud')
+        self.assertIs(conn1.r, conn2.r)
+        self.assertEqual(conn2.auth, ('pooluser', 'pass2'))
+
+
+class SingleFlightTest(DeviceCloudConnectorTestCase):
+
+    def start(self, func, *args):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(func(*args)))
+        thread.daemon = True
+        thread.start()
+        return thread, results
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.001)
+
+    def test_concurrent_calls_coalesced(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        def func():
+            calls.append(1)
+            release.wait()
+            return {'items': [1]}
+        leader, leader_results = self.start(flights.do, 'key', func)
+        self.wait_for(lambda: len(flights))
+        waiter, waiter_results = self.start(flights.do, 'key', func)
+        self.wait_for(lambda: flights.coalesced)
+        release.set()
+        leader.join()
+        waiter.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(leader_results, waiter_results)
+        # Each caller gets its own copy
+        self.assertIsNot(leader_results[0], waiter_results[0])
+        # Finished calls aren't shared
+        flights.do('key', func)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((flights.calls, flights.coalesced), (2, 1))
+
+    def test_error_shared(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        def func():
+            release.wait()
+            raise ValueError()
+        errors = []
+        def call():
+            try:
+                flights.do('key', func)
+            except ValueError:
+                errors.append(1)
+        leader, _ = self.start(call)
+        self.wait_for(lambda: len(flights))
+        waiter, _ = self.start(call)
+        self.wait_for(lambda: flights.coalesced)
+        release.set()
+        leader.join()
+        waiter.join()
+        self.assertEqual(len(errors), 2)
+
+    def test_leader_killed(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        def func():
+            release.wait()
+            # As when the leader's greenlet is killed
+            raise GreenletExit()
+        errors = []
+        def call(expected):
+            try:
+                flights.do('key', func)
+            except expected:
+                errors.append(expected)
+        leader, _ = self.start(call, GreenletExit)
+        self.wait_for(lambda: len(flights))
+        waiter, _ = self.start(call, FlightAborted)
+        self.wait_for(lambda: flights.coalesced)
+        release.set()
+        leader.join()
+        waiter.join()
+        self.assertEqual(errors.count(GreenletExit), 1)
+        # The waiter raises rather than returning None
+        self.assertEqual(errors.count(FlightAborted), 1)
+        self.assertEqual(len(flights), 0)
+
+    def test_connector_reads_coalesced(self):
+        release = threading.Event()
+        def get(*args, **kwargs):
+            release.wait()
+            response = MagicMock()
+            response.headers = {'Content-Type': 'application/json'}
+            response.json.return_value = {'items': []}
+            return response
+        self.patched_get.side_effect = get
+        other = DeviceCloudConnector("user", "otherpass", "cloud")
+        coalesced = request_flights.coalesced
+        first, first_results = self.start(self.cloud.get_device_list)
+        self.wait_for(lambda: self.patched_get.call_count)
+        same, same_results = self.start(self.cloud.get_device_list)
+        # Different credentials don't share results
+        different, _ = self.start(other.get_device_list)
+        self.wait_for(lambda: self.patched_get.call_count == 2)
+        self.wait_for(lambda: request_flights.coalesced > coalesced)
+        release.set()
+        for thread in (first, same, different):
+            thread.join()
+        self.assertEqual(self.patched_get.call_count, 2)
+        self.assertEqual(same_results, [{'items': []}])
+
+
+class TTLCacheTest(TestCase):
+
+    @patch('xbgw_dashboard.libs.digi.cache.time.time')
+    def test_expiry(self, patched_time):
+        patched_time.return_value = 1000
+        evicted = []
+        cache = TTLCache(ttl=10, on_evict=lambda k, v: evicted.append(k))
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=30)
+        patched_time.return_value = 1011
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(evicted, ['a'])
+
+    def test_lru_eviction(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+
+SCI_SETTINGS_XML = """<?xml version="1.0" encoding="utf-8"?>
+<sci_reply version="1.0"><send_message><device id="00000000-00000000-00000000-00000001">
+<rci_reply version="1.1"><do_command target="xbee"><query_setting>
+<radio><ID>0x1234</ID><NI>caf\xc3\xa9 &amp; bar</NI></radio><serial index="1"><BD>3</BD></serial><serial index="2"/>
+</query_setting><other>ignored</other></do_command></rci_reply></device>
+<device id="00000000-00000000-00000000-00000002"><error id="2001"><desc>Timeout</desc></error></device>
+</send_message></sci_reply>"""
+
+
+class XMLParseTest(TestCase):
+
+    def test_same_as_xmltodict(self):
+        expected = xmltodict.parse(SCI_SETTINGS_XML)
+        self.assertEqual(xmlparse.parse(SCI_SETTINGS_XML), expected)
+        self.assertEqual(xmlparse.parse(SCI_SETTINGS_XML.decode('utf-8')), expected)
+        chunks = [SCI_SETTINGS_XML[i:i + 7] for i in range(0, len(SCI_SETTINGS_XML), 7)]
+        self.assertEqual(xmlparse.parse(chunks), expected)
+
+    def test_select(self):
+        reply = xmlparse.parse(SCI_SETTINGS_XML, select=XBEE_SETTINGS_PATH)
+        devices = reply['sci_reply']['send_message']['device']
+        self.assertEqual(devices[0]['@id'], '00000000-00000000-00000000-00000001')
+        do_command = devices[0]['rci_reply']['do_command']
+        self.assertEqual(do_command['query_setting'],
+                         xmltodict.parse(SCI_SETTINGS_XML)['sci_reply']['send_message']['device'][0]['rci_reply']['do_command']['query_setting'])
+        self.assertNotIn('other', do_command)
+        # Errors are kept wherever they are
+        self.assertEqual(devices[1]['error']['desc'], 'Timeout')
+        self.assertEqual(xmlparse.parse('<a x="1"><b>2</b></a>', select=('a', 'c')), {'a': {'@x': '1'}})
+
+    def test_errors(self):
+        expected = [{'path': 'sci_reply/send_message/device/error',
+                     'target': '00000000-00000000-00000000-00000002',
+                     'error': {'@id': '2001', 'desc': 'Timeout'}}]
+        self.assertEqual(xmlparse.parse(SCI_SETTINGS_XML).errors, expected)
+        self.assertEqual(xmlparse.parse(SCI_SETTINGS_XML, select=XBEE_SETTINGS_PATH).errors, expected)
+        # Only the outermost of nested errors
+        self.assertEqual(len(xmlparse.parse('<a><error><error/></error></a>').errors), 1)
+        self.assertEqual(xmlparse.parse('<a><b/></a>').errors, [])
+        # Replies parsed elsewhere are searched
+        self.assertEqual(reply_errors(xmltodict.parse(SCI_SETTINGS_XML)), expected)
+        self.assertEqual(reply_errors({'a': [{'b': 1}, {'error': 'x'}]}),
+                         [{'path': 'a/error', 'target': None, 'error': 'x'}])
+
+    def test_json_errors(self):
+        for body, errors in (('{"items": [{"a": 1}]}', []),
+                             ('{"items": [{"error": "bad"}]}',
+                              [{'path': 'items/error', 'target': None, 'error': 'bad'}])):
+            response = Response()
+            response.headers['Content-Type'] = 'application/json'
+            response.encoding = 'utf-8'
+            response._content = body
+            reply = _parse_response(response)
+            self.assertEqual(reply, json.loads(body))
+            self.assertEqual(reply_errors(reply), errors)
+
+
+class SCITemplateTest(TestCase):
+
+    def test_render(self):
+        template = sci.Template(u'<a id={id}>{body}</a>{tail}')
+        self.assertEqual(template.render(id=sci.attr('1"&'), body=sci.text('<x>'), tail=u''),
+                         u'<a id=\'1"&amp;\'>&lt;x&gt;</a>')
+
+    def test_element_same_as_xmltodict(self):
+        for value in ({'G': {'K': 'V&<', 'N': 3, 'E': None}},
+                      {'@target': 'xbgw', 'reset': {'@a': '1', '#text': 't&'}, 'x': ['a', 'b']},
+                      u'caf\xe9', None):
+            expected = xmltodict.unparse({'root': value}).split('\n', 1)[1]
+            self.assertEqual(sci.element('root', value), expected)
+
+    def test_rci_request(self):
+        self.assertEqual(
+            sci.rci_request('D&1', sci.QUERY_SETTING, cache=True),
+            u'<?xml version="1.0" encoding="utf-8"?>\n<sci_request version="1.0"><send_message cache="True"><rci_request version="1.1"><query_setting></query_setting></rci_request><targets><device id="D&amp;1"></device></targets></send_message></sci_request>')
+
+
 class DeviceCloudUserTest(TestCase):
 
     def test_device_cloud_user_create(self):
@@ -288,6 +573,7 @@ class DeviceCloudBackendTest(TestCase):
         mc = self.mockedConnector.return_value
         mc.authenticate.return_value = (True, {})
         self.backend = DeviceCloudBackend()
+        auth_cache.clear()
         self.existing_user = User.objects.create_user(username='existinguser', cloud_fqdn='cloud_fqdn')
 
     def tearDown(self):
@@ -342,6 +628,35 @@ class DeviceCloudBackendTest(TestCase):
         self.assertNotEqual(user, self.existing_user)
         self.assertEquals(starting_user_count+1, ending_user_count)
 
+    def test_auth_cached(self):
+        """
+        Test that verified credentials are not checked with device cloud again
+        """
+        mc = self.mockedConnector.return_value
+        user = self.backend.authenticate('existinguser#cloud_fqdn', 'password')
+        user.backend = 'backend'
+        cached = self.backend.authenticate('existinguser#cloud_fqdn', 'password')
+        self.assertEqual(mc.authenticate.call_count, 1)
+        self.assertEqual(cached, self.existing_user)
+        self.assertFalse(hasattr(cached, 'backend'))
+        # Other credentials are checked
+        self.backend.authenticate('existinguser#cloud_fqdn', 'other')
+        self.assertEqual(mc.authenticate.call_count, 2)
+
+    def test_auth_failure_cached(self):
+        """
+        Test that rejected credentials are refused without asking device cloud
+        again, and that device cloud errors are not cached
+        """
+        mc = self.mockedConnector.return_value
+        mc.authenticate.side_effect = HTTPError(response=MagicMock())
+        self.assertIsNone(self.backend.authenticate('bad#cloud_fqdn', 'creds'))
+        mc.authenticate.side_effect = None
+        mc.authenticate.return_value = (False, {})
+        self.assertIsNone(self.backend.authenticate('bad#cloud_fqdn', 'creds'))
+        self.assertIsNone(self.backend.authenticate('bad#cloud_fqdn', 'creds'))
+        self.assertEqual(mc.authenticate.call_count, 2)
+
 
 class DeviceCloudConnectorAuthenticateTest(DeviceCloudConnectorTestCase):
     def setUp(self):
@@ -424,6 +739,35 @@ class DeviceCloudConnectorDataPointTest(DeviceCloudConnectorTestCase):
         self.assertEqual(datapoints['items'][0]['streamId'], stream_id)
         self.assertEqual(datapoints['items'][0]['data'], "0")
 
+    def test_datapoint_query_time_range(self):
+        stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+        self.cloud.get_datapoints(stream_id, start_time=1000, end_time=2000)
+        params = self.patched_get.call_args[1]['params']
+        self.assertEqual(params['startTime'], 1000)
+        self.assertEqual(params['endTime'], 2000)
+
+    def test_datapoint_iter_pages(self):
+        stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+        first = json.loads(TEST_RESPONSES['DataPoint']['GET'])
+        last = json.loads(TEST_RESPONSES['DataPoint']['GET'])
+        last['items'] = []
+        self.patched_get.return_value.json.side_effect = [first, last]
+        points = self.cloud.iter_datapoints(stream_id, start_time=1000, size=1)
+        # Nothing requested until consumed
+        self.assertFalse(self.patched_get.called)
+        self.assertEqual([p['data'] for p in points], ["0"])
+        self.assertEqual(self.patched_get.call_count, 2)
+        params = self.patched_get.call_args[1]['params']
+        self.assertEqual(params['pageCursor'], first['pageCursor'])
+        self.assertEqual(params['size'], 1)
+
+    def test_datapoint_iter_last_page(self):
+        # A page shorter than requested is the last
+        stream_id = "00000000-00000000-00000000-00000001/DIO/0"
+        pages = list(self.cloud.iter_datapoint_pages(stream_id))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(self.patched_get.call_count, 1)
+
 
 class DeviceCloudConnectorDeviceSettingsTest(DeviceCloudConnectorTestCase):
 
@@ -445,6 +789,18 @@ class DeviceCloudConnectorDeviceSettingsTest(DeviceCloudConnectorTestCase):
         self.assertEqual(settings['sci_reply']['send_message']['device']['@id'], "00000000-00000000-00000000-00000001")
         self.assertEqual(settings['sci_reply']['send_message']['device']['rci_reply']['query_setting']['InputOutput']['D0'], "Input")
 
+    def test_settings_xml_reply(self):
+        response = Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/xml;charset=UTF-8'
+        response.raw = HTTPResponse(body=StringIO(SCI_SETTINGS_XML), preload_content=False)
+        self.patched_post.return_value = response
+        settings = self.cloud.get_device_settings("00000000-00000000-00000000-00000001", radio='00:13:A2:00:00:00:00:01')
+        self.assertTrue(self.patched_post.call_args[1]['stream'])
+        device = settings['sci_reply']['send_message']['device'][0]
+        self.assertEqual(device['rci_reply']['do_command']['query_setting']['radio']['NI'], u'caf\xe9 & bar')
+        self.assertNotIn('other', device['rci_reply']['do_command'])
+
     def test_settings_group_rci_query(self):
         settings = self.cloud.get_device_settings("00000000-00000000-00000000-00000001", settings_group='InputOutput')
         self.assertTrue(self.patched_post.called)
@@ -461,6 +817,16 @@ class DeviceCloudConnectorDeviceSettingsTest(DeviceCloudConnectorTestCase):
         xml = """<?xml version="1.0" encoding="utf-8"?>\n<sci_request version="1.0"><send_message cache="False"><rci_request version="1.1"><set_setting><InputOutput><D0>Disabled</D0></InputOutput></set_setting></rci_request><targets><device id="00000000-00000000-00000000-00000001"></device></targets></send_message></sci_request>"""
         self.assertEqual(self.patched_post.call_args[1]['data'], xml)
 
+    def test_set_output(self):
+        self.cloud.set_output("00000000-00000000-00000000-00000001", "0x3", "0x1")
+        xml = """<?xml version="1.0" encoding="utf-8"?>\n<sci_request version="1.0"><send_message><rci_request version="1.1"><set_state><Executable><OM>0x3</OM><IO>0x1</IO></Executable></set_state></rci_request><targets><device id="00000000-00000000-00000000-00000001"></device></targets></send_message></sci_request>"""
+        self.assertEqual(self.patched_post.call_args[1]['data'], xml)
+
+    def test_send_serial_data(self):
+        self.cloud.send_serial_data("00000000-00000000-00000000-00000001", "YWI=", target_name='a"b')
+        xml = """<?xml version="1.0" encoding="utf-8"?>\n<sci_request version="1.0"><data_service><requests><device_request format="base64" target_name='a"b'>YWI=</device_request></requests><targets><device id="00000000-00000000-00000000-00000001"></device></targets></data_service></sci_request>"""
+        self.assertEqual(self.patched_post.call_args[1]['data'], xml)
+
 
 class DeviceCloudConnectorMonitorTest(DeviceCloudConnectorTestCase):
 
@@ -501,6 +867,20 @@ class DeviceCloudConnectorMonitorTest(DeviceCloudConnectorTestCase):
         self.assertTrue(self.patched_post.called)
         self.assertIn('<monTopic>DataPoint/00000000-00000000-00000000-00000001</monTopic>' ,self.patched_post.call_args[1]['data'])
 
+    def test_monitor_create_for_account_datapoint(self):
+        self.cloud.create_account_datapoint_monitor('url', 'user', 'pass', 'desc')
+        self.assertTrue(self.patched_post.called)
+        self.assertIn('<monTopic>DataPoint</monTopic>' ,self.patched_post.call_args[1]['data'])
+
+    def test_monitor_get_for_account_datapoint(self):
+        self.cloud.get_datapoint_monitor_for_account('url')
+        self.assertEqual("monTopic='DataPoint' and monTransportUrl='url'" ,self.patched_get.call_args[1]['params']['condition'])
+
+    def test_monitor_delete(self):
+        self.cloud.delete_monitor('monitor_id')
+        self.assertTrue(self.patched_delete.called)
+        self.assertIn('/ws/Monitor/monitor_id', self.patched_delete.call_args[0][1])
+
     def test_monitor_put(self):
         self.cloud.kick_monitor('monitor_id', 'user', 'pass')
         self.assertTrue(self.patched_put.called)
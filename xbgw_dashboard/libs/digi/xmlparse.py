@@ -0,0 +1,197 @@
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2015 Digi International Inc., All Rights Reserved.
+#
+
+"""
+Incremental parsing of Device Cloud XML replies
+
+Produces the same dictionaries as xmltodict.parse, but is fed the raw bytes
+of a reply chunk by chunk, and can be limited to the subtree callers read,
+e.g. the query_setting element of an SCI reply. Elements outside of it are
+not built, except for error elements, which are always kept along with the
+elements leading to them.
+
+Error elements are also listed while parsing, in the errors attribute of
+the result, so callers needn't search the reply for them.
+"""
+from collections import OrderedDict
+from xml.parsers import expat
+
+# Bytes read from a response at a time
+CHUNK_SIZE = 16 * 1024
+
+ATTR_PREFIX = '@'
+CDATA_KEY = '#text'
+ERROR = 'error'
+# Element whose id attribute names the target of an SCI request
+TARGET = 'device'
+
+
+def _push(item, key, value):
+    # Repeated elements become a list, as with xmltodict
+    try:
+        existing = item[key]
+    except KeyError:
+        item[key] = value
+        return
+    if isinstance(existing, list):
+        existing.append(value)
+    else:
+        item[key] = [existing, value]
+
+
+class Document(OrderedDict):
+    """
+    A parsed document, with the error elements found in it as a list of
+    {'path': 'a/b/error', 'target': device id or None, 'error': value}.
+    Also used by devicecloud for JSON replies.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Document, self).__init__(*args, **kwargs)
+        self.errors = []
+
+
+def _attr(attrs, name):
+    for i in xrange(0, len(attrs), 2):
+        if attrs[i] == name:
+            return attrs[i + 1]
+    return None
+
+
+class _Element(object):
+    __slots__ = ('name', 'attrs', 'item', 'text', 'full', 'on_path')
+
+    def __init__(self, name, attrs, full, on_path):
+        self.name = name
+        self.attrs = attrs
+        # Built on demand: attributes, then children
+        self.item = None
+        self.text = [] if full else None
+        self.full = full
+        self.on_path = on_path
+
+    def get_item(self):
+        if self.item is None:
+            attrs = self.attrs
+            self.item = OrderedDict(
+                (ATTR_PREFIX + attrs[i], attrs[i + 1])
+                for i in xrange(0, len(attrs), 2))
+        return self.item
+
+    def value(self):
+        """
+        The element's value as xmltodict would give it
+        """
+        text = ''.join(self.text).strip() or None
+        if self.item is None and self.attrs:
+            self.get_item()
+        if self.item is None:
+            return text
+        if text:
+            self.item[CDATA_KEY] = text
+        return self.item
+
+
+class _Handler(object):
+
+    def __init__(self, select=None):
+        self.select = tuple(select) if select is not None else None
+        self.stack = []
+        self.result = None
+        self.errors = []
+        # Error elements open, only the outermost is listed
+        self.in_error = 0
+
+    def start(self, name, attrs):
+        stack = self.stack
+        select = self.select
+        depth = len(stack)
+        parent = stack[-1] if stack else None
+        if select is None or (parent is not None and parent.full):
+            full, on_path = True, False
+        else:
+            on_path = (parent is None or parent.on_path) and \
+                depth < len(select) and select[depth] == name
+            full = (on_path and depth == len(select) - 1) or name == ERROR
+        stack.append(_Element(name, attrs, full, on_path))
+        if name == ERROR:
+            self.in_error += 1
+
+    def _add_error(self, value):
+        target = None
+        for element in reversed(self.stack):
+            if element.name == TARGET:
+                target = _attr(element.attrs, 'id')
+                break
+        path = [element.name for element in self.stack]
+        path.append(ERROR)
+        self.errors.append({'path': '/'.join(path), 'target': target,
+                            'error': value})
+
+    def end(self, name):
+        element = self.stack.pop()
+        if element.full:
+            value = element.value()
+            if name == ERROR:
+                self.in_error -= 1
+                if not self.in_error:
+                    self._add_error(value)
+        elif element.item is not None:
+            # Only holds the selected subtree or errors
+            value = element.item
+        elif not self.stack:
+            value = element.get_item() or None
+        else:
+            return
+        if self.stack:
+            _push(self.stack[-1].get_item(), name, value)
+        else:
+            self.result = Document([(name, value)])
+            self.result.errors = self.errors
+
+    def characters(self, data):
+        text = self.stack[-1].text
+        if text is not None:
+            text.append(data)
+
+
+def parse(source, select=None):
+    """
+    Parse an XML document into nested dictionaries
+
+    Args:
+        source: A string, or an iterable of byte string chunks such as
+                Response.iter_content()
+    Kwargs:
+        select (tuple): Element names from the root to the only subtree to
+                        build. Error elements are built wherever they are.
+                        None builds the whole document.
+
+    Raises expat.ExpatError if the document is malformed
+
+    Returns a Document with the root element
+    """
+    encoding = None
+    if isinstance(source, unicode):
+        # As xmltodict does for text
+        source = source.encode('utf-8')
+        encoding = 'utf-8'
+    if isinstance(source, str):
+        source = (source,)
+
+    handler = _Handler(select)
+    parser = expat.ParserCreate(encoding)
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+    for chunk in source:
+        parser.Parse(chunk, False)
+    parser.Parse('', True)
+    return handler.result
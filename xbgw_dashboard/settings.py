@@ -330,6 +330,11 @@ LIB_DIGI_DEVICECLOUD = {
     'USERNAME_CLOUD_DELIMETER': '#',
     # Set a default cloud fdqn if not provided
     'DEFAULT_CLOUD_SERVER': 'login.etherios.com',
+    # Seconds verified credentials are trusted without asking Device Cloud
+    # again, and rejected ones are refused
+    'AUTH_CACHE_TTL': 60,
+    'AUTH_CACHE_FAILURE_TTL': 10,
+    'AUTH_CACHE_MAX_SIZE': 10000,
 }
 
 # Custom authentication backend for Device Cloud
@@ -358,6 +363,134 @@ SECRET_DEVICE_CLOUD_MONITOR_AUTH_USER = \
 SECRET_DEVICE_CLOUD_MONITOR_AUTH_PASS = \
     os.environ.get('DEVICE_CLOUD_MONITOR_AUTH_PASS', "me")
 
+# Maximum number of devices whose Device Cloud monitors are set up in parallel
+# when a socket asks to start monitoring several devices at once
+MONITOR_SETUP_CONCURRENCY = int(
+    os.environ.get('MONITOR_SETUP_CONCURRENCY', 8))
+
+# Maximum number of radios whose settings are queried in parallel by the bulk
+# XBee configuration endpoint
+XBEE_CONFIG_CONCURRENCY = int(os.environ.get('XBEE_CONFIG_CONCURRENCY', 8))
+
+# Batch jobs over many radios, started over socket.io
+JOBS = {
+    # Radios processed at the same time by a job
+    'CONCURRENCY': 4,
+    # Maximum Device Cloud requests per second made by an account's jobs
+    'RATE': 5,
+    # Jobs an account can have running at the same time
+    'MAX_RUNNING': 2,
+    # Seconds a job and its progress are kept, for clients to resume
+    'RETENTION': 3600,
+}
+
+# Seconds after kicking a monitor during which further setup requests for it
+# won't kick it again. Monitors are tracked in a per-process registry, Device
+# Cloud is only re-queried on a registry miss or an error.
+MONITOR_KICK_INTERVAL = int(os.environ.get('MONITOR_KICK_INTERVAL', 300))
+
+# How DataPoint monitors are created. 'device' creates one monitor per gateway
+# (DataPoint/<device id>). 'account' creates a single DataPoint monitor for
+# the whole account, routing pushes to devices locally, and deletes any
+# per-device monitors it replaces.
+MONITOR_DATAPOINT_SCOPE = os.environ.get('MONITOR_DATAPOINT_SCOPE', 'device')
+
+# Push monitor ingestion. The monitor receiver queues each push from Device
+# Cloud and replies immediately, dispatcher greenlets deliver the queued pushes
+# to sockets.
+MONITOR_PUSH_QUEUE = {
+    # Maximum number of pushes waiting to be delivered
+    'MAX_SIZE': int(os.environ.get('MONITOR_PUSH_QUEUE_SIZE', 1000)),
+    # Number of dispatcher greenlets per process
+    'WORKERS': int(os.environ.get('MONITOR_PUSH_WORKERS', 4)),
+    # When the queue is full: 'block' waits up to BLOCK_TIMEOUT seconds for
+    # room, 'drop-oldest' discards the oldest queued push, 'reject' answers
+    # the push with a 503 so Device Cloud retries it later
+    'OVERFLOW': os.environ.get('MONITOR_PUSH_OVERFLOW', 'drop-oldest'),
+    'BLOCK_TIMEOUT': float(os.environ.get('MONITOR_PUSH_BLOCK_TIMEOUT', 5)),
+}
+
+# Broker delivering pushes to the worker processes with sockets subscribed to
+# them. LocalBroker only delivers within the receiving process, so requires a
+# single worker. UnixSocketBroker forwards pushes between the workers of one
+# host through Unix sockets in OPTIONS['PATH'], a directory only the user
+# running the workers may access.
+MONITOR_PUSH_BROKER = {
+    'BACKEND': os.environ.get(
+        'MONITOR_PUSH_BROKER',
+        'xbgw_dashboard.apps.dashboard.broker.LocalBroker'),
+    'OPTIONS': {},
+}
+if MONITOR_PUSH_BROKER['BACKEND'].endswith('UnixSocketBroker'):
+    MONITOR_PUSH_BROKER['OPTIONS']['PATH'] = os.environ.get(
+        'MONITOR_PUSH_BROKER_PATH',
+        os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            'run', 'push'))
+
+# Batching of DataPoint events sent to sockets that opt in. A batch is sent
+# INTERVAL seconds after its first event, or as soon as it holds MAX_SIZE
+# events.
+DEVICE_DATA_BATCH = {
+    'INTERVAL': float(os.environ.get('DEVICE_DATA_BATCH_INTERVAL', 0.25)),
+    'MAX_SIZE': int(os.environ.get('DEVICE_DATA_BATCH_SIZE', 100)),
+}
+
+# In-memory buffer of pushed DataPoints, used to answer DataPoint history
+# queries for monitored devices without asking Device Cloud.
+DATAPOINT_BUFFER = {
+    # Points kept per stream
+    'MAX_POINTS': int(os.environ.get('DATAPOINT_BUFFER_POINTS', 1000)),
+    # Streams kept per process
+    'MAX_STREAMS': int(os.environ.get('DATAPOINT_BUFFER_STREAMS', 10000)),
+    # Seconds after monitoring of a device starts before pushes are trusted
+    # to include every new point
+    'GRACE': 5,
+}
+
+# Local database store of DataPoints. When enabled, pushed points are saved,
+# DataPoint history is read from the database and Device Cloud is only asked
+# for ranges missing from it. Run the prune_datapoints command regularly to
+# apply RETENTION_DAYS.
+DATAPOINT_STORE = {
+    'ENABLED': bool(os.environ.get('DATAPOINT_STORE_ENABLED', False)),
+    'RETENTION_DAYS': int(os.environ.get('DATAPOINT_STORE_RETENTION_DAYS', 30)),
+    # Seconds before a time range is considered complete in Device Cloud,
+    # newer points are always fetched again
+    'SETTLE_TIME': 60,
+}
+
+# Per-account cache of DeviceCore device lists. DeviceCore pushes received by
+# a worker update its copy in place, other workers refetch after TTL seconds.
+DEVICE_LIST_CACHE = {
+    'TTL': int(os.environ.get('DEVICE_LIST_CACHE_TTL', 30)),
+    'MAX_ACCOUNTS': 1000,
+}
+
+# Per-account index of XBee nodes, used to answer node lookups without a
+# Device Cloud query. Refreshed in the background when used more than REFRESH
+# seconds after loading, dropped MAX_AGE seconds after loading.
+XBEE_INDEX = {
+    'REFRESH': 60,
+    'MAX_AGE': 600,
+    'MAX_ACCOUNTS': 1000,
+}
+
+# RCI query_setting responses of gateways and XBee radios, served instead of
+# querying the device again for TTL seconds. Settings written through the
+# dashboard are applied to the cached responses.
+SETTINGS_CACHE = {
+    'TTL': int(os.environ.get('SETTINGS_CACHE_TTL', 30)),
+    'MAX_ENTRIES': 1000,
+}
+
+# Decrypted credentials of sessions, kept by each worker for TTL seconds so
+# API requests don't decrypt the session's password every time
+CREDENTIAL_CACHE = {
+    'TTL': 300,
+    'MAX_SESSIONS': 10000,
+}
+
 # Supported Device Types (dpDeviceType) visible to frontend.
 # Will be used to filter Device Cloud queries
 #SUPPORTED_DEVICE_TYPES = ['XBee WiFi S6B TH', ]
@@ -11,6 +11,7 @@ from django.contrib.auth.views import logout_then_login
 from django.views.generic.base import TemplateView
 from rest_framework import routers
 from xbgw_dashboard.apps.dashboard import views
+from xbgw_dashboard.apps.dashboard.xbee import EXT_ADDR_PATTERN
 from xbgw_dashboard.libs.digi.forms import DeviceCloudAuthenticationForm
 from socketio import sdjango
 
@@ -93,9 +94,11 @@ dashboard_api_patterns = patterns(
     # XBee details, configuration and communications
     url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees$',
         views.XBeeList.as_view(), name='device-xbee-list'),
-    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>[0-9A-F:]+)/config$',
+    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/config$',
+        views.XBeeConfigList.as_view(), name='xbee-config-list'),
+    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>%s)/config$' % EXT_ADDR_PATTERN,
         views.XBeeConfig.as_view(), name='xbee-config'),
-    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>[0-9A-F:]+)/config-stock$',
+    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>%s)/config-stock$' % EXT_ADDR_PATTERN,
         views.XBeeStockConfig.as_view(), name='xbee-stock-config'),
     url(r'^devices/(?P<device_id>[0-9A-F\-]+)/io$', views.XBGWDeviceIO.as_view(),
         name='device-io'),
@@ -12,6 +12,7 @@ from django.views.generic.base import TemplateView
 from rest_framework import routers
 # DIFFERENCE FROM urls.py --> importing from views_e2e
 from xbgw_dashboard.apps.dashboard import views_e2e as views
+from xbgw_dashboard.apps.dashboard.xbee import EXT_ADDR_PATTERN
 from xbgw_dashboard.libs.digi.forms import DeviceCloudAuthenticationForm
 from socketio import sdjango
 
@@ -94,9 +95,9 @@ dashboard_api_patterns = patterns(
         views.DevicesDatapointList.as_view(), name='device-datapoint-list'),
     url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees$',
         views.XBeeList.as_view(), name='device-xbee-list'),
-    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>[0-9A-F:]+)/config$',
+    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>%s)/config$' % EXT_ADDR_PATTERN,
         views.XBeeConfig.as_view(), name='xbee-config'),
-    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>[0-9A-F:]+)/config-stock$',
+    url(r'^devices/(?P<device_id>[0-9A-F\-]+)/xbees/(?P<radio>%s)/config-stock$' % EXT_ADDR_PATTERN,
         views.XBeeStockConfig.as_view(), name='xbee-stock-config'),
     url(r'^xbees$', views.XBeeExplicitList.as_view(), name='xbee-list'),
     url(r'^', include(dash_api_router.urls))